@@ -1,13 +1,42 @@
+import argparse
+import asyncio
+import sys
+from src.config import Config
 from src.consumer import ImageConsumer
 from src.utils.logger import setup_logger
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exercise thumbnail consumer")
+    parser.add_argument('--mode', choices=['sync', 'async'], default=Config.CONSUMER_MODE,
+                        help="consumer runtime (default: CONSUMER_MODE or sync)")
+    parser.add_argument('--supervise', action='store_true',
+                        help="run several sync consumer processes under a supervisor")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of supervised workers (default: WORKER_COUNT)")
+    commands = parser.add_subparsers(dest='command')
+    from src.backfill import add_arguments, backfill
+    add_arguments(commands.add_parser('backfill', help="render thumbnails in bulk without RabbitMQ"))
+    args = parser.parse_args()
+    if args.command == 'backfill':
+        sys.exit(backfill(args))
+    if args.supervise and args.mode != 'sync':
+        parser.error("--supervise only supports --mode sync")
+
     logger = setup_logger()
-    logger.info("Starting application...")
+    logger.info(f"Starting application in {args.mode} mode...")
     
     try:
         print()
-        consumer = ImageConsumer()
-        consumer.run()
+        if args.supervise:
+            from src.supervisor import WorkerSupervisor
+            WorkerSupervisor(args.workers).run()
+        elif args.mode == 'async':
+            from src.async_consumer import AsyncImageConsumer
+            asyncio.run(AsyncImageConsumer().run())
+        else:
+            consumer = ImageConsumer()
+            consumer.run()
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
     except Exception as e:
-        logger.error(f"Application failed: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Application failed: {e}", exc_info=True)
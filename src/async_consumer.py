@@ -0,0 +1,387 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from src.config import Config
+from src.services.image_engines import process_context
+from src.services.image_processor import ImageProcessor, render_with_timings
+from src.services.async_s3_service import AsyncS3Service
+from src.services.async_redis_service import AsyncRedisService
+from src.services.async_rabbitmq_service import AsyncRabbitMQService
+from src.services.source_cache import SourceEvicted
+from src.services.thumbnail_cache import ThumbnailCache
+from src.services.thumbnail_store import create_thumbnail_store
+from src.utils.adaptive import AdaptiveController, report_permanent_failure, take_permanent_failures
+from src.utils.jobs import MaterializeSchedule, build_jobs, build_work_units, retry_headers, skipped_ids
+from src.utils.logger import SampledLogger, setup_logger
+from src.utils.metrics import (
+    CACHE_REQUESTS, IN_FLIGHT, observe_queue_lag, record_outcomes, stage_timer, start_metrics_server
+)
+
+
+class AsyncImageConsumer:
+    """asyncio counterpart of ImageConsumer.
+
+    Services can be injected so the consumer runs against local stand-ins
+    (an in-memory broker, fakeredis, a moto server) as well as the real ones.
+    """
+
+    def __init__(self, redis_service=None, s3_service=None, rabbitmq_service=None):
+        self.logger = setup_logger('AsyncImageConsumer')
+        self.sampled_logger = SampledLogger(self.logger)
+        self.logger.info("Initializing AsyncImageConsumer...")
+        self.config = Config()
+        self.max_in_flight = max(1, self.config.ASYNC_MAX_IN_FLIGHT)
+        self.BATCH_SIZE = max(self.config.BATCH_SIZE, self.max_in_flight)
+        # Adjusts the batch size, tasks in flight and pause between batches
+        self.controller = AdaptiveController(self.BATCH_SIZE, self.max_in_flight)
+        # Refreshes exercises:all while a long run is still going
+        self.materialize_schedule = MaterializeSchedule(
+            self.config.MATERIALIZE_INTERVAL_BATCHES, self.config.MATERIALIZE_INTERVAL_SECONDS
+        )
+        self.FANOUT_PUBLISH_CHUNK = 1000
+        self.processing = False
+        # Set when process_exercises arrives during a run, which then syncs again
+        self.rerun_requested = False
+        self.process_executor = None
+
+        self.redis_service = redis_service or AsyncRedisService()
+        self.s3_service = s3_service or AsyncS3Service()
+        self.rabbitmq_service = rabbitmq_service or AsyncRabbitMQService()
+        self.thumbnail_cache = None
+        if self.config.THUMBNAIL_CACHE_ENABLED:
+            self.thumbnail_cache = ThumbnailCache(self.redis_service.sync_service)
+        # Blocking stores run through asyncio.to_thread; s3 mode uses its own boto3 client
+        self.thumbnail_store = create_thumbnail_store(
+            self.config.THUMBNAIL_STORAGE, self.redis_service.sync_service
+        )
+        # Only the I/O-free helpers and publish() are used; downloads go through AsyncS3Service
+        self.image_processor = ImageProcessor(None, self.thumbnail_cache, self.thumbnail_store)
+
+    async def process_all_remaining(self):
+        """Process all remaining exercises, resuming an interrupted run's checkpoint"""
+        try:
+            await self.redis_service.start_run()
+            while True:
+                self.rerun_requested = False
+                await self.redis_service.sync_from_blob()
+                await self.drain_pending()
+                if not self.rerun_requested:
+                    break
+                self.logger.info("process_exercises arrived during the run, syncing again")
+
+            await self.redis_service.finish_run()
+            await self.redis_service.materialize_all_exercises()
+
+        except Exception as e:
+            self.logger.error(f"Error in process_all_remaining: {str(e)}", exc_info=True)
+            raise
+
+    async def drain_pending(self):
+        """Processes pending exercises batch by batch until none are left"""
+        self.materialize_schedule.reset()
+        while True:
+            await self.process_priority()
+            started = time.perf_counter()
+            status, exercises = await self.redis_service.get_status_and_pending(self.controller.batch_size)
+            self.controller.observe_redis(time.perf_counter() - started)
+            if status['remaining'] == 0:
+                self.logger.info("All exercises have been processed")
+                break
+            if not exercises:
+                self.logger.info("No more exercises to process")
+                break
+
+            self.logger.info(f"Processing next batch of {len(exercises)} exercises")
+            if not await self.process_batch(exercises):
+                self.logger.error("Failed to process batch, will retry")
+            if self.materialize_schedule.due():
+                await self.redis_service.materialize_all_exercises()
+
+            await asyncio.sleep(self.controller.delay)
+
+    async def process_exercise(self, semaphore, exercise_id, path_parts):
+        """Fetches, renders and stores one exercise's renditions.
+
+        Returns the (exercise_id, thumbnail, extras, s3_key) update for run_jobs to
+        commit, or None on failure.
+        """
+        async with semaphore:
+            IN_FLIGHT.inc()
+            try:
+                with stage_timer('job'):
+                    return await self._process_exercise(exercise_id, path_parts)
+            finally:
+                IN_FLIGHT.dec()
+
+    async def _process_exercise(self, exercise_id, path_parts):
+        renditions = None
+
+        async def cached(etag: str) -> bool:
+            # Checked with the ETag of the sniff GET, so a hit downloads nothing more
+            nonlocal renditions
+            fingerprint = self.image_processor.fingerprint(etag)
+            renditions = await asyncio.to_thread(self.image_processor.lookup, fingerprint)
+            return bool(renditions)
+
+        for refetched in (False, True):
+            image_data, etag = await self.s3_service.get_image_with_etag(
+                path_parts, skip=cached if self.thumbnail_cache else None
+            )
+            if self.thumbnail_cache and etag:
+                CACHE_REQUESTS.labels('hit' if renditions else 'miss').inc()
+            if renditions:
+                break
+            if not image_data:
+                self.logger.error(f"Failed to process image for {exercise_id}")
+                return None
+
+            loop = asyncio.get_running_loop()
+            try:
+                with stage_timer('render'):
+                    encoded, timings = await loop.run_in_executor(
+                        self.process_executor, render_with_timings, image_data, self.image_processor.renditions,
+                        self.image_processor.reducing_gap, self.image_processor.engine
+                    )
+                break
+            except SourceEvicted as e:
+                # Trimmed by another consumer between fetch and render
+                if refetched:
+                    raise
+                self.logger.warning(f"{e}, fetching it again")
+
+        if not renditions:
+            self.image_processor.record_render(encoded, timings)
+            if not encoded:
+                self.logger.error(f"Failed to process image for {exercise_id}")
+                report_permanent_failure(path_parts, 'undecodable')
+                return None
+
+            fingerprint = self.image_processor.fingerprint(etag) if self.thumbnail_cache and etag else None
+            renditions = await asyncio.to_thread(
+                self.image_processor.publish, exercise_id, fingerprint, encoded
+            )
+            if not renditions:
+                return None
+
+        thumbnail_uri, extras = self.image_processor.split(renditions)
+        return exercise_id, thumbnail_uri, extras, path_parts
+
+    async def run_jobs(self, jobs):
+        """Runs (exercise_id, s3_key) jobs with up to the controller's concurrency at once, then commits them together.
+
+        Returns the success count and the ids that failed permanently (see ImageConsumer.run_jobs).
+        """
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.controller.concurrency)
+        results = await asyncio.gather(
+            *(self.process_exercise(semaphore, exercise_id, path) for exercise_id, path in jobs),
+            return_exceptions=True
+        )
+        updates = []
+        for (exercise_id, _), result in zip(jobs, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"Error processing exercise {exercise_id}: {str(result)}", exc_info=result)
+            elif result:
+                updates.append(result)
+
+        success_count = 0
+        for (exercise_id, *_), updated in zip(updates, await self.redis_service.update_exercise_thumbnails(updates)):
+            if updated:
+                success_count += 1
+                self.sampled_logger.info("Successfully processed %s", exercise_id)
+            else:
+                self.logger.error(f"Failed to update Redis for {exercise_id}")
+        permanent = take_permanent_failures(jobs)
+        if jobs:
+            self.controller.update(len(jobs), len(jobs) - success_count, time.perf_counter() - started,
+                                   permanent=len(permanent))
+        record_outcomes(success_count, len(jobs) - success_count)
+        return success_count, permanent
+
+    async def process_priority(self, exercise_ids=()):
+        """Renders exercises requested on the interactive lane ahead of the backlog (see ImageConsumer)"""
+        if exercise_ids:
+            await asyncio.to_thread(self.redis_service.sync_service.prioritize, exercise_ids)
+
+        taken = 0
+        while True:
+            exercises, unknown = await self.redis_service.take_priority(self.config.PRIORITY_BATCH_SIZE)
+            if unknown:
+                # Most likely created after the last sync
+                await self.redis_service.sync_from_blob()
+                exercises += await self.redis_service.get_pending_exercises(unknown)
+            if not exercises:
+                break
+
+            self.logger.info(f"Processing {len(exercises)} prioritized exercises")
+            await self.process_batch(exercises, checkpoint=False)
+            taken += len(exercises)
+        return taken
+
+    async def fan_out(self):
+        """Publishes every pending exercise as process_thumbnails work units"""
+        await self.redis_service.sync_from_blob()
+
+        # Read and published a chunk at a time, as in ImageConsumer.fan_out
+        pending = self.redis_service.sync_service.iter_pending_exercises()
+        published = 0
+        while exercises := await asyncio.to_thread(lambda: list(islice(pending, self.FANOUT_PUBLISH_CHUNK))):
+            published += await self.publish_work_units(exercises)
+
+        self.logger.info(f"Fanned out {published} work units")
+        return published
+
+    async def publish_work_units(self, exercises):
+        jobs = build_jobs(exercises, self.logger)
+        record_outcomes(0, 0, skipped=len(exercises) - len(jobs))
+        units = build_work_units(jobs, self.config.FANOUT_BATCH_SIZE)
+        return await self.rabbitmq_service.publish_many(self.config.RABBITMQ_QUEUE, units)
+
+    async def process_work_unit(self, jobs, headers=None):
+        """Processes one process_thumbnails message; returns True if any job succeeded.
+
+        Failed jobs that are still pending are requeued (see ImageConsumer.process_work_unit).
+        """
+        await self.process_priority()
+        jobs = [(exercise_id, path_parts) for exercise_id, path_parts in jobs]
+        # Redelivered units skip the jobs that were already committed
+        pending_jobs = await self.redis_service.filter_pending_jobs(jobs)
+        if len(pending_jobs) < len(jobs):
+            self.logger.info(f"Skipping {len(jobs) - len(pending_jobs)} already processed exercises")
+
+        success_count, permanent = await self.run_jobs(pending_jobs)
+        await self.redis_service.record_failures(
+            [exercise_id for exercise_id, _ in pending_jobs if exercise_id not in permanent], permanent
+        )
+        self.logger.info(f"Work unit complete - Processed: {success_count}/{len(pending_jobs)} exercises")
+        if success_count < len(pending_jobs):
+            await self.retry_work_unit(await self.redis_service.filter_pending_jobs(pending_jobs), headers)
+
+        # The last worker to finish refreshes exercises:all, and any worker
+        # does on schedule while the backlog lasts
+        due = self.materialize_schedule.due()
+        if due or (await self.redis_service.get_processing_status())['remaining'] == 0:
+            await self.redis_service.materialize_all_exercises()
+        return success_count > 0
+
+    async def retry_work_unit(self, jobs, headers):
+        """Republishes a unit's failed jobs at the back of the work queue (see ImageConsumer.retry_work_unit)"""
+        if not jobs:
+            return
+        headers, exhausted = retry_headers(
+            headers, RuntimeError(f"{len(jobs)} jobs failed"), self.config.MAX_ATTEMPTS
+        )
+        if exhausted:
+            self.logger.error(f"Work unit failed {headers['x-attempts']} times, leaving {len(jobs)} jobs pending")
+            return
+        unit = build_work_units(jobs, len(jobs))[0]
+        if not await self.rabbitmq_service.republish(self.config.RABBITMQ_QUEUE, json.dumps(unit).encode(), headers):
+            self.logger.error(f"Could not requeue {len(jobs)} failed jobs, leaving them for the next run")
+
+    async def process_batch(self, exercises, checkpoint=True):
+        """Process a batch of exercises; ``checkpoint`` adds it to the drain run's counters"""
+        try:
+            total_exercises = len(exercises)
+            jobs = build_jobs(exercises, self.logger)
+            record_outcomes(0, 0, skipped=total_exercises - len(jobs))
+            success_count, permanent = await self.run_jobs(jobs)
+
+            # Whatever is still pending failed; unusable URLs and broken images fail for good
+            dead = await self.redis_service.record_failures(
+                [exercise_id for exercise_id, _ in jobs if exercise_id not in permanent],
+                skipped_ids(exercises, jobs) + permanent
+            )
+            if checkpoint:
+                await self.redis_service.checkpoint_run(success_count, total_exercises - success_count, len(dead))
+
+            status = await self.redis_service.get_processing_status()
+            self.logger.info(
+                f"Batch complete - Processed: {success_count}/{total_exercises} exercises. "
+                f"Overall progress: {status['processed']}/{status['total']} "
+                f"({status['remaining']} remaining). Limits: {self.controller.describe()}"
+            )
+
+            return success_count > 0
+
+        except Exception as e:
+            self.logger.error(f"Batch processing error: {str(e)}", exc_info=True)
+            await self.redis_service.release_claims(exercise.get('id') for exercise in exercises)
+            return False
+
+    async def callback(self, message):
+        try:
+            observe_queue_lag(message.timestamp.timestamp() if message.timestamp else None)
+            data = json.loads(message.body)
+
+            if data.get('action') == 'process_exercises':
+                if self.processing:
+                    # The run in progress syncs again before it returns, which
+                    # covers this trigger
+                    self.rerun_requested = True
+                    await message.ack()
+                    return
+
+                self.processing = True
+                try:
+                    if self.config.WORK_MODE == 'fanout':
+                        await self.fan_out()
+                    else:
+                        await self.process_all_remaining()
+                finally:
+                    self.processing = False
+                await message.ack()
+            elif data.get('action') == 'process_thumbnails':
+                await self.process_work_unit(data.get('jobs', []), message.headers)
+                await message.ack()
+            elif data.get('action') == 'process_priority':
+                # Runs alongside a drain in progress; ZPOPMIN hands each id to one taker
+                await self.process_priority(data.get('ids', []))
+                await message.ack()
+            else:
+                self.logger.warning(f"Unknown action: {data.get('action')}")
+                await message.ack()
+
+        except Exception as e:
+            self.logger.error(f"Callback error: {str(e)}", exc_info=True)
+            self.processing = False
+            if not message.processed:
+                await self.retry_message(message, e)
+
+    async def retry_message(self, message, error):
+        """Requeues a failed message with its attempt count, dead-lettering it after MAX_ATTEMPTS"""
+        headers, exhausted = retry_headers(message.headers, error, self.config.MAX_ATTEMPTS)
+        queue_name = message.routing_key or self.config.RABBITMQ_QUEUE
+        if exhausted:
+            queue_name = self.config.RABBITMQ_DEAD_LETTER_QUEUE
+            self.logger.error(f"Message failed {headers['x-attempts']} times, moving it to {queue_name}")
+
+        try:
+            if await self.rabbitmq_service.republish(queue_name, message.body, headers):
+                await message.ack()
+            else:
+                await message.nack(requeue=True)
+        except Exception as e:
+            self.logger.error(f"Could not settle failed message: {str(e)}")
+
+    async def run(self):
+        self.logger.info("Starting async consumer...")
+        start_metrics_server()
+        await self.s3_service.start()
+        if not await self.redis_service.test_connection():
+            raise Exception("Could not connect to Redis")
+
+        self.process_executor = ProcessPoolExecutor(
+            max_workers=max(1, self.config.PIPELINE_PROCESS_WORKERS),
+            mp_context=process_context(self.image_processor.engine)
+        )
+        try:
+            await self.rabbitmq_service.start_consuming(self.callback)
+        except asyncio.CancelledError:
+            self.logger.info("Shutting down...")
+        finally:
+            await self.rabbitmq_service.close()
+            await self.s3_service.close()
+            await self.redis_service.close()
+            self.process_executor.shutdown(wait=True)
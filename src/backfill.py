@@ -0,0 +1,299 @@
+"""Offline bulk thumbnailing, without RabbitMQ.
+
+    python run.py backfill                          # everything pending
+    python run.py backfill --all                    # the whole catalog, e.g. after a size change
+    python run.py backfill --input export.jsonl --limit 1000
+    python run.py backfill --all --resume-from 4711 --dry-run
+
+Exercises stream from Redis in catalog order, or from a JSONL export with
+one exercise object per line, through ImagePipeline in chunks, with a render
+process per core and enough fetches in flight to keep them busy. Results are
+committed exactly like the consumer's, so a backfill can run next to live
+consumers, and exercises:all is materialized on the consumer's schedule
+and at the end, also after an interrupted run. Throughput and an ETA are
+printed to stderr; an interrupted run prints the id to pass to
+--resume-from.
+"""
+import argparse
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+from src.config import Config
+from src.services.image_pipeline import ImagePipeline
+from src.services.image_processor import ImageProcessor
+from src.services.redis_service import RedisService
+from src.services.s3_service import S3Service
+from src.services.thumbnail_cache import ThumbnailCache
+from src.services.thumbnail_store import create_thumbnail_store
+from src.utils.adaptive import take_permanent_failures
+from src.utils.jobs import MaterializeSchedule, build_jobs, skipped_ids
+
+logger = logging.getLogger(__name__)
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+class Progress:
+    """Counts finished jobs and prints a status line to stderr.
+
+    On a terminal the line is redrawn in place every ``interval`` seconds;
+    otherwise (e.g. piped into a log) a new line is written every ten
+    intervals.
+    """
+
+    def __init__(self, total: Optional[int], interval: float = 1.0, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.tty = stream.isatty()
+        self.interval = interval if self.tty else interval * 10
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, exercise_id: str, ok: bool):
+        with self._lock:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def skip(self, count: int):
+        with self._lock:
+            self.skipped += count
+
+    def line(self) -> str:
+        with self._lock:
+            done = self.succeeded + self.failed + self.skipped
+            succeeded, failed, skipped = self.succeeded, self.failed, self.skipped
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        rate = done / elapsed
+        position = f"{done:,}"
+        eta = ''
+        if self.total:
+            position += f"/{self.total:,} {100.0 * done / self.total:5.1f}%"
+            if rate > 0:
+                eta = f"  ETA {format_duration(max(self.total - done, 0) / rate)}"
+        return (f"{position}  ok {succeeded:,}  failed {failed:,}  skipped {skipped:,}  "
+                f"{rate:,.1f}/s  elapsed {format_duration(elapsed)}{eta}")
+
+    def _print(self, end: str):
+        if self.tty:
+            self.stream.write(f"\r\033[K{self.line()}{end}")
+        else:
+            self.stream.write(f"{self.line()}\n")
+        self.stream.flush()
+
+    def _tick(self):
+        while not self._stop.wait(self.interval):
+            self._print('')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._tick, name='backfill-progress', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._print('\n')
+
+def scan_jsonl(path: str, resume_from: Optional[str]) -> Tuple[int, int]:
+    """Byte offset of the line to start from and the number of lines after it.
+
+    Without ``resume_from`` that is the whole file. Raises ValueError when
+    the id is not in the file.
+    """
+    offset, count, found = 0, 0, resume_from is None
+    with open(path, 'rb') as f:
+        for line in f:
+            if not found:
+                try:
+                    found = line.strip() and str(json.loads(line).get('id')) == resume_from
+                except (ValueError, AttributeError):
+                    pass
+                if not found:
+                    offset += len(line)
+                    continue
+            if line.strip():
+                count += 1
+    if not found:
+        raise ValueError(f"Exercise {resume_from} is not in {path}")
+    return offset, count
+
+def iter_jsonl(path: str, offset: int = 0) -> Iterator[Dict]:
+    """Yields the exercise objects of a JSONL export from a byte offset on"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                logger.error(f"Skipping unreadable line {number} after offset {offset} of {path}: {e}")
+
+def exercise_stream(args, redis_service: RedisService) -> Tuple[Iterator[Dict], Optional[int]]:
+    """The exercises to process and how many there are"""
+    if args.input:
+        offset, total = scan_jsonl(args.input, args.resume_from)
+        exercises = iter_jsonl(args.input, offset)
+    else:
+        start = None
+        if args.resume_from is not None:
+            start = redis_service.catalog_position(args.resume_from)
+            if start is None:
+                raise ValueError(f"Exercise {args.resume_from} is not in the synced catalog")
+        pending = not args.all
+        total = redis_service.count_exercises(pending=pending, start=start)
+        if pending:
+            exercises = redis_service.iter_pending_exercises(args.chunk_size, start)
+        else:
+            exercises = redis_service.iter_indexed_exercises(args.chunk_size, start)
+
+    if args.limit is not None:
+        exercises = itertools.islice(exercises, args.limit)
+        total = min(total, args.limit)
+    return exercises, total
+
+def chunks(exercises: Iterator[Dict], size: int) -> Iterator[list]:
+    while True:
+        chunk = list(itertools.islice(exercises, size))
+        if not chunk:
+            return
+        yield chunk
+
+def dry_run(exercises: Iterator[Dict], total: Optional[int], chunk_size: int) -> int:
+    """Counts what a backfill would do without fetching or writing anything"""
+    count = runnable = 0
+    first = last = None
+    for chunk in chunks(exercises, chunk_size):
+        jobs = build_jobs(chunk, logger)
+        count += len(chunk)
+        runnable += len(jobs)
+        first = first if first is not None else chunk[0].get('id')
+        last = chunk[-1].get('id')
+    print(f"Dry run: {count:,} exercises (expected {total if total is not None else 'unknown'}), "
+          f"{runnable:,} would be rendered, {count - runnable:,} have no usable image; "
+          f"ids {first} .. {last}", file=sys.stderr)
+    return 0
+
+def configure(args):
+    """Sizes the pipeline for one process that owns the host"""
+    if args.processes:
+        Config.PIPELINE_PROCESS_WORKERS = args.processes
+    # Renders are the bottleneck; a few jobs per core cover S3 latency
+    in_flight = args.in_flight or max(Config.PIPELINE_MAX_IN_FLIGHT, 4 * Config.PIPELINE_PROCESS_WORKERS)
+    Config.PIPELINE_MAX_IN_FLIGHT = in_flight
+    Config.PIPELINE_FETCH_WORKERS = max(Config.PIPELINE_FETCH_WORKERS, in_flight)
+
+def backfill(args) -> int:
+    """Runs a backfill from parsed arguments; returns the exit code"""
+    # Per-job logging would drown the status line; failures still show
+    logging.basicConfig(level=logging.WARNING)
+    configure(args)
+    redis_service = RedisService()
+    if not redis_service.test_connection():
+        print("Could not connect to Redis", file=sys.stderr)
+        return 1
+
+    if not args.dry_run and not args.no_sync:
+        synced = redis_service.sync_from_blob()
+        print(f"Synced {synced} exercises from exercises:all", file=sys.stderr)
+
+    try:
+        exercises, total = exercise_stream(args, redis_service)
+    except (OSError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    if args.dry_run:
+        return dry_run(exercises, total, args.chunk_size)
+
+    s3_service = S3Service()
+    thumbnail_cache = ThumbnailCache(redis_service) if Config.THUMBNAIL_CACHE_ENABLED else None
+    thumbnail_store = create_thumbnail_store(Config.THUMBNAIL_STORAGE, redis_service, s3_service)
+    image_processor = ImageProcessor(s3_service, thumbnail_cache, thumbnail_store)
+    pipeline = ImagePipeline(image_processor, redis_service)
+
+    print(f"Backfilling {total if total is not None else 'an unknown number of'} exercises with "
+          f"{Config.PIPELINE_PROCESS_WORKERS} render processes, {pipeline.max_in_flight} in flight",
+          file=sys.stderr)
+    progress = Progress(total)
+    progress.start()
+    resume_id = None
+    dead_lettered = 0
+    materialize_schedule = MaterializeSchedule(Config.MATERIALIZE_INTERVAL_BATCHES, Config.MATERIALIZE_INTERVAL_SECONDS)
+    try:
+        for chunk in chunks(exercises, args.chunk_size):
+            # Every earlier chunk is committed, so this is a safe restart point
+            resume_id = chunk[0].get('id')
+            jobs = build_jobs(chunk, logger)
+            progress.skip(len(chunk) - len(jobs))
+            pipeline.run(jobs, on_done=progress.record)
+            # As in the consumer: whatever is still pending failed, unusable URLs and broken images for good
+            permanent = take_permanent_failures(jobs)
+            dead_lettered += len(redis_service.record_failures(
+                [exercise_id for exercise_id, _ in jobs if exercise_id not in permanent],
+                skipped_ids(chunk, jobs) + permanent
+            ))
+            if materialize_schedule.due():
+                redis_service.materialize_all_exercises()
+        resume_id = None
+    except KeyboardInterrupt:
+        logger.warning("Interrupted")
+    except Exception as e:
+        logger.error(f"Backfill failed: {e}", exc_info=True)
+    finally:
+        progress.stop()
+        pipeline.close()
+
+    # Whatever was committed, interrupted or not, becomes visible to readers
+    # of exercises:all; the merge is WATCH-guarded like the consumer's
+    print(f"Materializing {redis_service.all_key}", file=sys.stderr)
+    if not redis_service.materialize_all_exercises():
+        print(f"Could not materialize {redis_service.all_key}; the next drain will", file=sys.stderr)
+
+    if dead_lettered:
+        print(f"{dead_lettered} exercises ran out of attempts and were dead-lettered", file=sys.stderr)
+    if resume_id is not None:
+        print(f"Stopped early; continue with --resume-from {resume_id}", file=sys.stderr)
+        return 1
+    return 1 if progress.failed else 0
+
+def add_arguments(parser: argparse.ArgumentParser):
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--all', action='store_true',
+                        help="re-render every synced exercise, not only the pending ones")
+    source.add_argument('--input', metavar='PATH',
+                        help="JSONL export to read exercises from, one exercise object per line")
+    parser.add_argument('--resume-from', metavar='ID', default=None,
+                        help="start at this exercise id (as printed by an interrupted run)")
+    parser.add_argument('--limit', type=int, default=None, help="process at most this many exercises")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="count what would be processed without fetching or writing anything")
+    parser.add_argument('--no-sync', action='store_true',
+                        help="skip syncing exercises:all into the index first")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="render processes (default: PIPELINE_PROCESS_WORKERS, i.e. one per core)")
+    parser.add_argument('--in-flight', type=int, default=None,
+                        help="jobs between fetch and commit at once (default: 4 per render process)")
+    parser.add_argument('--chunk-size', type=int, default=2000,
+                        help="exercises read and checkpointed at a time")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline bulk thumbnail backfill")
+    add_arguments(parser)
+    return backfill(parser.parse_args(argv))
+
+if __name__ == '__main__':
+    sys.exit(main())
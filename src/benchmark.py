@@ -0,0 +1,394 @@
+"""Reproducible benchmarks for the thumbnail pipeline.
+
+    python -m src.benchmark --output bench.json
+    python -m src.benchmark --redis-url redis://localhost:6379/15 --catalog-sizes 1000,10000
+
+Generates a seeded synthetic corpus, times ImageProcessor.process_image and
+the pipeline against an in-memory S3 stand-in, times every installed image
+engine and checks its output against Pillow's, then times RedisService
+catalog sync, batch updates, pending reads and materialization on catalogs of
+the given sizes, and the size and speed of every installed catalog format. Without --redis-url fakeredis is used. Results are written
+as JSON so runs can be compared across commits. The Redis database is
+flushed, so never point it at a shared instance.
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+import PIL
+from PIL import Image, ImageDraw
+from src.config import Config
+from src.services.image_engines import ENGINES, available_engines, check_encoders, get_engine
+from src.services.image_pipeline import ImagePipeline
+from src.services.image_processor import (
+    ImageProcessor, create_renditions, data_uri, parse_renditions, thumbnail_psnr
+)
+from src.services.redis_service import RedisService
+from src.utils.codec import CATALOG_FORMATS, check_format, decode_catalog, encode_catalog
+
+# (width, height, format, mode): the shapes exercise images come in
+CORPUS_SPECS = [
+    (640, 480, 'JPEG', 'RGB'),
+    (1920, 1080, 'JPEG', 'RGB'),
+    (4032, 3024, 'JPEG', 'RGB'),
+    (1200, 1200, 'PNG', 'RGBA'),
+    (800, 600, 'PNG', 'P'),
+    (1024, 768, 'PNG', 'L'),
+    (1600, 900, 'WEBP', 'RGB'),
+    (500, 500, 'GIF', 'P'),
+]
+
+# Below this an engine's thumbnails are no longer visually equivalent to Pillow's
+PARITY_PSNR_DB = 30.0
+
+class CorpusS3:
+    """In-memory stand-in for S3Service serving the synthetic corpus"""
+
+    def __init__(self, corpus: Dict[str, bytes]):
+        self.corpus = corpus
+
+    def get_etag(self, image_url: str):
+        return None
+
+    def get_image_with_etag(self, image_url: str, etag=None, skip=None):
+        return self.corpus[image_url], None
+
+    def get_image(self, image_url: str):
+        return self.corpus[image_url]
+
+def synthetic_image(width: int, height: int, mode: str, rng: random.Random) -> Image.Image:
+    """Gradients plus random shapes: compresses like a photo-ish diagram, not like noise"""
+    img = Image.merge('RGB', [
+        Image.linear_gradient('L').resize((width, height)),
+        Image.radial_gradient('L').resize((width, height)),
+        Image.linear_gradient('L').rotate(90).resize((width, height)),
+    ])
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + rng.randrange(height // 4 + 1)
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)((x0, y0, x1, y1), fill=fill)
+
+    if mode == 'RGBA':
+        img.putalpha(Image.radial_gradient('L').resize((width, height)))
+    elif mode == 'P':
+        img = img.quantize(256)
+    elif mode != 'RGB':
+        img = img.convert(mode)
+    return img
+
+def build_corpus(count: int, seed: int) -> Dict[str, bytes]:
+    rng = random.Random(seed)
+    corpus = {}
+    for index in range(count):
+        width, height, fmt, mode = CORPUS_SPECS[index % len(CORPUS_SPECS)]
+        buffer = io.BytesIO()
+        synthetic_image(width, height, mode, rng).save(buffer, format=fmt)
+        corpus[f"bench/{index:05d}.{fmt.lower()}"] = buffer.getvalue()
+    return corpus
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def latency_summary(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    return {
+        'count': len(latencies),
+        'images_per_sec': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies, default=0.0) * 1000, 3),
+    }
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(who).ru_maxrss * scale / (1024 * 1024), 1)
+
+def bench_process_image(corpus: Dict[str, bytes], rounds: int) -> Dict:
+    processor = ImageProcessor(CorpusS3(corpus))
+    failures = 0
+    latencies = []
+    per_format = {}
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for key in corpus:
+            t0 = time.perf_counter()
+            if processor.process_image(key, key) is None:
+                failures += 1
+            latency = time.perf_counter() - t0
+            latencies.append(latency)
+            per_format.setdefault(key.rsplit('.', 1)[1], []).append(latency)
+    elapsed = time.perf_counter() - started
+
+    result = latency_summary(latencies, elapsed)
+    result.update(
+        failures=failures,
+        peak_rss_mb=peak_rss_mb(),
+        by_format={fmt: latency_summary(values, sum(values)) for fmt, values in per_format.items()},
+    )
+    return result
+
+def bench_engines(corpus: Dict[str, bytes], rounds: int) -> Dict:
+    """Times every installed engine on the corpus and compares its renditions to Pillow's.
+
+    Pillow is the reference, so its own parity is 'reference'; engines that
+    are not installed, or cannot encode the configured formats, are listed
+    as 'skipped' rather than passing without having run.
+    """
+    renditions = parse_renditions(Config.THUMBNAIL_RENDITIONS)
+    reducing_gap = Config.THUMBNAIL_REDUCING_GAP or None
+    reference = {key: create_renditions(data, renditions, reducing_gap) for key, data in corpus.items()}
+
+    results = {}
+    for name in ENGINES:
+        if name not in available_engines():
+            results[name] = {'parity': 'skipped', 'reason': 'not installed'}
+            continue
+        try:
+            check_encoders(name, {r.format for r in renditions})
+        except ValueError as e:
+            results[name] = {'engine': get_engine(name).describe(), 'parity': 'skipped', 'reason': str(e)}
+            continue
+
+        failures = 0
+        latencies = []
+        psnr = []
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for key, data in corpus.items():
+                t0 = time.perf_counter()
+                encoded = create_renditions(data, renditions, reducing_gap, engine=name)
+                latencies.append(time.perf_counter() - t0)
+                if encoded is None or reference[key] is None:
+                    failures += 1
+                    continue
+                psnr += [
+                    thumbnail_psnr(data_uri(r.mime_type, reference[key][r.name]), data_uri(r.mime_type, encoded[r.name]))
+                    for r in renditions
+                ]
+        elapsed = time.perf_counter() - started
+
+        finite = [value for value in psnr if not math.isinf(value)]
+        if name == 'pillow':
+            parity = 'reference'
+        elif failures or not psnr:
+            parity = 'failed'
+        else:
+            parity = 'passed' if not finite or min(finite) >= PARITY_PSNR_DB else 'failed'
+        result = latency_summary(latencies, elapsed)
+        result.update(
+            engine=get_engine(name).describe(),
+            failures=failures,
+            min_psnr_db=round(min(finite), 2) if finite else None,
+            parity=parity,
+        )
+        results[name] = result
+    return results
+
+def seed_catalog(redis_service: RedisService, size: int, keys: List[str]):
+    redis_service.redis.flushdb()
+    exercises = [
+        {'id': str(index), 'name': f"Exercise {index}",
+         'image': {'uri': f"https://{Config.AWS_BUCKET_NAME}.s3.amazonaws.com/{keys[index % len(keys)]}"}}
+        for index in range(size)
+    ]
+    redis_service.redis.set(redis_service.all_key, json.dumps(exercises))
+
+def bench_pipeline(redis_service: RedisService, corpus: Dict[str, bytes], rounds: int) -> Dict:
+    keys = list(corpus)
+    jobs = [(str(index), keys[index % len(keys)]) for index in range(len(keys) * rounds)]
+    seed_catalog(redis_service, len(jobs), keys)
+    redis_service.sync_from_blob()
+
+    pipeline = ImagePipeline(ImageProcessor(CorpusS3(corpus)), redis_service)
+    try:
+        started = time.perf_counter()
+        succeeded = pipeline.run(jobs)
+        elapsed = time.perf_counter() - started
+    finally:
+        pipeline.close()
+
+    return {
+        'jobs': len(jobs),
+        'succeeded': succeeded,
+        'images_per_sec': round(len(jobs) / elapsed, 2),
+        'elapsed_s': round(elapsed, 3),
+        'process_workers': Config.PIPELINE_PROCESS_WORKERS,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_child_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+def timed(fn, *args) -> Tuple[float, object]:
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+def bench_redis(redis_service: RedisService, size: int, updates: int, batch_size: int) -> Dict:
+    keys = ['bench/source.jpg']
+    seed_catalog(redis_service, size, keys)
+    thumbnail = 'data:image/jpeg;base64,' + 'A' * 4000  # ~ a 3 KB JPEG
+
+    sync_s, _ = timed(redis_service.sync_from_blob)
+    read_s, _ = timed(redis_service.get_exercises_without_thumbnails, batch_size)
+
+    updates = min(updates, size)
+    ids = random.Random(size).sample(range(size), updates)
+    batch_latencies = []
+    started = time.perf_counter()
+    for start in range(0, updates, batch_size):
+        batch = [(str(index), thumbnail, None, keys[0]) for index in ids[start:start + batch_size]]
+        elapsed, _ = timed(redis_service.update_exercise_thumbnails, batch)
+        batch_latencies.append(elapsed)
+    update_s = time.perf_counter() - started
+
+    single_latencies = []
+    for index in ids[:min(200, updates)]:
+        elapsed, _ = timed(redis_service.update_exercise_thumbnail, str(index), thumbnail, None, keys[0])
+        single_latencies.append(elapsed)
+
+    status_s, status = timed(redis_service.get_processing_status)
+    drain_read_s, _ = timed(redis_service.get_status_and_pending, batch_size)
+    materialize_s, _ = timed(redis_service.materialize_all_exercises)
+
+    return {
+        'catalog_size': size,
+        'sync_from_blob_s': round(sync_s, 4),
+        'pending_read_ms': round(read_s * 1000, 3),
+        'updates': updates,
+        'batch_size': batch_size,
+        'updates_per_sec': round(updates / update_s, 1) if update_s else 0.0,
+        'batch_p50_ms': round(percentile(batch_latencies, 50) * 1000, 3),
+        'batch_p99_ms': round(percentile(batch_latencies, 99) * 1000, 3),
+        'single_p50_ms': round(percentile(single_latencies, 50) * 1000, 3),
+        'single_p99_ms': round(percentile(single_latencies, 99) * 1000, 3),
+        'status_ms': round(status_s * 1000, 3),
+        'status_and_pending_ms': round(drain_read_s * 1000, 3),
+        'materialize_s': round(materialize_s, 4),
+        'processed': status['processed'],
+    }
+
+def bench_catalog(size: int) -> Dict:
+    # Random bytes, so thumbnails compress about as badly as real JPEGs do
+    rng = random.Random(size)
+    exercises = [
+        {'id': str(index), 'name': f"Exercise {index}", 'difficulty': index % 5,
+         'image': {'uri': f"https://{Config.AWS_BUCKET_NAME}.s3.amazonaws.com/bench/{index}.jpg",
+                   'thumbnail': 'data:image/jpeg;base64,' + base64.b64encode(rng.randbytes(3000)).decode()}}
+        for index in range(size)
+    ]
+    results = {'catalog_size': size}
+    for fmt in CATALOG_FORMATS:
+        try:
+            check_format(fmt)
+        except ValueError as e:
+            results[fmt] = {'skipped': str(e)}
+            continue
+        encode_s, raw = timed(encode_catalog, exercises, fmt)
+        decode_s, _ = timed(decode_catalog, raw)
+        results[fmt] = {
+            'bytes': len(raw),
+            'encode_ms': round(encode_s * 1000, 3),
+            'decode_ms': round(decode_s * 1000, 3),
+        }
+    return results
+
+def redis_client(url: str):
+    import redis
+    if url:
+        return redis.Redis.from_url(url, decode_responses=True), url
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("Install fakeredis or pass --redis-url to benchmark the Redis paths")
+    return fakeredis.FakeRedis(decode_responses=True), 'fakeredis'
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Thumbnail pipeline benchmarks")
+    parser.add_argument('--images', type=int, default=48, help="synthetic corpus size")
+    parser.add_argument('--rounds', type=int, default=2, help="passes over the corpus per image benchmark")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--catalog-sizes', default='1000,10000,100000',
+                        help="comma separated catalog sizes for the Redis benchmark")
+    parser.add_argument('--updates', type=int, default=2000, help="thumbnail updates timed per catalog")
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE)
+    parser.add_argument('--redis-url', default=None, help="local Redis to use instead of fakeredis (flushed!)")
+    parser.add_argument('--skip', default='', help="comma separated: process_image,engines,pipeline,redis,catalog")
+    parser.add_argument('--output', default='-', help="JSON output path, - for stdout")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    skip = set(filter(None, args.skip.split(',')))
+    client, backend = redis_client(args.redis_url)
+    redis_service = RedisService(client=client)
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'redis': backend,
+            'seed': args.seed,
+            'renditions': Config.THUMBNAIL_RENDITIONS,
+            'reducing_gap': Config.THUMBNAIL_REDUCING_GAP,
+            'image_engine': Config.IMAGE_ENGINE,
+            'catalog_format': Config.CATALOG_FORMAT,
+        },
+    }
+
+    corpus = build_corpus(args.images, args.seed)
+    results['corpus'] = {
+        'images': len(corpus),
+        'bytes': sum(len(data) for data in corpus.values()),
+        'specs': [f"{w}x{h} {fmt} {mode}" for w, h, fmt, mode in CORPUS_SPECS],
+    }
+
+    if 'process_image' not in skip:
+        results['process_image'] = bench_process_image(corpus, args.rounds)
+    if 'engines' not in skip:
+        results['engines'] = bench_engines(corpus, args.rounds)
+    if 'pipeline' not in skip:
+        results['pipeline'] = bench_pipeline(redis_service, corpus, args.rounds)
+    if 'redis' not in skip:
+        sizes = [int(size) for size in args.catalog_sizes.split(',') if size]
+        results['redis'] = [bench_redis(redis_service, size, args.updates, args.batch_size) for size in sizes]
+    if 'catalog' not in skip:
+        sizes = [int(size) for size in args.catalog_sizes.split(',') if size]
+        results['catalog'] = [bench_catalog(size) for size in sizes]
+
+    payload = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(payload)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(payload + '\n')
+        print(f"Wrote benchmark results to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
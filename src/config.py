@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 import os
+import tempfile
 
 load_dotenv()
 
@@ -8,6 +9,16 @@ class Config:
     RABBITMQ_HOST = os.getenv('RABBITMQ_HOST')
     RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT'))
     RABBITMQ_QUEUE = os.getenv('RABBITMQ_QUEUE')
+    RABBITMQ_PREFETCH = int(os.getenv('RABBITMQ_PREFETCH', 1))
+    # Messages that fail MAX_ATTEMPTS times end up here
+    RABBITMQ_DEAD_LETTER_QUEUE = os.getenv('RABBITMQ_DEAD_LETTER_QUEUE', f"{RABBITMQ_QUEUE}.dead")
+    # Interactive lane (see ThumbnailScheduler): requested exercises are
+    # served before each bulk batch, PRIORITY_BATCH_SIZE at a time
+    RABBITMQ_INTERACTIVE_QUEUE = os.getenv('RABBITMQ_INTERACTIVE_QUEUE', f"{RABBITMQ_QUEUE}.interactive")
+    PRIORITY_BATCH_SIZE = int(os.getenv('PRIORITY_BATCH_SIZE', 20))
+    # Longest a coalesced process_exercises trigger blocks new ones if its
+    # message is lost; normally the next sync clears it
+    TRIGGER_COALESCE_SECONDS = int(os.getenv('TRIGGER_COALESCE_SECONDS', 300))
     
     # Redis
     REDIS_HOST = os.getenv('REDIS_HOST')
@@ -15,9 +26,131 @@ class Config:
     REDIS_DB = int(os.getenv('REDIS_DB'))
     REDIS_TTL = int(os.getenv('REDIS_TTL'))
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')  # Adaugă parola
+    # One connection pool per process, shared by every service and thread.
+    # 0 sizes it to the pipeline's threads; the blocking pool makes callers
+    # wait up to REDIS_POOL_TIMEOUT seconds for a free connection instead of
+    # failing when it is exhausted
+    REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 0))
+    REDIS_BLOCKING_POOL = os.getenv('REDIS_BLOCKING_POOL', 'true').lower() == 'true'
+    REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 10))
+    # Seconds before a stalled command or connect fails (0 waits forever)
+    REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 10))
+    REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 5))
+    REDIS_SOCKET_KEEPALIVE = os.getenv('REDIS_SOCKET_KEEPALIVE', 'true').lower() == 'true'
+    # Idle connections are PINGed before reuse after this many seconds
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+    # Retries with exponential backoff after a timeout or dropped connection
+    REDIS_RETRY_ON_TIMEOUT = os.getenv('REDIS_RETRY_ON_TIMEOUT', 'true').lower() == 'true'
+    REDIS_RETRIES = int(os.getenv('REDIS_RETRIES', 3))
     
     # AWS
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
     AWS_DEFAULT_REGION = os.getenv('AWS_DEFAULT_REGION')
-    AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
\ No newline at end of file
+    AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME')
+    # Custom endpoint for S3-compatible stand-ins (MinIO, moto server, ...)
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+    # 0 sizes the pool to the threads (or async tasks) sharing the client
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 0))
+    S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', 5))
+    S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', 30))
+    S3_RETRY_MODE = os.getenv('S3_RETRY_MODE', 'adaptive')
+    S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', 5))
+    S3_TCP_KEEPALIVE = os.getenv('S3_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+    # Source limits, enforced before a full download or decode (0 disables)
+    S3_MAX_OBJECT_BYTES = int(os.getenv('S3_MAX_OBJECT_BYTES', 50 * 1024 * 1024))
+    IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 50_000_000))
+    # Ranged read used to check size and header first; small objects are
+    # fetched by it entirely
+    S3_SNIFF_BYTES = int(os.getenv('S3_SNIFF_BYTES', 64 * 1024))
+
+    # Thumbnail cache (keyed by source ETag + thumbnail parameters)
+    THUMBNAIL_CACHE_ENABLED = os.getenv('THUMBNAIL_CACHE_ENABLED', 'true').lower() == 'true'
+    THUMBNAIL_CACHE_TTL = int(os.getenv('THUMBNAIL_CACHE_TTL', 7 * 24 * 3600))
+    THUMBNAIL_CACHE_LRU_BYTES = int(os.getenv('THUMBNAIL_CACHE_LRU_BYTES', 64 * 1024 * 1024))
+    # Local disk cache of downloaded source images (keyed by bucket/key/ETag),
+    # shared by the consumers of a host that point at the same directory
+    SOURCE_CACHE_ENABLED = os.getenv('SOURCE_CACHE_ENABLED', 'true').lower() == 'true'
+    SOURCE_CACHE_DIR = os.getenv('SOURCE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'thumbnail-sources'))
+    SOURCE_CACHE_MAX_BYTES = int(os.getenv('SOURCE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+    # Processing
+    # name:WxH:format[:quality[:progressive]], comma separated; the first one
+    # is the exercise thumbnail, the others go to exercise:image:<id>:<name>
+    THUMBNAIL_RENDITIONS = os.getenv('THUMBNAIL_RENDITIONS', 'thumb:128x128:jpeg:85')
+    # Reduce-on-load headroom over the thumbnail size; 0 decodes at full size
+    THUMBNAIL_REDUCING_GAP = float(os.getenv('THUMBNAIL_REDUCING_GAP', 2.0))
+    # 'pillow' (also covers Pillow-SIMD), 'vips' (needs pyvips and libvips)
+    # or 'auto' for the fastest one installed
+    IMAGE_ENGINE = os.getenv('IMAGE_ENGINE', 'pillow')
+    # Where encoded thumbnails live: 'inline' keeps base64 data URIs in the
+    # exercise record, 'redis' stores raw bytes under thumbnail:blob:* and
+    # 's3' uploads them; the last two leave only a key or URL in the record
+    THUMBNAIL_STORAGE = os.getenv('THUMBNAIL_STORAGE', 'inline')
+    THUMBNAIL_S3_BUCKET = os.getenv('THUMBNAIL_S3_BUCKET', AWS_BUCKET_NAME)
+    THUMBNAIL_S3_PREFIX = os.getenv('THUMBNAIL_S3_PREFIX', 'thumbnails/')
+    # Public base URL for uploaded thumbnails (e.g. a CDN); defaults to the bucket
+    THUMBNAIL_URL_BASE = os.getenv('THUMBNAIL_URL_BASE')
+    # Encoding of exercises:all: 'json', 'msgpack' or 'msgpack+zstd' (the
+    # last two need msgpack, and zstandard; see requirements-optional.txt).
+    # Reads detect the format, so writers can switch once every reader runs
+    # this version
+    CATALOG_FORMAT = os.getenv('CATALOG_FORMAT', 'json')
+    CATALOG_ZSTD_LEVEL = int(os.getenv('CATALOG_ZSTD_LEVEL', 3))
+    CONSUMER_MODE = os.getenv('CONSUMER_MODE', 'sync')
+    # 'drain': one process_exercises message drains everything in one worker
+    # 'fanout': it is split into process_thumbnails work units instead
+    WORK_MODE = os.getenv('WORK_MODE', 'drain')
+    FANOUT_BATCH_SIZE = int(os.getenv('FANOUT_BATCH_SIZE', 5))
+    ASYNC_MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', 64))
+    BATCH_SIZE = int(os.getenv('BATCH_SIZE', 10))
+    PIPELINE_ENABLED = os.getenv('PIPELINE_ENABLED', 'true').lower() == 'true'
+    PIPELINE_FETCH_WORKERS = int(os.getenv('PIPELINE_FETCH_WORKERS', 16))
+    PIPELINE_PROCESS_WORKERS = int(os.getenv('PIPELINE_PROCESS_WORKERS', os.cpu_count() or 1))
+    PIPELINE_WRITE_WORKERS = int(os.getenv('PIPELINE_WRITE_WORKERS', 4))
+    PIPELINE_MAX_IN_FLIGHT = int(os.getenv('PIPELINE_MAX_IN_FLIGHT', 32))
+    # Redis updates committed per round-trip by the pipeline's write stage
+    PIPELINE_WRITE_BATCH = int(os.getenv('PIPELINE_WRITE_BATCH', 100))
+    # Adaptive batching: BATCH_SIZE and the in-flight limit are starting
+    # points that grow while jobs stay healthy and halve on S3 throttling,
+    # Redis reads slower than REDIS_LATENCY_LIMIT seconds, a failure rate
+    # over ADAPTIVE_MAX_ERROR_RATE or job latency over
+    # ADAPTIVE_LATENCY_TOLERANCE times its average. ADAPTIVE_MAX_IN_FLIGHT
+    # of 0 allows four times the starting limit
+    ADAPTIVE_ENABLED = os.getenv('ADAPTIVE_ENABLED', 'true').lower() == 'true'
+    ADAPTIVE_MAX_BATCH_SIZE = int(os.getenv('ADAPTIVE_MAX_BATCH_SIZE', 500))
+    ADAPTIVE_MAX_IN_FLIGHT = int(os.getenv('ADAPTIVE_MAX_IN_FLIGHT', 0))
+    ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv('ADAPTIVE_LATENCY_TOLERANCE', 2.0))
+    ADAPTIVE_MAX_ERROR_RATE = float(os.getenv('ADAPTIVE_MAX_ERROR_RATE', 0.5))
+    ADAPTIVE_MAX_BACKOFF = float(os.getenv('ADAPTIVE_MAX_BACKOFF', 30))
+    REDIS_LATENCY_LIMIT = float(os.getenv('REDIS_LATENCY_LIMIT', 0.25))
+    # Attempts per exercise (and per message) before it is dead-lettered
+    MAX_ATTEMPTS = int(os.getenv('MAX_ATTEMPTS', 5))
+    # Pending exercises a drain batch claims go back to the pending index if
+    # neither committed nor failed within this many seconds (a dead worker)
+    CLAIM_LEASE_SECONDS = int(os.getenv('CLAIM_LEASE_SECONDS', 600))
+    # A run rewrites exercises:all (the WATCH-guarded merge) at least every
+    # MATERIALIZE_INTERVAL_SECONDS and, when set, every
+    # MATERIALIZE_INTERVAL_BATCHES batches or work units, besides once at
+    # the end; 0 turns a limit off
+    MATERIALIZE_INTERVAL_SECONDS = float(os.getenv('MATERIALIZE_INTERVAL_SECONDS', 60))
+    MATERIALIZE_INTERVAL_BATCHES = int(os.getenv('MATERIALIZE_INTERVAL_BATCHES', 0))
+
+    # Logging: LOG_ASYNC writes through a background QueueListener thread,
+    # LOG_FORMAT is 'text' or 'json', and only one in LOG_SAMPLE_RATE
+    # per-image info/debug lines is kept (errors are always logged)
+    LOG_ASYNC = os.getenv('LOG_ASYNC', 'true').lower() == 'true'
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+    LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', 100))
+
+    # Metrics (Prometheus /metrics endpoint; port 0 disables it)
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+    METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+
+    # Supervisor
+    WORKER_COUNT = int(os.getenv('WORKER_COUNT', os.cpu_count() or 1))
+    WORKER_RESTART_BACKOFF = float(os.getenv('WORKER_RESTART_BACKOFF', 1))
+    WORKER_RESTART_MAX_BACKOFF = float(os.getenv('WORKER_RESTART_MAX_BACKOFF', 60))
+    WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', 120))
+    SUPERVISOR_STATS_INTERVAL = float(os.getenv('SUPERVISOR_STATS_INTERVAL', 30))
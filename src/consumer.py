@@ -1,24 +1,55 @@
 import json
+from src.config import Config
 from src.services.image_processor import ImageProcessor
+from src.services.image_pipeline import ImagePipeline
 from src.services.s3_service import S3Service
 from src.services.redis_service import RedisService
+from src.services.thumbnail_cache import ThumbnailCache
+from src.services.thumbnail_store import create_thumbnail_store
 from src.services.rabbitmq_service import RabbitMQService
-from src.utils.logger import setup_logger
+from src.utils.adaptive import AdaptiveController, take_permanent_failures
+from src.utils.jobs import MaterializeSchedule, build_jobs, build_work_units, retry_headers, skipped_ids
+from src.utils.logger import SampledLogger, setup_logger
+from src.utils.metrics import observe_queue_lag, record_outcomes, start_metrics_server
 import pika
 import time
 
 
 class ImageConsumer:
-    def __init__(self):
+    def __init__(self, stats=None):
         self.logger = setup_logger('ImageConsumer')
+        self.sampled_logger = SampledLogger(self.logger)
         self.logger.info("Initializing ImageConsumer...")
-        self.BATCH_SIZE = 10
+        self.config = Config()
+        self.BATCH_SIZE = self.config.BATCH_SIZE
+        # Adjusts the batch size, pipeline concurrency and pause between batches
+        self.controller = AdaptiveController(self.BATCH_SIZE, self.config.PIPELINE_MAX_IN_FLIGHT)
+        # Refreshes exercises:all while a long run is still going
+        self.materialize_schedule = MaterializeSchedule(
+            self.config.MATERIALIZE_INTERVAL_BATCHES, self.config.MATERIALIZE_INTERVAL_SECONDS
+        )
+        self.FANOUT_PUBLISH_CHUNK = 1000
+        self.processing = False
+        # Set when process_exercises arrives during a run, which then syncs again
+        self.rerun_requested = False
+        self.stopping = False
+        # Optional shared counters (see WorkerStats) updated after every job run
+        self.stats = stats
         
         try:
             self.redis_service = RedisService()
             self.s3_service = S3Service()
-            self.image_processor = ImageProcessor(self.s3_service)
+            self.thumbnail_cache = None
+            if self.config.THUMBNAIL_CACHE_ENABLED:
+                self.thumbnail_cache = ThumbnailCache(self.redis_service)
+            self.thumbnail_store = create_thumbnail_store(
+                self.config.THUMBNAIL_STORAGE, self.redis_service, self.s3_service
+            )
+            self.image_processor = ImageProcessor(self.s3_service, self.thumbnail_cache, self.thumbnail_store)
             self.rabbitmq_service = RabbitMQService()
+            self.pipeline = None
+            if self.config.PIPELINE_ENABLED:
+                self.pipeline = ImagePipeline(self.image_processor, self.redis_service)
             
             if not self.redis_service.test_connection():
                 raise Exception("Could not connect to Redis")
@@ -27,140 +58,329 @@ class ImageConsumer:
             self.logger.error(f"Error during initialization: {str(e)}", exc_info=True)
             raise
     def process_all_remaining(self):
-        """Process all remaining exercises"""
+        """Process all remaining exercises.
+
+        Progress is durable: every batch commits its thumbnails and adds to
+        the run checkpoint, so a redelivered trigger after a crash resumes
+        with whatever is still pending.
+        """
         try:
+            self.redis_service.start_run()
             while True:
-                status = self.get_processing_status()
-                if status['remaining'] == 0:
-                    self.logger.info("All exercises have been processed")
+                self.rerun_requested = False
+                # Pick up anything written to exercises:all since the last run
+                self.redis_service.sync_from_blob()
+                self.drain_pending()
+                if self.stopping or not self.rerun_requested:
                     break
+                self.logger.info("process_exercises arrived during the run, syncing again")
 
-                exercises = self.redis_service.get_exercises_without_thumbnails(self.BATCH_SIZE)
-                if not exercises:
-                    self.logger.info("No more exercises to process")
-                    break
+            if not self.stopping:
+                self.redis_service.finish_run()
 
-                self.logger.info(f"Processing next batch of {len(exercises)} exercises")
-                if not self.process_batch(exercises):
-                    self.logger.error("Failed to process batch, will retry")
-                    time.sleep(1)  # Small delay before retry
-                    continue
-
-                # Small delay between batches to prevent overload
-                time.sleep(0.1)
+            # Keep exercises:all current for existing readers
+            self.redis_service.materialize_all_exercises()
 
         except Exception as e:
             self.logger.error(f"Error in process_all_remaining: {str(e)}", exc_info=True)
             raise
 
+    def drain_pending(self):
+        """Processes pending exercises batch by batch until none are left.
+
+        Exercises that keep failing are dead-lettered by process_batch, so
+        this terminates even when some images can never be processed.
+        """
+        self.materialize_schedule.reset()
+        while not self.stopping:
+            self.process_priority()
+            started = time.perf_counter()
+            status, exercises = self.redis_service.get_status_and_pending(self.controller.batch_size)
+            self.controller.observe_redis(time.perf_counter() - started)
+            if status['remaining'] == 0:
+                self.logger.info("All exercises have been processed")
+                break
+            if not exercises:
+                self.logger.info("No more exercises to process")
+                break
+
+            self.logger.info(f"Processing next batch of {len(exercises)} exercises")
+            if not self.process_batch(exercises):
+                self.logger.error("Failed to process batch, will retry")
+            if self.materialize_schedule.due():
+                self.redis_service.materialize_all_exercises()
+
+            # Grows while batches are healthy, backs off under pressure
+            time.sleep(self.controller.delay)
+
+    def process_priority(self, exercise_ids=()):
+        """Renders exercises requested on the interactive lane ahead of the backlog.
+
+        Runs for process_priority messages and before every bulk batch or
+        work unit, so a request waits for at most the batch in progress.
+        Returns how many exercises it took.
+        """
+        if exercise_ids:
+            self.redis_service.prioritize(exercise_ids)
+
+        taken = 0
+        while not self.stopping:
+            exercises, unknown = self.redis_service.take_priority(self.config.PRIORITY_BATCH_SIZE)
+            if unknown:
+                # Most likely created after the last sync
+                self.redis_service.sync_from_blob()
+                exercises += self.redis_service.get_pending_exercises(unknown)
+            if not exercises:
+                break
+
+            self.logger.info(f"Processing {len(exercises)} prioritized exercises")
+            self.process_batch(exercises, checkpoint=False)
+            taken += len(exercises)
+        return taken
+
+    def fan_out(self):
+        """Publishes every pending exercise as process_thumbnails work units"""
+        self.redis_service.sync_from_blob()
+
+        published = 0
+        exercises = []
+        for exercise in self.redis_service.iter_pending_exercises():
+            exercises.append(exercise)
+            if len(exercises) >= self.FANOUT_PUBLISH_CHUNK:
+                published += self.publish_work_units(exercises)
+                exercises = []
+        if exercises:
+            published += self.publish_work_units(exercises)
+
+        self.logger.info(f"Fanned out {published} work units")
+        return published
+
+    def publish_work_units(self, exercises):
+        jobs = build_jobs(exercises, self.logger)
+        record_outcomes(0, 0, skipped=len(exercises) - len(jobs))
+        units = build_work_units(jobs, self.config.FANOUT_BATCH_SIZE)
+        return self.rabbitmq_service.publish_many(self.config.RABBITMQ_QUEUE, units)
+
+    def process_work_unit(self, jobs, headers=None):
+        """Processes one process_thumbnails message; returns True if any job succeeded.
+
+        Jobs that failed but are still pending go back on the queue as a unit
+        of their own, carrying the message's attempt count in ``headers``.
+        """
+        self.process_priority()
+        jobs = [(exercise_id, path_parts) for exercise_id, path_parts in jobs]
+        # Redelivered units skip the jobs that were already committed
+        pending_jobs = self.redis_service.filter_pending_jobs(jobs)
+        if len(pending_jobs) < len(jobs):
+            self.logger.info(f"Skipping {len(jobs) - len(pending_jobs)} already processed exercises")
+
+        success_count, permanent = self.run_jobs(pending_jobs)
+        self.redis_service.record_failures(
+            [exercise_id for exercise_id, _ in pending_jobs if exercise_id not in permanent], permanent
+        )
+        self.logger.info(f"Work unit complete - Processed: {success_count}/{len(pending_jobs)} exercises")
+        if success_count < len(pending_jobs):
+            # Dead-lettered exercises have left the pending set
+            self.retry_work_unit(self.redis_service.filter_pending_jobs(pending_jobs), headers)
+
+        # The last worker to finish refreshes exercises:all for existing
+        # readers, and any worker does on schedule while the backlog lasts
+        if self.materialize_schedule.due() or self.get_processing_status()['remaining'] == 0:
+            self.redis_service.materialize_all_exercises()
+        return success_count > 0
+
+    def retry_work_unit(self, jobs, headers):
+        """Republishes a unit's failed jobs at the back of the work queue.
+
+        Redis dead-letters each exercise after MAX_ATTEMPTS failures, which
+        ends the retries; the attempt header only stops a unit whose
+        failures are not being recorded.
+        """
+        if not jobs:
+            return
+        headers, exhausted = retry_headers(
+            headers, RuntimeError(f"{len(jobs)} jobs failed"), self.config.MAX_ATTEMPTS
+        )
+        if exhausted:
+            self.logger.error(f"Work unit failed {headers['x-attempts']} times, leaving {len(jobs)} jobs pending")
+            return
+        unit = build_work_units(jobs, len(jobs))[0]
+        if not self.rabbitmq_service.republish(self.config.RABBITMQ_QUEUE, json.dumps(unit).encode(), headers):
+            self.logger.error(f"Could not requeue {len(jobs)} failed jobs, leaving them for the next run")
+
     def get_processing_status(self):
         """Get current processing status of all exercises"""
-        try:
-            all_exercises = self.redis_service.get_all_exercises()
-            if not all_exercises:
-                return {'total': 0, 'processed': 0, 'remaining': 0}
-
-            total = len(all_exercises)
-            needs_processing = sum(1 for exercise in all_exercises 
-                                 if 'image' in exercise 
-                                 and exercise.get('image', {}).get('uri')
-                                 and exercise.get('image', {}).get('thumbnail') is None)
-            
-            return {
-                'total': total,
-                'processed': total - needs_processing,
-                'remaining': needs_processing
-            }
-        except Exception as e:
-            self.logger.error(f"Error getting processing status: {str(e)}")
-            return {'total': 0, 'processed': 0, 'remaining': 0}
+        return self.redis_service.get_processing_status()
+
+    def process_jobs_serial(self, jobs):
+        """Processes jobs one at a time on the calling thread, committing them together"""
+        updates = []
+        total_jobs = len(jobs)
+        for i, (exercise_id, path_parts) in enumerate(jobs, 1):
+            try:
+                self.sampled_logger.debug("Processing exercise %d/%d - ID: %s", i, total_jobs, exercise_id)
+
+                if renditions := self.image_processor.process_renditions(exercise_id=exercise_id, image_url=path_parts):
+                    thumbnail_uri, extras = self.image_processor.split(renditions)
+                    updates.append((exercise_id, thumbnail_uri, extras, path_parts))
+                else:
+                    self.logger.error(f"Failed to process image for {exercise_id}")
+
+            except Exception as e:
+                self.logger.error(f"Error processing exercise {exercise_id}: {str(e)}", exc_info=True)
+                continue
 
-    def process_batch(self, exercises):
-        """Process a batch of exercises"""
         success_count = 0
+        for (exercise_id, *_), updated in zip(updates, self.redis_service.update_exercise_thumbnails(updates)):
+            if updated:
+                success_count += 1
+                self.sampled_logger.info("Successfully processed %s (%d/%d)", exercise_id, success_count, total_jobs)
+            else:
+                self.logger.error(f"Failed to update Redis for {exercise_id}")
+        return success_count
+
+    def run_jobs(self, jobs):
+        """Runs jobs through the pipeline, or serially when it is disabled or fails.
+
+        Returns the success count and the ids whose source image is missing,
+        rejected or undecodable; retrying those cannot help, and they do not
+        count as load for the controller.
+        """
+        success_count = None
+        started = time.perf_counter()
+        if self.pipeline:
+            try:
+                self.pipeline.max_in_flight = self.controller.concurrency
+                success_count = self.pipeline.run(jobs)
+            except Exception as e:
+                self.logger.error(f"Pipeline failed, falling back to serial processing: {str(e)}", exc_info=True)
+        if success_count is None:
+            success_count = self.process_jobs_serial(jobs)
+
+        permanent = take_permanent_failures(jobs)
+        if jobs:
+            self.controller.update(len(jobs), len(jobs) - success_count, time.perf_counter() - started,
+                                   permanent=len(permanent))
+        record_outcomes(success_count, len(jobs) - success_count)
+        if self.stats is not None:
+            self.stats.record(success_count, len(jobs) - success_count)
+        return success_count, permanent
+
+    def process_batch(self, exercises, checkpoint=True):
+        """Process a batch of exercises; ``checkpoint`` adds it to the drain run's counters"""
         try:
             total_exercises = len(exercises)
-            for i, exercise in enumerate(exercises, 1):
-                try:
-                    exercise_id = exercise['id']
-                    image_url = exercise.get('image', {}).get('uri')
-                    
-                    if not image_url:
-                        self.logger.warning(f"No image URL for exercise {exercise_id}")
-                        continue
-                    
-                    self.logger.info(f"Processing exercise {i}/{total_exercises} - ID: {exercise_id}")
-                    
-                    if 'proveit-exercises-directories.s3' in image_url:
-                        path_parts = image_url.split('?')[0].split('proveit-exercises-directories.s3.amazonaws.com/')[1]
-                        self.logger.debug(f"Processing path: {path_parts}")
-                        
-                        if thumbnail_uri := self.image_processor.process_image(exercise_id=exercise_id, image_url=path_parts):
-                            if self.redis_service.update_exercise_thumbnail(exercise_id, thumbnail_uri):
-                                success_count += 1
-                                self.logger.info(f"Successfully processed {exercise_id} ({success_count}/{total_exercises})")
-                            else:
-                                self.logger.error(f"Failed to update Redis for {exercise_id}")
-                        else:
-                            self.logger.error(f"Failed to process image for {exercise_id}")
-                    else:
-                        self.logger.warning(f"Skipping {exercise_id} - Invalid S3 URL")
-                            
-                except Exception as e:
-                    self.logger.error(f"Error processing exercise {exercise.get('id', 'unknown')}: {str(e)}", exc_info=True)
-                    continue
+            jobs = build_jobs(exercises, self.logger)
+            record_outcomes(0, 0, skipped=total_exercises - len(jobs))
+            success_count, permanent = self.run_jobs(jobs)
+
+            # Whatever is still pending failed; unusable URLs and broken images fail for good
+            dead = self.redis_service.record_failures(
+                [exercise_id for exercise_id, _ in jobs if exercise_id not in permanent],
+                skipped_ids(exercises, jobs) + permanent
+            )
+            if checkpoint:
+                self.redis_service.checkpoint_run(success_count, total_exercises - success_count, len(dead))
                     
             status = self.get_processing_status()
             self.logger.info(
                 f"Batch complete - Processed: {success_count}/{total_exercises} exercises. "
                 f"Overall progress: {status['processed']}/{status['total']} "
-                f"({status['remaining']} remaining)"
+                f"({status['remaining']} remaining). Limits: {self.controller.describe()}"
             )
             
             return success_count > 0
             
         except Exception as e:
             self.logger.error(f"Batch processing error: {str(e)}", exc_info=True)
+            # Let the next batch, here or in another worker, have them at once
+            self.redis_service.release_claims(exercise.get('id') for exercise in exercises)
             return False
 
     def callback(self, ch, method, properties, body):
         try:
-            if self.processing:
-                # If already processing, just acknowledge and return
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                return
-
+            observe_queue_lag(properties.timestamp)
             data = json.loads(body)
             
             if data.get('action') == 'process_exercises':
+                if self.processing:
+                    # The run in progress syncs again before it returns, which
+                    # covers this trigger
+                    self.rerun_requested = True
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    return
+
                 self.processing = True
                 try:
-                    # Process all remaining exercises
-                    self.process_all_remaining()
+                    if self.config.WORK_MODE == 'fanout':
+                        # Split the work into per-exercise units for all workers
+                        self.fan_out()
+                    else:
+                        # Process all remaining exercises
+                        self.process_all_remaining()
                 finally:
                     self.processing = False
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                if self.stopping:
+                    # Cut short mid-backlog: another worker resumes the checkpoint
+                    ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                    return
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            elif data.get('action') == 'process_thumbnails':
+                # Ack only once the unit's Redis writes are done
+                self.process_work_unit(data.get('jobs', []), properties.headers)
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            elif data.get('action') == 'process_priority':
+                self.process_priority(data.get('ids', []))
+                ch.basic_ack(delivery_tag=method.delivery_tag)
             else:
                 self.logger.warning(f"Unknown action: {data.get('action')}")
                 ch.basic_ack(delivery_tag=method.delivery_tag)
                 
         except Exception as e:
             self.logger.error(f"Callback error: {str(e)}", exc_info=True)
+            self.processing = False
             if not ch.is_closed:
+                self.retry_message(ch, method, properties, body, e)
+
+    def retry_message(self, ch, method, properties, body, error):
+        """Requeues a failed message at the back of its lane with its attempt count.
+
+        After MAX_ATTEMPTS it goes to the dead-letter queue instead, so a
+        poison message cannot be redelivered forever.
+        """
+        headers, exhausted = retry_headers(properties.headers, error, self.config.MAX_ATTEMPTS)
+        # Published to the default exchange, so the routing key is the queue
+        queue_name = method.routing_key or self.config.RABBITMQ_QUEUE
+        if exhausted:
+            queue_name = self.config.RABBITMQ_DEAD_LETTER_QUEUE
+            self.logger.error(f"Message failed {headers['x-attempts']} times, moving it to {queue_name}")
+
+        try:
+            if self.rabbitmq_service.republish(queue_name, body, headers):
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            else:
                 ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-            self.processing = False
-            raise
+        except Exception as e:
+            self.logger.error(f"Could not settle failed message: {str(e)}")
 
 
+    def stop(self):
+        """Stops after the batch in progress; safe to call from a signal handler.
+
+        A process_exercises trigger whose drain this cuts short is requeued
+        rather than acked, so the rest of the backlog is not stranded.
+        """
+        self.stopping = True
+        self.rabbitmq_service.stop_consuming()
+
     def run(self):
         self.logger.info("Starting consumer...")
-        while True:
+        start_metrics_server()
+        while not self.stopping:
             try:
                 self.rabbitmq_service.start_consuming(self.callback)
             except KeyboardInterrupt:
-                self.logger.info("Shutting down...")
-                self.rabbitmq_service.close()
-                break
+                self.stopping = True
             except (pika.exceptions.ConnectionClosedByBroker,
                     pika.exceptions.AMQPChannelError,
                     pika.exceptions.AMQPConnectionError) as e:
@@ -170,4 +390,9 @@ class ImageConsumer:
             except Exception as e:
                 self.logger.error(f"Fatal error: {str(e)}")
                 self.processing = False  # Reset processing flag on error
-                raise
\ No newline at end of file
+                raise
+
+        self.logger.info("Shutting down...")
+        self.rabbitmq_service.close()
+        if self.pipeline:
+            self.pipeline.close()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import aio_pika
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List
+from src.config import Config
+from src.utils.logger import setup_logger
+
+class AsyncRabbitMQService:
+    """aio-pika counterpart of RabbitMQService.
+
+    connect_robust takes care of reconnecting, and since message callbacks run
+    on the event loop a long drain no longer starves heartbeats.
+    """
+
+    def __init__(self):
+        self.logger = setup_logger('AsyncRabbitMQService')
+        self.config = Config()
+        self.connection = None
+        self.channel = None
+
+    async def connect(self):
+        """Opens a robust connection and channel if not already open"""
+        if self.connection is None or self.connection.is_closed:
+            self.logger.info(f"Attempting to connect to RabbitMQ at {self.config.RABBITMQ_HOST}:{self.config.RABBITMQ_PORT}")
+            self.connection = await aio_pika.connect_robust(
+                host=self.config.RABBITMQ_HOST,
+                port=self.config.RABBITMQ_PORT,
+                heartbeat=600
+            )
+
+        if self.channel is None or self.channel.is_closed:
+            self.channel = await self.connection.channel()
+            await self.channel.set_qos(prefetch_count=self.config.RABBITMQ_PREFETCH)
+            self.logger.info("Successfully connected to RabbitMQ")
+
+    async def publish(self, queue_name: str, message: dict, persistent: bool = True) -> bool:
+        """Publishes a message to a queue"""
+        return await self.publish_many(queue_name, [message], persistent) == 1
+
+    async def publish_many(self, queue_name: str, messages: List[dict], persistent: bool = True) -> int:
+        """Publishes messages to a queue, declaring it once; returns how many were sent"""
+        published = 0
+        try:
+            await self.connect()
+            await self.channel.declare_queue(queue_name, durable=True)
+            delivery_mode = aio_pika.DeliveryMode.PERSISTENT if persistent else aio_pika.DeliveryMode.NOT_PERSISTENT
+            for message in messages:
+                await self.channel.default_exchange.publish(
+                    aio_pika.Message(
+                        body=json.dumps(message).encode(),
+                        delivery_mode=delivery_mode,
+                        timestamp=datetime.now(timezone.utc)
+                    ),
+                    routing_key=queue_name
+                )
+                published += 1
+            self.logger.debug(f"Published {published} message(s) to {queue_name}")
+            return published
+        except Exception as e:
+            self.logger.error(f"Failed to publish message: {str(e)}", exc_info=True)
+            return published
+
+    async def republish(self, queue_name: str, body: bytes, headers: dict) -> bool:
+        """Publishes a raw message body with headers, e.g. a retried or dead-lettered message"""
+        try:
+            await self.connect()
+            await self.channel.declare_queue(queue_name, durable=True)
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=body,
+                    headers=headers,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    timestamp=datetime.now(timezone.utc)
+                ),
+                routing_key=queue_name
+            )
+            return True
+        except Exception as e:
+            self.logger.error(f"Failed to republish message to {queue_name}: {str(e)}", exc_info=True)
+            return False
+
+    async def start_consuming(self, callback: Callable[[aio_pika.abc.AbstractIncomingMessage], Awaitable[None]]):
+        """Consumes the bulk and interactive lanes until cancelled"""
+        await self.connect()
+        for queue_name in (self.config.RABBITMQ_QUEUE, self.config.RABBITMQ_INTERACTIVE_QUEUE):
+            queue = await self.channel.declare_queue(queue_name, durable=True)
+            await queue.consume(callback)
+        self.logger.info("Starting to consume messages...")
+        await asyncio.Future()
+
+    async def close(self):
+        """Gracefully close the connection"""
+        if self.connection and not self.connection.is_closed:
+            await self.connection.close()
+        self.channel = None
+        self.connection = None
+        self.logger.info("RabbitMQ service shut down")
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+from typing import Iterable, Optional, List, Dict, Tuple
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import NoScriptError
+from src.config import Config
+from src.utils.metrics import stage_timer
+from src.services.redis_service import (
+    RedisService, STATUS_REPLIES, UPDATE_THUMBNAILS_SCRIPT, PENDING_BATCH_SCRIPT, RECORD_FAILURES_SCRIPT,
+    RELEASE_CLAIMS_SCRIPT, TAKE_PRIORITY_SCRIPT, connection_options, pool_size
+)
+
+logger = logging.getLogger(__name__)
+
+class AsyncRedisService:
+    """redis.asyncio counterpart of RedisService for the async consumer.
+
+    Hot-path calls are native coroutines sharing RedisService's key layout and
+    Lua scripts. The rare bulk operations (sync/materialize of exercises:all)
+    and the drain checkpoint are delegated to a RedisService running in a
+    worker thread.
+    """
+
+    def __init__(self, client: Optional[aioredis.Redis] = None, sync_service: Optional[RedisService] = None):
+        self.config = Config()
+        self.redis = client or aioredis.Redis(connection_pool=self.create_pool())
+        self.sync_service = sync_service or RedisService()
+        self.image_prefix = self.sync_service.image_prefix
+        self.data_prefix = self.sync_service.data_prefix
+        self.index_key = self.sync_service.index_key
+        self.pending_key = self.sync_service.pending_key
+        self.claimed_key = self.sync_service.claimed_key
+        self.dead_key = self.sync_service.dead_key
+        self._update_thumbnails = self.redis.register_script(UPDATE_THUMBNAILS_SCRIPT)
+        self._pending_batch = self.redis.register_script(PENDING_BATCH_SCRIPT)
+        self._record_failures = self.redis.register_script(RECORD_FAILURES_SCRIPT)
+        self._take_priority = self.redis.register_script(TAKE_PRIORITY_SCRIPT)
+        self._release_claims = self.redis.register_script(RELEASE_CLAIMS_SCRIPT)
+
+    def create_pool(self) -> aioredis.ConnectionPool:
+        """Connection pool with the same settings as RedisService's shared one.
+
+        Async pools are bound to the event loop, so this one belongs to the
+        consumer; blocking calls delegated to sync_service use the shared pool.
+        """
+        options = dict(
+            connection_options(),
+            decode_responses=True,
+            retry=Retry(ExponentialBackoff(), self.config.REDIS_RETRIES) if self.config.REDIS_RETRY_ON_TIMEOUT else None,
+        )
+        if self.config.REDIS_BLOCKING_POOL:
+            return aioredis.BlockingConnectionPool(
+                max_connections=pool_size(), timeout=self.config.REDIS_POOL_TIMEOUT, **options
+            )
+        return aioredis.ConnectionPool(max_connections=pool_size(), **options)
+
+    async def test_connection(self) -> bool:
+        try:
+            return await self.redis.ping()
+        except Exception as e:
+            logger.error(f"Redis connection test failed: {e}")
+            return False
+
+    async def get_exercises_without_thumbnails(self, limit: int = 50) -> List[Dict]:
+        """Claims the next exercises needing thumbnail processing (see RedisService)"""
+        try:
+            if limit <= 0:
+                return []
+
+            keys, args = self.sync_service.pending_batch_args(limit)
+            with stage_timer('redis_read'):
+                flat = await self._pending_batch(keys=keys, args=args)
+            return RedisService.parse_pending_batch(flat)
+
+        except Exception as e:
+            logger.error(f"Error getting exercises without thumbnails: {e}")
+            return []
+
+    async def get_processing_status(self) -> Dict[str, int]:
+        """Returns total/processed/remaining/dead counts in a single round-trip"""
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                self.sync_service.queue_status(pipe)
+                return RedisService.parse_status(*await pipe.execute())
+        except Exception as e:
+            logger.error(f"Error getting processing status: {e}")
+            return {'total': 0, 'processed': 0, 'remaining': 0, 'dead': 0}
+
+    async def get_status_and_pending(self, limit: int) -> Tuple[Dict[str, int], List[Dict]]:
+        """Returns the processing status and the next ``limit`` pending exercises in one round-trip"""
+        try:
+            with stage_timer('redis_read'):
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    self.sync_service.queue_status(pipe)
+                    if limit > 0:
+                        self.sync_service.queue_pending_batch(pipe, limit)
+                    replies = await pipe.execute(raise_on_error=False)
+            for reply in replies[:STATUS_REPLIES]:
+                if isinstance(reply, Exception):
+                    raise reply
+
+            status = RedisService.parse_status(*replies[:STATUS_REPLIES])
+            if limit <= 0:
+                return status, []
+            batch = replies[STATUS_REPLIES]
+            if isinstance(batch, NoScriptError):
+                return status, await self.get_exercises_without_thumbnails(limit)
+            if isinstance(batch, Exception):
+                raise batch
+            return status, RedisService.parse_pending_batch(batch)
+        except Exception as e:
+            logger.error(f"Error getting processing status and pending exercises: {e}")
+            return {'total': 0, 'processed': 0, 'remaining': 0, 'dead': 0}, []
+
+    async def record_failures(self, exercise_ids: Iterable, permanent_ids: Iterable = ()) -> List[str]:
+        """Counts a failed attempt for the given pending or claimed exercises; returns the ids dead-lettered"""
+        try:
+            keys, args = self.sync_service.failure_script_args(exercise_ids, permanent_ids)
+            if len(args) == 2:
+                return []
+            return self.sync_service.log_dead_letters(await self._record_failures(keys=keys, args=args))
+        except Exception as e:
+            logger.error(f"Error recording failed exercises: {e}")
+            return []
+
+    async def release_claims(self, exercise_ids: Iterable) -> int:
+        """Returns claimed exercises to the pending index without counting an attempt"""
+        try:
+            exercise_ids = [str(exercise_id) for exercise_id in exercise_ids]
+            if not exercise_ids:
+                return 0
+            return await self._release_claims(
+                keys=[self.pending_key, self.claimed_key, self.index_key], args=exercise_ids
+            )
+        except Exception as e:
+            logger.error(f"Error releasing claimed exercises: {e}")
+            return 0
+
+    async def filter_pending_jobs(self, jobs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Drops (exercise_id, s3_key) jobs whose work is already done"""
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for exercise_id, _ in jobs:
+                    pipe.zscore(self.pending_key, exercise_id)
+                    pipe.hget(self.sync_service._data_key(exercise_id), 'source')
+                return RedisService.select_pending_jobs(jobs, await pipe.execute())
+        except Exception as e:
+            logger.error(f"Error checking pending jobs, processing all of them: {e}")
+            return jobs
+
+    async def update_exercise_thumbnails(self, updates: List[Tuple[str, str, Optional[Dict[str, str]], Optional[str]]]) -> List[bool]:
+        """Commits (exercise_id, thumbnail, renditions, source_key) results in one atomic round-trip"""
+        with stage_timer('redis_write'):
+            return await self._update_exercise_thumbnails(updates)
+
+    async def _update_exercise_thumbnails(self, updates) -> List[bool]:
+        results = []
+        chunk_size = self.sync_service.pipeline_chunk
+        for start in range(0, len(updates), chunk_size):
+            chunk = updates[start:start + chunk_size]
+            try:
+                keys, args = self.sync_service.update_script_args(chunk)
+                flags = await self._update_thumbnails(keys=keys, args=args)
+                results += self.sync_service.log_update_results(chunk, flags)
+            except Exception as e:
+                logger.error(f"Error updating exercise thumbnails: {e}")
+                results += [False] * len(chunk)
+        return results
+
+    async def update_exercise_thumbnail(self, exercise_id: str, thumbnail_uri: str,
+                                        renditions: Optional[Dict[str, str]] = None,
+                                        source: Optional[str] = None) -> bool:
+        """Sets the thumbnail (plus any extra renditions) and clears the pending entry"""
+        return (await self.update_exercise_thumbnails([(exercise_id, thumbnail_uri, renditions, source)]))[0]
+
+    async def take_priority(self, limit: int) -> Tuple[List[Dict], List[str]]:
+        """Claims up to ``limit`` requested exercises (see RedisService.take_priority)"""
+        try:
+            flat = await self._take_priority(
+                keys=[self.sync_service.priority_key, self.pending_key, self.index_key, self.claimed_key],
+                args=[limit, self.data_prefix, self.sync_service.claim_deadline()]
+            )
+            return RedisService.parse_priority_batch(flat)
+        except Exception as e:
+            logger.error(f"Error taking prioritized exercises: {e}")
+            return [], []
+
+    async def get_pending_exercises(self, exercise_ids: List[str]) -> List[Dict]:
+        return await asyncio.to_thread(self.sync_service.get_pending_exercises, exercise_ids)
+
+    async def sync_from_blob(self, force: bool = False) -> int:
+        return await asyncio.to_thread(self.sync_service.sync_from_blob, force)
+
+    async def materialize_all_exercises(self) -> bool:
+        return await asyncio.to_thread(self.sync_service.materialize_all_exercises)
+
+    async def start_run(self) -> Dict[str, str]:
+        return await asyncio.to_thread(self.sync_service.start_run)
+
+    async def checkpoint_run(self, succeeded: int, failed: int, dead_lettered: int) -> bool:
+        return await asyncio.to_thread(self.sync_service.checkpoint_run, succeeded, failed, dead_lettered)
+
+    async def finish_run(self) -> Dict[str, str]:
+        return await asyncio.to_thread(self.sync_service.finish_run)
+
+    async def close(self):
+        await self.redis.aclose()
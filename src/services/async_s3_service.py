@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Tuple, Union
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from src.config import Config
+from src.services.s3_service import client_options, downloaded
+from src.services.source_cache import CachedSource, SourceCache
+from src.utils.adaptive import is_missing_error, report_if_throttled, report_permanent_failure
+from src.utils.images import (
+    ImageRejected, check_object_size, etag_of, is_partial, object_size, read_capped_async,
+    read_up_to_async, sniff_image
+)
+from src.utils.metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+class AsyncS3Service:
+    """aiobotocore counterpart of S3Service; call start() before use"""
+
+    def __init__(self, endpoint_url: Optional[str] = None):
+        self.config = Config()
+        self.endpoint_url = endpoint_url or self.config.S3_ENDPOINT_URL
+        self.session = get_session()
+        self._client_context = None
+        self.s3_client = None
+        self.source_cache = SourceCache() if self.config.SOURCE_CACHE_ENABLED else None
+
+    async def start(self):
+        if self.s3_client is None:
+            self._client_context = self.session.create_client(
+                's3',
+                aws_access_key_id=self.config.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=self.config.AWS_SECRET_ACCESS_KEY,
+                region_name=self.config.AWS_DEFAULT_REGION,
+                endpoint_url=self.endpoint_url,
+                # aiohttp keeps pooled connections alive on its own
+                config=AioConfig(**client_options(self.config.ASYNC_MAX_IN_FLIGHT))
+            )
+            self.s3_client = await self._client_context.__aenter__()
+
+    def _get_key(self, image_url: str) -> str:
+        return image_url.split(f'{self.config.AWS_BUCKET_NAME}.s3.amazonaws.com/')[-1]
+
+    async def get_image(self, image_url: str) -> Optional[bytes]:
+        image_data = (await self.get_image_with_etag(image_url))[0]
+        return image_data.read() if isinstance(image_data, CachedSource) else image_data
+
+    async def get_image_with_etag(self, image_url: str, etag: Optional[str] = None,
+                                  skip: Optional[Callable[[str], Awaitable[bool]]] = None
+                                  ) -> Tuple[Optional[Union[bytes, CachedSource]], Optional[str]]:
+        """Returns an object's body together with its ETag, through the source cache.
+
+        As S3Service.get_image_with_etag, with an async ``skip``.
+        """
+        try:
+            bucket = self.config.AWS_BUCKET_NAME
+            key = self._get_key(image_url)
+            sniffing = self.config.S3_SNIFF_BYTES > 0
+            head, complete = None, False
+            if etag is None:
+                if sniffing:
+                    head, etag, complete = await self._sniff(bucket, key)
+                elif skip or (self.source_cache and self.source_cache.contains(bucket, key)):
+                    etag = await self.get_etag(image_url)
+            if etag and skip and await skip(etag):
+                return None, etag
+            if self.source_cache and (cached := self.source_cache.get(bucket, key, etag)):
+                return cached, etag
+
+            if sniffing and head is None:
+                # The ETag was known up front but is not cached
+                head, etag, complete = await self._sniff(bucket, key)
+            if complete:
+                data = head
+            elif head is not None:
+                data = await self._download_rest(bucket, key, head, etag)
+            else:
+                data, etag = await self._download(bucket, key)
+            if self.source_cache and etag:
+                cached = await asyncio.to_thread(self.source_cache.put, bucket, key, etag, data)
+                return cached or data, etag
+            return data, etag
+        except ImageRejected as e:
+            logger.warning(f"Rejected {image_url}: {e}")
+            report_permanent_failure(image_url, str(e))
+            return None, None
+        except Exception as e:
+            if is_missing_error(e):
+                report_permanent_failure(image_url, 'not found')
+            else:
+                report_if_throttled(e, 's3')
+            logger.error(f"S3 error: {e}")
+            return None, None
+
+    async def _sniff(self, bucket: str, key: str) -> Tuple[bytes, Optional[str], bool]:
+        """Ranged read of the first S3_SNIFF_BYTES (see S3Service._sniff)"""
+        sniff_bytes = self.config.S3_SNIFF_BYTES
+        with stage_timer('s3_get'):
+            response = await self.s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{sniff_bytes - 1}")
+            etag = etag_of(response)
+            async with response['Body'] as stream:
+                if not is_partial(response):
+                    # Range was ignored: this is the whole object
+                    check_object_size(response.get('ContentLength', 0))
+                    head = await read_up_to_async(stream, sniff_bytes)
+                    sniff_image(head)
+                    return downloaded(await read_capped_async(stream, head)), etag, True
+                head = await read_up_to_async(stream, sniff_bytes + 1)
+        size = object_size(response, len(head))
+        check_object_size(size)
+        sniff_image(head)
+        if len(head) >= size:
+            return downloaded(head), etag, True
+        return head, etag, False
+
+    async def _download_rest(self, bucket: str, key: str, head: bytes, etag: Optional[str]) -> bytes:
+        """Fetches what follows a sniffed head, pinned to the sniffed version with If-Match"""
+        options = {'IfMatch': f'"{etag}"'} if etag else {}
+        with stage_timer('s3_get'):
+            response = await self.s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(head)}-", **options)
+            async with response['Body'] as stream:
+                check_object_size(len(head) + response.get('ContentLength', 0))
+                data = await read_capped_async(stream, head)
+        return downloaded(data)
+
+    async def _download(self, bucket: str, key: str) -> Tuple[bytes, Optional[str]]:
+        """Downloads a whole object and its ETag in one bounded read, for S3_SNIFF_BYTES=0"""
+        with stage_timer('s3_get'):
+            response = await self.s3_client.get_object(Bucket=bucket, Key=key)
+            async with response['Body'] as stream:
+                check_object_size(response.get('ContentLength', 0))
+                data = await read_capped_async(stream)
+        return downloaded(data), etag_of(response)
+
+    async def get_etag(self, image_url: str) -> Optional[str]:
+        """Returns an object's ETag with a HEAD request, without downloading it"""
+        try:
+            bucket = self.config.AWS_BUCKET_NAME
+            with stage_timer('s3_head'):
+                response = await self.s3_client.head_object(Bucket=bucket, Key=self._get_key(image_url))
+            return response.get('ETag', '').strip('"') or None
+        except Exception as e:
+            report_if_throttled(e, 's3')
+            logger.error(f"S3 head error: {e}")
+            return None
+
+    async def close(self):
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+        self._client_context = None
+        self.s3_client = None
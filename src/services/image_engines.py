@@ -0,0 +1,178 @@
+import io
+import logging
+import multiprocessing
+import time
+from typing import BinaryIO, Dict, Iterable, List, Optional, Union
+import PIL
+from PIL import Image
+from src.utils.images import check_pixels
+
+try:
+    import pyvips
+except (ImportError, OSError):  # the binding or libvips itself is missing
+    pyvips = None
+
+logger = logging.getLogger(__name__)
+
+class PillowEngine:
+    """Decode, resize and encode with Pillow (or Pillow-SIMD, which installs as PIL).
+
+    Renditions are produced largest first, each one downscaled from the
+    previous result, so an extra size only costs its own resize and encode.
+    ``reducing_gap`` controls reduce-on-load for the first (largest) step:
+    JPEGs are drafted so libjpeg decodes straight at 1/2, 1/4 or 1/8 scale
+    (DCT scaling), other formats are box-reduced by an integer factor, and at
+    least ``reducing_gap`` times the target size is kept for the final
+    LANCZOS pass. RGBA and LA are resized (premultiplied) before their alpha
+    is dropped, so only the largest rendition is converted, never the
+    source.
+    ``None`` decodes and resamples at full size.
+    """
+
+    name = 'pillow'
+    fork_safe = True
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    @staticmethod
+    def describe() -> str:
+        # Pillow-SIMD releases carry a .postN suffix
+        flavour = 'Pillow-SIMD' if '.post' in PIL.__version__ else 'Pillow'
+        return f"{flavour} {PIL.__version__}"
+
+    @staticmethod
+    def encodes(fmt: str) -> bool:
+        # Encoder plugins register themselves only when Pillow was built with their library
+        Image.init()
+        return fmt.upper() in Image.SAVE
+
+    def render(self, image_data: Union[bytes, BinaryIO], renditions: List, reducing_gap: Optional[float],
+               timings: Dict[str, float]) -> Dict[str, bytes]:
+        results = {}
+        # BytesIO shares the bytes object's buffer, so this does not copy it
+        source = io.BytesIO(image_data) if isinstance(image_data, bytes) else image_data
+        with Image.open(source) as img:
+            # Only the header has been read so far; refuse bombs before decoding
+            check_pixels(img.size)
+            if img.mode == 'P':
+                # Pillow resamples palette images with NEAREST only
+                img = img.convert('RGB')
+
+            current = img
+            for index, rendition in enumerate(renditions):
+                started = time.perf_counter()
+                if index > 0:
+                    current = current.copy()
+                current.thumbnail(rendition.size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+                if current.mode in ('RGBA', 'LA'):
+                    # Drop alpha like VipsEngine; JPEG cannot store it
+                    current = current.convert(current.mode[:-1])
+                resized = time.perf_counter()
+                results[rendition.name] = rendition.encode(current)
+                timings['decode_resize'] += resized - started
+                timings['encode'] += time.perf_counter() - resized
+        return results
+
+class VipsEngine:
+    """Decode, resize and encode with libvips through pyvips.
+
+    ``thumbnail_buffer`` shrinks on load (JPEG DCT scaling, WebP and PDF
+    scale-on-load, ...) and streams the decode, so memory stays near the
+    output size whatever the source resolution. The largest rendition is
+    kept in memory and the smaller ones are resized from it, as in
+    PillowEngine. Alpha is dropped like Pillow's RGB conversion does.
+    ``reducing_gap`` does not apply: vips picks the shrink itself.
+    """
+
+    name = 'vips'
+    # libvips' worker threads do not survive fork(): a forked pool worker
+    # hangs once the parent has rendered anything
+    fork_safe = False
+    SAVE_OPTIONS = {
+        'jpeg': ('.jpg', lambda r: {'Q': r.quality, 'optimize_coding': True, 'interlace': r.progressive}),
+        'webp': ('.webp', lambda r: {'Q': r.quality}),
+        'avif': ('.avif', lambda r: {'Q': r.quality}),
+    }
+
+    @staticmethod
+    def available() -> bool:
+        return pyvips is not None
+
+    @staticmethod
+    def describe() -> str:
+        return f"libvips {pyvips.version(0)}.{pyvips.version(1)}.{pyvips.version(2)}"
+
+    @classmethod
+    def encodes(cls, fmt: str) -> bool:
+        # Savers depend on how libvips was built (AVIF needs libheif with an AV1 encoder)
+        return fmt in cls.SAVE_OPTIONS and cls.SAVE_OPTIONS[fmt][0] in pyvips.get_suffixes()
+
+    def render(self, image_data: Union[bytes, BinaryIO], renditions: List, reducing_gap: Optional[float],
+               timings: Dict[str, float]) -> Dict[str, bytes]:
+        if not isinstance(image_data, bytes):
+            image_data = image_data.read()
+
+        # Header only, to refuse bombs before decoding
+        header = pyvips.Image.new_from_buffer(image_data, '', access='sequential')
+        check_pixels((header.width, header.height))
+
+        results = {}
+        current = None
+        for rendition in renditions:
+            started = time.perf_counter()
+            width, height = rendition.size
+            if current is None:
+                current = pyvips.Image.thumbnail_buffer(image_data, width, height=height, size='down')
+                if current.hasalpha():
+                    current = current.extract_band(0, n=current.bands - 1)
+                # Decode once for every rendition
+                current = current.copy_memory()
+            else:
+                current = current.thumbnail_image(width, height=height, size='down')
+            resized = time.perf_counter()
+            suffix, options = self.SAVE_OPTIONS[rendition.format]
+            results[rendition.name] = current.write_to_buffer(suffix, strip=True, **options(rendition))
+            timings['decode_resize'] += resized - started
+            timings['encode'] += time.perf_counter() - resized
+        return results
+
+ENGINES = {engine.name: engine for engine in (PillowEngine, VipsEngine)}
+
+# One instance per process, created on first use (also inside pool workers)
+_instances = {}
+
+def available_engines() -> List[str]:
+    return [name for name, engine in ENGINES.items() if engine.available()]
+
+def resolve_engine(requested: str) -> str:
+    """Maps IMAGE_ENGINE to an installed engine.
+
+    'auto' prefers vips when it is installed; an engine that is missing
+    falls back to Pillow with a warning rather than failing every image.
+    """
+    available = available_engines()
+    if requested == 'auto':
+        return 'vips' if 'vips' in available else 'pillow'
+    if requested not in ENGINES:
+        raise ValueError(f"Unknown image engine: {requested}")
+    if requested not in available:
+        logger.warning(f"Image engine {requested} is not installed, using pillow")
+        return 'pillow'
+    return requested
+
+def check_encoders(name: str, formats: Iterable[str]):
+    """Raises ValueError when the engine cannot encode one of the formats"""
+    for fmt in formats:
+        if not ENGINES[name].encodes(fmt):
+            raise ValueError(f"Image engine {name} cannot encode {fmt} renditions")
+
+def process_context(name: str):
+    """multiprocessing context for render pools; None keeps the platform default"""
+    return None if ENGINES[name].fork_safe else multiprocessing.get_context('spawn')
+
+def get_engine(name: str):
+    if name not in _instances:
+        _instances[name] = ENGINES[name]()
+    return _instances[name]
@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from src.config import Config
+from src.services.image_engines import process_context
+from src.services.image_processor import ImageProcessor, render_with_timings
+from src.services.redis_service import RedisService
+from src.services.source_cache import SourceEvicted
+from src.utils.adaptive import report_permanent_failure
+from src.utils.logger import SampledLogger
+from src.utils.metrics import IN_FLIGHT, observe_timings
+
+logger = logging.getLogger(__name__)
+sampled_logger = SampledLogger(logger)
+
+class ImagePipeline:
+    """Runs fetch -> render -> write as three overlapping stages.
+
+    S3 fetches and writes (thumbnail storage plus the Redis update) run on
+    bounded thread pools, rendition encoding runs on a process pool. At most
+    ``max_in_flight`` exercises are between the first and last stage at any
+    time; ``run`` blocks on new submissions until a slot frees up.
+
+    Redis updates are buffered and committed together: a batch is flushed
+    once it holds ``write_batch_size`` results or every in-flight job is
+    waiting in it, so a run of up to ``max_in_flight`` jobs costs a single
+    round-trip.
+    """
+
+    def __init__(self, image_processor: ImageProcessor, redis_service: RedisService):
+        self.config = Config()
+        self.image_processor = image_processor
+        self.redis_service = redis_service
+        self.max_in_flight = max(1, self.config.PIPELINE_MAX_IN_FLIGHT)
+        self.write_batch_size = max(1, self.config.PIPELINE_WRITE_BATCH)
+
+        self.fetch_executor = ThreadPoolExecutor(
+            max_workers=max(1, self.config.PIPELINE_FETCH_WORKERS),
+            thread_name_prefix='s3-fetch'
+        )
+        self.write_executor = ThreadPoolExecutor(
+            max_workers=max(1, self.config.PIPELINE_WRITE_WORKERS),
+            thread_name_prefix='redis-write'
+        )
+        self.process_executor = None
+        self._process_lock = threading.Lock()
+        self._batch = []
+        self._in_flight = 0
+        self._batch_lock = threading.Lock()
+
+    def _get_process_executor(self) -> ProcessPoolExecutor:
+        with self._process_lock:
+            if self.process_executor is None:
+                self.process_executor = ProcessPoolExecutor(
+                    max_workers=max(1, self.config.PIPELINE_PROCESS_WORKERS),
+                    mp_context=process_context(self.image_processor.engine)
+                )
+            return self.process_executor
+
+    def _reset_process_executor(self, wait: bool = False):
+        with self._process_lock:
+            if self.process_executor is not None:
+                self.process_executor.shutdown(wait=wait, cancel_futures=True)
+                self.process_executor = None
+
+    def run(self, jobs: Iterable[Tuple[str, str]], on_done: Optional[Callable[[str, bool], None]] = None) -> int:
+        """Processes (exercise_id, s3_key) pairs and returns the success count.
+
+        ``jobs`` is consumed lazily, so it can be a generator. ``on_done`` is
+        called with the exercise id and whether it succeeded as each job
+        finishes, from whichever thread finished it.
+        """
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+
+        for exercise_id, key in jobs:
+            slots.acquire()
+            job = Future()
+            job.add_done_callback(lambda _: slots.release())
+            with self._batch_lock:
+                self._in_flight += 1
+            IN_FLIGHT.inc()
+            job.add_done_callback(partial(self._on_job_done, time.perf_counter()))
+            if on_done is not None:
+                job.add_done_callback(partial(self._notify, on_done, exercise_id))
+            futures.append(job)
+            self._submit(job, exercise_id, key)
+
+        success_count = 0
+        for job in futures:
+            try:
+                if job.result():
+                    success_count += 1
+            except BrokenProcessPool as e:
+                logger.error(f"Process pool broke, recreating it: {e}")
+                self._reset_process_executor()
+            except Exception as e:
+                logger.error(f"Pipeline job failed: {e}", exc_info=True)
+
+        return success_count
+
+    def _submit(self, job: Future, exercise_id: str, key: str, refetched: bool = False):
+        try:
+            fetch = self.fetch_executor.submit(self.image_processor.fetch, key)
+            fetch.add_done_callback(partial(self._on_fetched, job, exercise_id, key, refetched))
+        except Exception as e:
+            job.set_exception(e)
+
+    def _on_fetched(self, job: Future, exercise_id: str, key: str, refetched: bool, fetch: Future):
+        try:
+            cached, image_data, fingerprint = fetch.result()
+            if cached:
+                # Cache hit: skip the encode stage entirely
+                self._submit_write(job, exercise_id, key, fingerprint, renditions=cached)
+                return
+
+            if not image_data:
+                logger.error(f"Failed to process image for {exercise_id}")
+                job.set_result(False)
+                return
+
+            encode = self._get_process_executor().submit(
+                render_with_timings, image_data, self.image_processor.renditions,
+                self.image_processor.reducing_gap, self.image_processor.engine
+            )
+            encode.add_done_callback(partial(self._on_encoded, job, exercise_id, key, fingerprint, refetched))
+        except Exception as e:
+            job.set_exception(e)
+
+    def _on_encoded(self, job: Future, exercise_id: str, key: str, fingerprint, refetched: bool, encode: Future):
+        try:
+            try:
+                encoded, timings = encode.result()
+            except SourceEvicted as e:
+                if refetched:
+                    raise
+                # Trimmed by another consumer between fetch and render
+                logger.warning(f"{e}, fetching it again")
+                self._submit(job, exercise_id, key, refetched=True)
+                return
+            self.image_processor.record_render(encoded, timings)
+            if not encoded:
+                logger.error(f"Failed to process image for {exercise_id}")
+                report_permanent_failure(key, 'undecodable')
+                job.set_result(False)
+                return
+
+            self._submit_write(job, exercise_id, key, fingerprint, encoded=encoded)
+        except Exception as e:
+            job.set_exception(e)
+
+    def _submit_write(self, job: Future, exercise_id: str, key: str, fingerprint, **renditions):
+        write = self.write_executor.submit(self._write, exercise_id, fingerprint, **renditions)
+        write.add_done_callback(partial(self._on_written, job, exercise_id, key))
+
+    def _write(self, exercise_id: str, fingerprint, renditions: Optional[Dict[str, str]] = None,
+               encoded: Optional[Dict[str, bytes]] = None) -> Optional[Tuple[str, Dict[str, str]]]:
+        """Publishes freshly encoded bytes; cache hits are already references"""
+        if encoded is not None:
+            renditions = self.image_processor.publish(exercise_id, fingerprint, encoded)
+            if not renditions:
+                return None
+        return self.image_processor.split(renditions)
+
+    def _on_written(self, job: Future, exercise_id: str, key: str, write: Future):
+        try:
+            published = write.result()
+            if not published:
+                logger.error(f"Failed to store thumbnails for {exercise_id}")
+                job.set_result(False)
+                return
+
+            thumbnail_uri, extras = published
+            with self._batch_lock:
+                self._batch.append((job, (exercise_id, thumbnail_uri, extras, key)))
+                batch = self._take_batch()
+            self._submit_commit(batch)
+        except Exception as e:
+            job.set_exception(e)
+
+    def _on_job_done(self, started: float, job: Future):
+        IN_FLIGHT.dec()
+        observe_timings({'job': time.perf_counter() - started})
+        # A finished job may leave only buffered ones in flight
+        with self._batch_lock:
+            self._in_flight -= 1
+            batch = self._take_batch()
+        self._submit_commit(batch)
+
+    @staticmethod
+    def _notify(on_done: Callable[[str, bool], None], exercise_id: str, job: Future):
+        try:
+            on_done(exercise_id, job.exception() is None and bool(job.result()))
+        except Exception as e:
+            logger.error(f"Job callback failed for {exercise_id}: {e}")
+
+    def _take_batch(self):
+        """Pops the buffered updates when they should be committed; call with _batch_lock held"""
+        if self._batch and (len(self._batch) >= self.write_batch_size
+                            or len(self._batch) >= self._in_flight):
+            batch, self._batch = self._batch, []
+            return batch
+        return None
+
+    def _submit_commit(self, batch):
+        if batch:
+            self.write_executor.submit(self._commit, batch)
+
+    def _commit(self, batch):
+        try:
+            results = self.redis_service.update_exercise_thumbnails([update for _, update in batch])
+        except Exception as e:
+            for job, _ in batch:
+                job.set_exception(e)
+            return
+
+        for (job, (exercise_id, *_)), updated in zip(batch, results):
+            if updated:
+                sampled_logger.info("Successfully processed %s", exercise_id)
+            else:
+                logger.error(f"Failed to update Redis for {exercise_id}")
+            job.set_result(updated)
+
+    def close(self):
+        """Shuts down all stage executors"""
+        self.fetch_executor.shutdown(wait=True)
+        self.write_executor.shutdown(wait=True)
+        self._reset_process_executor(wait=True)
@@ -1,36 +1,301 @@
-from PIL import Image
+from PIL import Image, ImageChops
 import io
+import math
 import base64
 import logging
-from typing import Optional
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+from src.config import Config
+from src.services.image_engines import check_encoders, get_engine, resolve_engine
 from src.services.s3_service import S3Service
+from src.services.source_cache import CachedSource, SourceEvicted
+from src.services.thumbnail_cache import ThumbnailCache
+from src.utils.adaptive import report_permanent_failure
+from src.utils.metrics import BYTES, CACHE_REQUESTS, observe_timings, stage_timer
 
 logger = logging.getLogger(__name__)
 
+class Rendition:
+    """One output variant: a bounding box, an encoder and its settings"""
+
+    FORMATS = {
+        'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+        'webp': ('WEBP', 'image/webp', 'webp'),
+        'avif': ('AVIF', 'image/avif', 'avif'),
+    }
+
+    def __init__(self, name: str, size: Tuple[int, int], fmt: str = 'jpeg',
+                 quality: int = 85, progressive: bool = False):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unsupported rendition format: {fmt}")
+        self.name = name
+        self.size = size
+        self.format = fmt
+        self.quality = quality
+        self.progressive = progressive
+
+    @property
+    def signature(self) -> str:
+        return f"{self.name}={self.size[0]}x{self.size[1]}/{self.format}/q{self.quality}/p{int(self.progressive)}"
+
+    @property
+    def mime_type(self) -> str:
+        return self.FORMATS[self.format][1]
+
+    @property
+    def extension(self) -> str:
+        return self.FORMATS[self.format][2]
+
+    def encode(self, img: Image.Image) -> bytes:
+        pil_format = self.FORMATS[self.format][0]
+        if pil_format != 'JPEG' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGB')
+
+        options = {'quality': self.quality}
+        if pil_format == 'JPEG':
+            options.update(optimize=True, progressive=self.progressive)
+
+        buffer = io.BytesIO()
+        img.save(buffer, format=pil_format, **options)
+        return buffer.getvalue()
+
+def data_uri(mime_type: str, data: bytes) -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def parse_renditions(spec: str, engine: Optional[str] = None) -> List[Rendition]:
+    """Parses ``name:WxH:format[:quality[:progressive]]`` entries separated by commas.
+
+    With ``engine``, formats it cannot encode raise ValueError here rather
+    than failing every image later.
+    """
+    renditions = []
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        parts = entry.split(':')
+        if len(parts) < 3:
+            raise ValueError(f"Invalid rendition spec: {entry}")
+        width, height = (int(value) for value in parts[1].lower().split('x'))
+        renditions.append(Rendition(
+            name=parts[0],
+            size=(width, height),
+            fmt=parts[2].lower(),
+            quality=int(parts[3]) if len(parts) > 3 and parts[3] else 85,
+            progressive=len(parts) > 4 and parts[4].lower() in ('progressive', 'true', '1')
+        ))
+
+    if not renditions:
+        raise ValueError("At least one rendition is required")
+    if engine is not None:
+        check_encoders(engine, {rendition.format for rendition in renditions})
+    return renditions
+
+DEFAULT_RENDITION = Rendition('thumb', (128, 128))
+
+def create_renditions(image_data: Union[bytes, BinaryIO, CachedSource], renditions: List[Rendition],
+                      reducing_gap: Optional[float] = 2.0,
+                      timings: Optional[Dict[str, float]] = None,
+                      engine: str = 'pillow') -> Optional[Dict[str, bytes]]:
+    """Decodes an image once and returns every rendition's encoded bytes.
+
+    Kept at module level so it can be shipped to a process pool, with the
+    engine (see image_engines) passed by name. Accepts the encoded bytes, a
+    seekable file-like object or a CachedSource, which is memory-mapped. ``reducing_gap`` is Pillow's reduce-on-load
+    headroom; ``None`` decodes and resamples at full size.
+
+    When ``timings`` is given, seconds spent in ``decode_resize`` (decoders
+    fuse scaled decoding with the reduce, so they are timed together) and
+    ``encode`` are added to it. None means the source itself cannot be
+    rendered; failures that are not the image's fault raise instead.
+    """
+    try:
+        ordered = sorted(renditions, key=lambda r: r.size[0] * r.size[1], reverse=True)
+        spent = {'decode_resize': 0.0, 'encode': 0.0}
+        if isinstance(image_data, CachedSource):
+            with image_data.open() as mapped:
+                results = get_engine(engine).render(mapped, ordered, reducing_gap, spent)
+        else:
+            results = get_engine(engine).render(image_data, ordered, reducing_gap, spent)
+
+        if timings is not None:
+            for stage, seconds in spent.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+        return results
+
+    except (MemoryError, SourceEvicted):
+        raise
+    except Exception as e:
+        logger.error(f"Image processing error: {e}")
+        return None
+
+def render_with_timings(image_data: Union[bytes, BinaryIO, CachedSource], renditions: List[Rendition],
+                        reducing_gap: Optional[float] = 2.0,
+                        engine: str = 'pillow') -> Tuple[Optional[Dict[str, bytes]], Dict[str, float]]:
+    """create_renditions for process pools: returns the stage timings alongside"""
+    timings = {}
+    return create_renditions(image_data, renditions, reducing_gap, timings, engine), timings
+
+def create_thumbnail(image_data: bytes, size: Tuple[int, int] = (128, 128),
+                     reducing_gap: Optional[float] = 2.0) -> Optional[str]:
+    """Decodes, resizes and encodes an image as a single JPEG data URI"""
+    rendition = Rendition(DEFAULT_RENDITION.name, size)
+    renditions = create_renditions(image_data, [rendition], reducing_gap)
+    return data_uri(rendition.mime_type, renditions[rendition.name]) if renditions else None
+
+def thumbnail_psnr(reference_uri: str, candidate_uri: str) -> float:
+    """PSNR in dB between two thumbnail data URIs; inf when identical.
+
+    Used to check that a faster decode path or another image engine stays
+    visually equivalent to the reference (above ~35 dB is indistinguishable
+    at thumbnail size). Engines may round the scaled size differently, so a
+    candidate off by one pixel is resized to the reference before comparing.
+    """
+    def decode(uri):
+        return Image.open(io.BytesIO(base64.b64decode(uri.split(',', 1)[1]))).convert('RGB')
+
+    with decode(reference_uri) as reference, decode(candidate_uri) as candidate:
+        if reference.size != candidate.size:
+            if max(abs(a - b) for a, b in zip(reference.size, candidate.size)) > 1:
+                return 0.0
+            candidate = candidate.resize(reference.size, Image.Resampling.LANCZOS)
+        histogram = ImageChops.difference(reference, candidate).histogram()
+
+    pixels = reference.size[0] * reference.size[1] * 3
+    squared = sum(count * (value % 256) ** 2 for value, count in enumerate(histogram))
+    if squared == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / (squared / pixels))
+
+def rendition_signature(renditions: List[Rendition]) -> str:
+    return ';'.join(rendition.signature for rendition in renditions)
+
 class ImageProcessor:
-    def __init__(self, s3_service: S3Service):
+    def __init__(self, s3_service: Optional[S3Service], cache: Optional[ThumbnailCache] = None, store=None):
         self.s3_service = s3_service
-        self.thumbnail_size = (128, 128)
-        
-    def process_image(self, exercise_id: str, image_url: str) -> Optional[str]:
+        self.cache = cache
+        # Where encoded bytes go (see thumbnail_store); None keeps data URIs inline
+        self.store = store
+        self.engine = resolve_engine(Config.IMAGE_ENGINE)
+        logger.info(f"Image engine: {self.engine} ({get_engine(self.engine).describe()})")
+        # The first rendition is the exercise thumbnail, the rest are extras
+        self.renditions = parse_renditions(Config.THUMBNAIL_RENDITIONS, self.engine)
+        self.primary = self.renditions[0].name
+        self.thumbnail_size = self.renditions[0].size
+        self.reducing_gap = Config.THUMBNAIL_REDUCING_GAP or None
+        self.signature = rendition_signature(self.renditions)
+        if self.engine != 'pillow':
+            # Engines differ slightly in output; Pillow keeps the existing keys
+            self.signature += f";engine={self.engine}"
+        if store:
+            # Cached references are only valid for the store that wrote them
+            self.signature += f";{store.location}"
+
+    def fingerprint(self, etag: str) -> str:
+        return self.cache.fingerprint(etag, self.signature, self.reducing_gap)
+
+    def fetch(self, image_url: str) -> Tuple[Optional[Dict[str, str]], Optional[Union[bytes, CachedSource]], Optional[str]]:
+        """Resolves a source image through the cache.
+
+        Returns ``(renditions, None, fingerprint)`` on a cache hit, checked
+        with the ETag of the ranged sniff GET so a hit costs that one small
+        request, or ``(None, image_data, fingerprint)`` after a download,
+        where image_data is a CachedSource when the source cache has it. The
+        fingerprint is None when caching is off.
+        """
+        renditions = None
+
+        def cached(etag: str) -> bool:
+            nonlocal renditions
+            renditions = self.lookup(self.fingerprint(etag))
+            return bool(renditions)
+
+        image_data, etag = self.s3_service.get_image_with_etag(image_url, skip=cached if self.cache else None)
+        if self.cache and etag:
+            CACHE_REQUESTS.labels('hit' if renditions else 'miss').inc()
+            if renditions:
+                logger.debug("Thumbnail cache hit for %s", image_url)
+                return renditions, None, self.fingerprint(etag)
+        fingerprint = self.fingerprint(etag) if self.cache and etag else None
+        return None, image_data, fingerprint
+
+    def lookup(self, fingerprint: str) -> Optional[Dict[str, str]]:
+        """Cached renditions for a fingerprint, unless their stored objects
+        were released or expired since"""
+        renditions = self.cache.get(fingerprint)
+        if renditions and self.store and not self.store.alive(renditions[self.primary]):
+            return None
+        return renditions
+
+    def render(self, image_data: Union[bytes, CachedSource]) -> Optional[Dict[str, bytes]]:
+        with stage_timer('render'):
+            encoded, timings = render_with_timings(image_data, self.renditions, self.reducing_gap, self.engine)
+        self.record_render(encoded, timings)
+        return encoded
+
+    @staticmethod
+    def record_render(encoded: Optional[Dict[str, bytes]], timings: Dict[str, float]):
+        """Records a render's stage timings and output size, wherever it ran"""
+        observe_timings(timings)
+        if encoded:
+            BYTES.labels('out').inc(sum(len(data) for data in encoded.values()))
+
+    def publish(self, exercise_id: str, fingerprint: Optional[str],
+                encoded: Dict[str, bytes]) -> Optional[Dict[str, str]]:
+        """Turns encoded renditions into the references stored on the exercise.
+
+        Inline mode returns data URIs; otherwise the bytes go to the store,
+        keyed by fingerprint when there is one so identical sources share
+        their objects. The result is cached under the fingerprint.
+        """
+        with stage_timer('publish'):
+            if self.store:
+                items = [(rendition, encoded[rendition.name]) for rendition in self.renditions]
+                renditions = self.store.put(fingerprint or exercise_id, items)
+                if not renditions:
+                    logger.error(f"Failed to store thumbnails for {exercise_id}")
+                    return None
+            else:
+                renditions = {
+                    rendition.name: data_uri(rendition.mime_type, encoded[rendition.name])
+                    for rendition in self.renditions
+                }
+
+        self.remember(fingerprint, renditions)
+        return renditions
+
+    def remember(self, fingerprint: Optional[str], renditions: Dict[str, str]):
+        """Stores published rendition references in the cache"""
+        if self.cache and fingerprint:
+            self.cache.put(fingerprint, renditions)
+
+    def split(self, renditions: Dict[str, str]) -> Tuple[str, Dict[str, str]]:
+        """Separates the exercise thumbnail from the extra renditions"""
+        extras = {name: uri for name, uri in renditions.items() if name != self.primary}
+        return renditions[self.primary], extras
+
+    @stage_timer('job')
+    def process_renditions(self, exercise_id: str, image_url: str) -> Optional[Dict[str, str]]:
         try:
-            image_data = self.s3_service.get_image(image_url)
-            if not image_data:
+            for refetched in (False, True):
+                renditions, image_data, fingerprint = self.fetch(image_url)
+                if renditions:
+                    return renditions
+                if not image_data:
+                    return None
+                try:
+                    encoded = self.render(image_data)
+                    break
+                except SourceEvicted as e:
+                    if refetched:
+                        raise
+                    logger.warning(f"{e}, fetching it again")
+
+            if not encoded:
+                report_permanent_failure(image_url, 'undecodable')
                 return None
-                
-            with Image.open(io.BytesIO(image_data)) as img:
-                if img.mode in ('RGBA', 'P'):
-                    img = img.convert('RGB')
-                    
-                img.thumbnail(self.thumbnail_size, Image.Resampling.LANCZOS)
-                
-                buffer = io.BytesIO()
-                img.save(buffer, format='JPEG', quality=85, optimize=True)
-                image_data = buffer.getvalue()
-                
-                image_base64 = base64.b64encode(image_data).decode('utf-8')
-                return f"data:image/jpeg;base64,{image_base64}"
-                
+            return self.publish(exercise_id, fingerprint, encoded)
+
         except Exception as e:
             logger.error(f"Image processing error: {e}")
             return None
+        
+    def process_image(self, exercise_id: str, image_url: str) -> Optional[str]:
+        renditions = self.process_renditions(exercise_id, image_url)
+        return renditions[self.primary] if renditions else None
@@ -2,7 +2,7 @@ import pika
 import time
 import logging
 import json
-from typing import Callable
+from typing import Callable, List
 from src.config import Config
 from src.utils.logger import setup_logger
 
@@ -18,13 +18,15 @@ class RabbitMQService:
 
     def publish(self, queue_name: str, message: dict, persistent: bool = True) -> bool:
         """Publishes a message to a queue"""
+        return self.publish_many(queue_name, [message], persistent) == 1
+
+    def publish_many(self, queue_name: str, messages: List[dict], persistent: bool = True) -> int:
+        """Publishes messages to a queue, declaring it once; returns how many were sent"""
+        published = 0
         try:
             # Ensure we have a connection
             if not self.connect():
-                return False
-
-            # Convert message to JSON
-            message_body = json.dumps(message)
+                return 0
 
             # Declare queue to ensure it exists
             self.channel.queue_declare(
@@ -32,23 +34,49 @@ class RabbitMQService:
                 durable=True
             )
 
-            # Publish the message
+            properties = pika.BasicProperties(
+                delivery_mode=2 if persistent else 1,  # 2 = persistent
+                timestamp=int(time.time())  # lets consumers measure queue lag
+            )
+            for message in messages:
+                self.channel.basic_publish(
+                    exchange='',
+                    routing_key=queue_name,
+                    body=json.dumps(message),
+                    properties=properties
+                )
+                published += 1
+
+            self.logger.debug(f"Published {published} message(s) to {queue_name}")
+            return published
+
+        except Exception as e:
+            self.logger.error(f"Failed to publish message: {str(e)}", exc_info=True)
+            # Try to cleanup and reconnect
+            self.cleanup()
+            return published
+
+    def republish(self, queue_name: str, body: bytes, headers: dict) -> bool:
+        """Publishes a raw message body with headers, e.g. a retried or dead-lettered message"""
+        try:
+            if not self.connect():
+                return False
+
+            self.channel.queue_declare(queue=queue_name, durable=True)
             self.channel.basic_publish(
                 exchange='',
                 routing_key=queue_name,
-                body=message_body,
+                body=body,
                 properties=pika.BasicProperties(
-                    delivery_mode=2 if persistent else 1  # 2 = persistent
+                    delivery_mode=2,
+                    timestamp=int(time.time()),
+                    headers=headers
                 )
             )
-
-            self.logger.debug(f"Published message to {queue_name}")
             return True
 
         except Exception as e:
-            self.logger.error(f"Failed to publish message: {str(e)}", exc_info=True)
-            # Try to cleanup and reconnect
-            self.cleanup()
+            self.logger.error(f"Failed to republish message to {queue_name}: {str(e)}", exc_info=True)
             return False
 
     def connect(self):
@@ -70,11 +98,14 @@ class RabbitMQService:
                     
                 if self.channel is None or self.channel.is_closed:
                     self.channel = self.connection.channel()
-                    self.channel.queue_declare(queue=self.config.RABBITMQ_QUEUE, durable=True)
-                    self.channel.basic_qos(prefetch_count=1)
+                    for queue_name in self.consumed_queues():
+                        self.channel.queue_declare(queue=queue_name, durable=True)
+                    self.channel.basic_qos(prefetch_count=self.config.RABBITMQ_PREFETCH)
                     self.logger.info("Successfully connected to RabbitMQ")
                     self.reconnect_delay = 5
-                    return True
+
+                # Already connected (e.g. publishing from inside a consumer callback)
+                return True
                     
             except Exception as e:
                 self.logger.error(f"Failed to connect to RabbitMQ: {str(e)}")
@@ -84,6 +115,10 @@ class RabbitMQService:
                 
         return False
 
+    def consumed_queues(self) -> List[str]:
+        """The bulk lane and the interactive lane"""
+        return [self.config.RABBITMQ_QUEUE, self.config.RABBITMQ_INTERACTIVE_QUEUE]
+
     def start_consuming(self, callback: Callable):
         """Starts consuming messages with automatic reconnection"""
         while self.should_reconnect:
@@ -91,13 +126,13 @@ class RabbitMQService:
                 if not self.connect():
                     continue
 
-                self.channel.basic_consume(
-                    queue=self.config.RABBITMQ_QUEUE,
-                    on_message_callback=callback
-                )
+                for queue_name in self.consumed_queues():
+                    self.channel.basic_consume(queue=queue_name, on_message_callback=callback)
                 
                 self.logger.info("Starting to consume messages...")
                 self.channel.start_consuming()
+                if not self.should_reconnect:
+                    break
                 
             except (pika.exceptions.ConnectionClosedByBroker,
                     pika.exceptions.AMQPChannelError,
@@ -113,6 +148,19 @@ class RabbitMQService:
 
             time.sleep(self.reconnect_delay)
 
+    def stop_consuming(self):
+        """Stops consuming once the in-flight message has been handled.
+
+        Safe to call from a signal handler: the stop is scheduled on the
+        connection's ioloop rather than run re-entrantly.
+        """
+        self.should_reconnect = False
+        try:
+            if self.connection and not self.connection.is_closed and self.channel:
+                self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        except Exception as e:
+            self.logger.warning(f"Could not schedule stop_consuming: {str(e)}")
+
     def cleanup(self):
         """Clean up connection and channel"""
         try:
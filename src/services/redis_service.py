@@ -1,22 +1,401 @@
 import redis
-import json
+import hashlib
 import logging
-from typing import Optional, List, Dict
+import threading
+import time
+import uuid
+from typing import Iterable, Optional, List, Dict, Iterator, Tuple
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import NoScriptError
+from redis.retry import Retry
 from src.config import Config
+from src.utils.codec import check_format, decode_catalog, dumps, encode_catalog, loads
+from src.utils.jobs import get_s3_key
+from src.utils.metrics import PENDING, stage_timer
 
 logger = logging.getLogger(__name__)
 
+# Store references (see thumbnail_store: blob keys and URLs, unlike inline
+# data URIs) are counted in a hash, REFS, mapping each exercise thumbnail to
+# the number of hashes pointing at it; FILES lists every location written
+# with it, space-separated. Blobs no exercise shows yet expire (see
+# REGISTER_THUMBNAIL_SCRIPT); the first reference makes them permanent.
+# Releasing the last one deletes Redis blobs at once and queues S3 objects
+# as "<reference> <location>" members of ORPHANS for the store to delete. A
+# reference never counted (written before counting started) is left alone.
+THUMBNAIL_REFERENCES = """
+local function is_blob(value)
+    return string.sub(value, 1, #blob_prefix) == blob_prefix
+end
+local function is_reference(value)
+    return value and (is_blob(value) or string.find(value, '://', 1, true) ~= nil)
+end
+local function registered(value)
+    return redis.call('HEXISTS', refs_key, value) == 1
+        and (not is_blob(value) or redis.call('EXISTS', value) == 1)
+end
+local function files(value)
+    return string.gmatch(redis.call('HGET', files_key, value) or value, '%S+')
+end
+local function keep(value)
+    for file in files(value) do
+        if is_blob(file) then
+            redis.call('PERSIST', file)
+        end
+    end
+end
+local function release(value)
+    local count = redis.call('HINCRBY', refs_key, value, -1)
+    if count > 0 then
+        return
+    end
+    redis.call('HDEL', refs_key, value)
+    if count < 0 then
+        return
+    end
+    for file in files(value) do
+        if is_blob(file) then
+            redis.call('DEL', file)
+        else
+            redis.call('SADD', orphans_key, value .. ' ' .. file)
+        end
+    end
+    redis.call('HDEL', files_key, value)
+end
+local function replace(old, new)
+    if old == new then
+        return
+    end
+    if is_reference(new) then
+        if not registered(new) then
+            -- Keep the old objects rather than leave nothing behind
+            return
+        end
+        redis.call('HINCRBY', refs_key, new, 1)
+        keep(new)
+    end
+    if is_reference(old) then
+        release(old)
+    end
+end
+"""
+
+# Atomically applies a batch of thumbnail results: for every exercise sets
+# the thumbnail on its hash, drops it from the pending index (KEYS[1]) and
+# the claimed set (KEYS[3]) and writes the image key plus any extra
+# rendition keys, copies expiring after ARGV[1] seconds. KEYS[4..6] and
+# ARGV[2] are the REFS, FILES and ORPHANS
+# keys and the blob prefix of THUMBNAIL_REFERENCES: the thumbnail an
+# exercise had before is released, and the blobs of its new one no longer
+# expire. Per exercise follow id, thumbnail, source key, extra count and
+# the extra values in ARGV, and data key, image key and extra keys in KEYS.
+# KEYS[2] is the dead-letter index, left along with the attempt count and
+# any source reset mark once an exercise succeeds. Returns one flag per
+# exercise: 1 when applied, 0 when its hash does not exist, -1 when the hash
+# now points at another source image (the thumbnail would be stale), -2
+# when the stored thumbnail was released or expired before the commit; in
+# both of the latter cases nothing is written.
+UPDATE_THUMBNAILS_SCRIPT = """
+local refs_key, files_key, orphans_key, blob_prefix = KEYS[4], KEYS[5], KEYS[6], ARGV[2]
+""" + THUMBNAIL_REFERENCES + """
+local ttl = tonumber(ARGV[1])
+local result = {}
+local k, a = 7, 3
+while a <= #ARGV do
+    local id, thumbnail, source, extras = ARGV[a], ARGV[a + 1], ARGV[a + 2], tonumber(ARGV[a + 3])
+    local current = redis.call('HGET', KEYS[k], 'source')
+    if redis.call('EXISTS', KEYS[k]) == 0 then
+        table.insert(result, 0)
+    elseif source ~= '' and current and current ~= '' and current ~= source then
+        table.insert(result, -1)
+    elseif is_reference(thumbnail) and not registered(thumbnail) then
+        table.insert(result, -2)
+    else
+        replace(redis.call('HGET', KEYS[k], 'thumbnail'), thumbnail)
+        redis.call('HSET', KEYS[k], 'thumbnail', thumbnail)
+        redis.call('HDEL', KEYS[k], 'attempts', 'reset')
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('ZREM', KEYS[3], id)
+        for i = 0, extras do
+            local value = i == 0 and thumbnail or ARGV[a + 3 + i]
+            if ttl > 0 then
+                redis.call('SET', KEYS[k + 1 + i], value, 'EX', ttl)
+            else
+                redis.call('SET', KEYS[k + 1 + i], value)
+            end
+        end
+        if is_reference(thumbnail) then
+            keep(thumbnail)
+        end
+        table.insert(result, 1)
+    end
+    k = k + 2 + extras
+    a = a + 4 + extras
+end
+return result
+"""
+
+# Counts the thumbnails sync_from_blob put on or took off exercise hashes:
+# ARGV[1] is the blob prefix, followed by old, new pairs ('' for none).
+REPLACE_THUMBNAILS_SCRIPT = """
+local refs_key, files_key, orphans_key, blob_prefix = KEYS[1], KEYS[2], KEYS[3], ARGV[1]
+""" + THUMBNAIL_REFERENCES + """
+for i = 2, #ARGV, 2 do
+    replace(ARGV[i], ARGV[i + 1])
+end
+return true
+"""
+
+# Records a stored thumbnail for THUMBNAIL_REFERENCES: KEYS[1..3] are the
+# REFS, FILES and ORPHANS keys, ARGV[1] the TTL, ARGV[2] the reference and
+# ARGV[3] its space-separated locations. Any further KEYS are blobs written
+# with the bytes in the same ARGV position; they expire after the TTL unless
+# an exercise already shows the reference, since a render that is never
+# committed would otherwise keep them forever.
+REGISTER_THUMBNAIL_SCRIPT = """
+local ttl, reference = tonumber(ARGV[1]), ARGV[2]
+local referenced = tonumber(redis.call('HGET', KEYS[1], reference) or '0') > 0
+redis.call('HSETNX', KEYS[1], reference, 0)
+redis.call('HSET', KEYS[2], reference, ARGV[3])
+for location in string.gmatch(ARGV[3], '%S+') do
+    redis.call('SREM', KEYS[3], reference .. ' ' .. location)
+end
+for i = 4, #KEYS do
+    if referenced or ttl <= 0 then
+        redis.call('SET', KEYS[i], ARGV[i])
+    else
+        redis.call('SET', KEYS[i], ARGV[i], 'EX', ttl)
+    end
+end
+return true
+"""
+
+# SHA-1 of the catalog blob computed server-side, so checking whether it
+# changed does not transfer it
+BLOB_DIGEST_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return false
+end
+return redis.sha1hex(value)
+"""
+
+# Counts a failed attempt for every exercise still in the pending index
+# (KEYS[1]) or claimed by a batch (KEYS[3]); claimed ones are released back
+# to pending at their position in the index (KEYS[4]). ARGV[1] is the
+# attempt limit and ARGV[2] the data key prefix, followed by id, increment
+# pairs. Exercises reaching the limit move to the dead-letter index
+# (KEYS[2]) at their catalog position; returns their ids.
+RECORD_FAILURES_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local dead = {}
+for i = 3, #ARGV, 2 do
+    local id = ARGV[i]
+    local position = redis.call('ZSCORE', KEYS[1], id)
+    if redis.call('ZREM', KEYS[3], id) == 1 and not position then
+        position = redis.call('ZSCORE', KEYS[4], id)
+        if position then
+            redis.call('ZADD', KEYS[1], position, id)
+        end
+    end
+    if position then
+        local attempts = redis.call('HINCRBY', ARGV[2] .. id, 'attempts', tonumber(ARGV[i + 1]))
+        if attempts >= limit then
+            redis.call('ZREM', KEYS[1], id)
+            redis.call('ZADD', KEYS[2], position, id)
+            table.insert(dead, id)
+        end
+    end
+end
+return dead
+"""
+
+# Pops the ARGV[1] oldest requests from the priority set (KEYS[1]) and
+# returns them as a flat [id, data, ...] list: data for exercises still
+# pending (KEYS[2]), which are claimed (KEYS[4]) until ARGV[3], '' for ids
+# missing from the index (KEYS[3]), which may be newer than the last sync.
+# Requests for finished or already claimed exercises are dropped.
+TAKE_PRIORITY_SCRIPT = """
+local popped = redis.call('ZPOPMIN', KEYS[1], tonumber(ARGV[1]))
+local result = {}
+for i = 1, #popped, 2 do
+    local id = popped[i]
+    if redis.call('ZSCORE', KEYS[2], id) then
+        local data = redis.call('HGET', ARGV[2] .. id, 'data')
+        if data then
+            redis.call('ZREM', KEYS[2], id)
+            redis.call('ZADD', KEYS[4], tonumber(ARGV[3]), id)
+            table.insert(result, id)
+            table.insert(result, data)
+        end
+    elseif not redis.call('ZSCORE', KEYS[3], id) then
+        table.insert(result, id)
+        table.insert(result, '')
+    end
+end
+return result
+"""
+
+# Claims the first ARGV[1] pending ids (KEYS[1]) and returns them with
+# their stored data in a single round-trip, as a flat [id, data, id, data,
+# ...] list. Claimed ids move to KEYS[2] scored by their lease deadline,
+# ARGV[4]; a commit or a recorded failure ends the claim, so concurrent
+# drains never get the same exercise. Claims whose deadline passed before
+# ARGV[3], now, go back to pending at their position in the index (KEYS[3])
+# first. Ids without data are dropped.
+PENDING_BATCH_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[3], 'LIMIT', 0, 1000)
+for _, id in ipairs(expired) do
+    local position = redis.call('ZSCORE', KEYS[3], id)
+    if position then
+        redis.call('ZADD', KEYS[1], position, id)
+    end
+    redis.call('ZREM', KEYS[2], id)
+end
+local popped = redis.call('ZPOPMIN', KEYS[1], tonumber(ARGV[1]))
+local result = {}
+for i = 1, #popped, 2 do
+    local id = popped[i]
+    local data = redis.call('HGET', ARGV[2] .. id, 'data')
+    if data then
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[4]), id)
+        table.insert(result, id)
+        table.insert(result, data)
+    end
+end
+return result
+"""
+
+# Hands claimed ids (ARGV) back to the pending index (KEYS[1]) at their
+# position in the index (KEYS[3]) without counting an attempt; ids no
+# longer claimed (KEYS[2]) are left alone. Returns how many were released.
+RELEASE_CLAIMS_SCRIPT = """
+local released = 0
+for _, id in ipairs(ARGV) do
+    if redis.call('ZREM', KEYS[2], id) == 1 then
+        local position = redis.call('ZSCORE', KEYS[3], id)
+        if position then
+            redis.call('ZADD', KEYS[1], position, id)
+            released = released + 1
+        end
+    end
+end
+return released
+"""
+
+# Replies queue_status adds to a pipeline
+STATUS_REPLIES = 4
+
+# Drops the calling drain (ARGV[1]) from the active drains of the run
+# (KEYS[2]), along with drains silent since ARGV[2]. The last one out
+# deletes the run checkpoint (KEYS[1]) and returns it as a flat
+# [field, value, ...] list; otherwise nothing is returned.
+FINISH_RUN_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[2]) > 0 then
+    return {}
+end
+local checkpoint = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1], KEYS[2])
+return checkpoint
+"""
+
+def connection_options() -> Dict:
+    """redis-py connection settings from Config, shared by the sync and async pools"""
+    return dict(
+        host=Config.REDIS_HOST,
+        port=Config.REDIS_PORT,
+        db=Config.REDIS_DB,
+        password=Config.REDIS_PASSWORD,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT or None,
+        socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT or None,
+        socket_keepalive=Config.REDIS_SOCKET_KEEPALIVE,
+        health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+        retry_on_timeout=Config.REDIS_RETRY_ON_TIMEOUT,
+    )
+
+def pool_size() -> int:
+    # Every fetch and write thread may hold one, plus the drain loop's own reads
+    return Config.REDIS_MAX_CONNECTIONS or max(16, Config.PIPELINE_FETCH_WORKERS + Config.PIPELINE_WRITE_WORKERS + 4)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def shared_pool(decode_responses: bool = True) -> redis.ConnectionPool:
+    """The process-wide pool for text (or raw bytes) clients.
+
+    Every RedisService, ThumbnailCache and thumbnail store of a process
+    borrows from it, so concurrent stages cannot open more than
+    REDIS_MAX_CONNECTIONS sockets between them. redis-py resets pools
+    inherited through fork(), so worker processes get their own.
+    """
+    with _pools_lock:
+        if decode_responses not in _pools:
+            options = dict(
+                connection_options(),
+                decode_responses=decode_responses,
+                retry=Retry(ExponentialBackoff(), Config.REDIS_RETRIES) if Config.REDIS_RETRY_ON_TIMEOUT else None,
+            )
+            if Config.REDIS_BLOCKING_POOL:
+                pool = redis.BlockingConnectionPool(
+                    max_connections=pool_size(), timeout=Config.REDIS_POOL_TIMEOUT, **options
+                )
+            else:
+                pool = redis.ConnectionPool(max_connections=pool_size(), **options)
+            _pools[decode_responses] = pool
+        return _pools[decode_responses]
+
 class RedisService:
-    def __init__(self):
+    def __init__(self, client: Optional[redis.Redis] = None,
+                 binary_client: Optional[redis.Redis] = None):
         self.config = Config()
-        self.redis = redis.Redis(
-            host=self.config.REDIS_HOST,
-            port=self.config.REDIS_PORT,
-            db=self.config.REDIS_DB,
-            password=self.config.REDIS_PASSWORD,
-            decode_responses=True
-        )
+        self.redis = client or redis.Redis(connection_pool=shared_pool())
+        # Injected clients (e.g. fakeredis) get a binary twin on their own server
+        self._shared = client is None
         self.image_prefix = "exercise:image:"
+        self.all_key = "exercises:all"
+        self.data_prefix = "exercise:data:"
+        self.index_key = "exercises:index"
+        self.pending_key = "exercises:pending"
+        # Pending exercises a batch is working on, by lease deadline
+        self.claimed_key = "exercises:claimed"
+        # Exercises given up on after MAX_ATTEMPTS failures, and the
+        # checkpoint of the drain run in progress
+        self.dead_key = "exercises:dead"
+        self.run_key = "exercises:run"
+        # Drains sharing that run, by last checkpoint time, and this one's id
+        self.run_drains_key = "exercises:run:drains"
+        self.run_token = None
+        # Digest of the last fully synced exercises:all, and the progress of
+        # an unfinished sync of it
+        self.digest_key = "exercises:all:digest"
+        self.sync_cursor_key = "exercises:sync:cursor"
+        # Exercises requested on the interactive lane, by request time, and
+        # the marker of a process_exercises trigger no sync has seen yet
+        self.priority_key = "exercises:priority"
+        self.trigger_key = "exercises:trigger"
+        # Format materialize writes exercises:all in; any format is read
+        self.catalog_format = self.config.CATALOG_FORMAT
+        check_format(self.catalog_format)
+        self.blob_prefix = "thumbnail:blob:"
+        # Reference counts of stored thumbnails, the locations written with
+        # each, and released S3 objects awaiting deletion
+        self.refs_key = "thumbnail:refs"
+        self.files_key = "thumbnail:files"
+        self.orphans_key = "thumbnail:orphans"
+        self.pipeline_chunk = 1000
+        self._binary = binary_client
+        self._update_thumbnails = self.redis.register_script(UPDATE_THUMBNAILS_SCRIPT)
+        self._pending_batch = self.redis.register_script(PENDING_BATCH_SCRIPT)
+        self._release_claims = self.redis.register_script(RELEASE_CLAIMS_SCRIPT)
+        self._finish_run = self.redis.register_script(FINISH_RUN_SCRIPT)
+        self._blob_digest = self.redis.register_script(BLOB_DIGEST_SCRIPT)
+        self._record_failures = self.redis.register_script(RECORD_FAILURES_SCRIPT)
+        self._take_priority = self.redis.register_script(TAKE_PRIORITY_SCRIPT)
+        self._replace_thumbnails = self.redis.register_script(REPLACE_THUMBNAILS_SCRIPT)
+        self._register_thumbnail = self.binary.register_script(REGISTER_THUMBNAIL_SCRIPT)
 
     def test_connection(self) -> bool:
         """Testează conexiunea la Redis"""
@@ -25,82 +404,668 @@ class RedisService:
         except Exception as e:
             logger.error(f"Redis connection test failed: {e}")
             return False
-        
+
+    @property
+    def binary(self) -> redis.Redis:
+        """Client without decode_responses, for raw thumbnail bytes"""
+        if self._binary is None and self._shared:
+            self._binary = redis.Redis(connection_pool=shared_pool(decode_responses=False))
+        elif self._binary is None:
+            pool = self.redis.connection_pool
+            self._binary = redis.Redis(connection_pool=redis.ConnectionPool(
+                connection_class=pool.connection_class,
+                **{**pool.connection_kwargs, 'decode_responses': False}
+            ))
+        return self._binary
+
+    def _data_key(self, exercise_id) -> str:
+        return f"{self.data_prefix}{exercise_id}"
+
     def get_all_exercises(self) -> Optional[List[Dict]]:
         """Get all exercises from Redis"""
         try:
-            exercises_data = self.redis.get("exercises:all")
-            if exercises_data:
-                return json.loads(exercises_data)
-            return None
+            return decode_catalog(self.binary.get(self.all_key))
         except Exception as e:
             logger.error(f"Error getting all exercises: {e}")
             return None
 
+    def claim_deadline(self) -> float:
+        return time.time() + self.config.CLAIM_LEASE_SECONDS
+
+    def pending_batch_args(self, limit: int):
+        """Builds the keys/args of PENDING_BATCH_SCRIPT"""
+        now = time.time()
+        keys = [self.pending_key, self.claimed_key, self.index_key]
+        return keys, [limit, self.data_prefix, now, now + self.config.CLAIM_LEASE_SECONDS]
+
+    @stage_timer('redis_read')
     def get_exercises_without_thumbnails(self, limit: int = 50) -> List[Dict]:
-        """Gets exercises needing thumbnail processing"""
+        """Claims the next exercises needing thumbnail processing from the pending index.
+
+        They stay claimed until their thumbnail is committed or a failure is
+        recorded for them, or for CLAIM_LEASE_SECONDS if neither happens.
+        """
         try:
-            raw_data = self.redis.get("exercises:all")
-            if not raw_data:
+            if limit <= 0:
                 return []
 
-            all_exercises = json.loads(raw_data)
-            needs_processing = []
+            keys, args = self.pending_batch_args(limit)
+            flat = self._pending_batch(keys=keys, args=args)
+            return self.parse_pending_batch(flat)
+
+        except Exception as e:
+            logger.error(f"Error getting exercises without thumbnails: {e}")
+            return []
+
+    def release_claims(self, exercise_ids: Iterable) -> int:
+        """Returns claimed exercises to the pending index without counting an attempt"""
+        try:
+            exercise_ids = [str(exercise_id) for exercise_id in exercise_ids]
+            if not exercise_ids:
+                return 0
+            return self._release_claims(keys=[self.pending_key, self.claimed_key, self.index_key],
+                                        args=exercise_ids)
+        except Exception as e:
+            logger.error(f"Error releasing claimed exercises: {e}")
+            return 0
+
+    def iter_pending_exercises(self, chunk_size: int = 500, start: Optional[float] = None) -> Iterator[Dict]:
+        """Yields every pending exercise, paging the index by score.
 
-            for exercise in all_exercises:
-                if (
-                    'image' in exercise 
-                    and exercise.get('image', {}).get('uri')
-                    and exercise.get('image', {}).get('thumbnail') is None
-                ):
-                    needs_processing.append(exercise)
-                    if len(needs_processing) >= limit:
-                        break
+        Paging by score rather than offset keeps the walk stable while other
+        workers remove ids from the index.
+        """
+        return self._iter_exercises(self.pending_key, chunk_size, start)
 
-            return needs_processing
+    def iter_indexed_exercises(self, chunk_size: int = 500, start: Optional[float] = None) -> Iterator[Dict]:
+        """Yields every synced exercise, finished or not, in catalog order"""
+        return self._iter_exercises(self.index_key, chunk_size, start)
 
+    def catalog_position(self, exercise_id) -> Optional[float]:
+        """Score of an exercise in the index (and the pending set), None when it is not synced"""
+        return self.redis.zscore(self.index_key, str(exercise_id))
+
+    def count_exercises(self, pending: bool = True, start: Optional[float] = None) -> int:
+        """How many pending (or indexed) exercises sit at or after catalog position ``start``"""
+        key = self.pending_key if pending else self.index_key
+        return self.redis.zcount(key, '-inf' if start is None else start, '+inf')
+
+    def _iter_exercises(self, key: str, chunk_size: int, start: Optional[float]) -> Iterator[Dict]:
+        """Walks a sorted set of exercise ids from score ``start`` and yields their data"""
+        min_score = '-inf' if start is None else start
+        while True:
+            entries = self.redis.zrangebyscore(
+                key, min_score, '+inf', start=0, num=chunk_size, withscores=True
+            )
+            if not entries:
+                return
+
+            pipe = self.redis.pipeline(transaction=False)
+            for exercise_id, _ in entries:
+                pipe.hget(self._data_key(exercise_id), 'data')
+            for data in pipe.execute():
+                if data:
+                    yield self._decode_pending(data)
+
+            min_score = f"({entries[-1][1]}"
+
+    @staticmethod
+    def _decode_pending(data: str) -> Dict:
+        exercise = loads(data)
+        if exercise.get('image') is not None:
+            exercise['image']['thumbnail'] = None
+        return exercise
+
+    @staticmethod
+    def parse_pending_batch(flat: List[str]) -> List[Dict]:
+        """Decodes the [id, data, ...] reply of the pending batch script"""
+        return [RedisService._decode_pending(data) for data in flat[1::2]]
+
+    def get_processing_status(self) -> Dict[str, int]:
+        """Returns total/processed/remaining/dead counts in a single round-trip"""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            self.queue_status(pipe)
+            return self.parse_status(*pipe.execute())
         except Exception as e:
-            logger.error(f"Error getting exercises without thumbnails: {e}")
+            logger.error(f"Error getting processing status: {e}")
+            return {'total': 0, 'processed': 0, 'remaining': 0, 'dead': 0}
+
+    def queue_status(self, pipe):
+        """Queues the STATUS_REPLIES counters parse_status expects on a pipeline"""
+        pipe.zcard(self.index_key)
+        pipe.zcard(self.pending_key)
+        pipe.zcard(self.claimed_key)
+        pipe.zcard(self.dead_key)
+
+    def queue_pending_batch(self, pipe, limit: int):
+        """Queues the pending batch script by SHA, so the pipeline stays one round-trip.
+
+        redis-py would check the script cache first when a Script is called
+        on a pipeline; a server that lost the script answers NoScriptError
+        instead, and the caller falls back to get_exercises_without_thumbnails.
+        """
+        keys, args = self.pending_batch_args(limit)
+        pipe.evalsha(self._pending_batch.sha, len(keys), *keys, *args)
+
+    @stage_timer('redis_read')
+    def get_status_and_pending(self, limit: int) -> Tuple[Dict[str, int], List[Dict]]:
+        """Returns the processing status and the next ``limit`` pending exercises.
+
+        Counters and batch candidates come back in one pipelined round-trip,
+        which is all the drain loop needs per batch.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            self.queue_status(pipe)
+            if limit > 0:
+                self.queue_pending_batch(pipe, limit)
+            replies = pipe.execute(raise_on_error=False)
+            for reply in replies[:STATUS_REPLIES]:
+                if isinstance(reply, Exception):
+                    raise reply
+
+            status = self.parse_status(*replies[:STATUS_REPLIES])
+            if limit <= 0:
+                return status, []
+            batch = replies[STATUS_REPLIES]
+            if isinstance(batch, NoScriptError):
+                return status, self.get_exercises_without_thumbnails(limit)
+            if isinstance(batch, Exception):
+                raise batch
+            return status, self.parse_pending_batch(batch)
+        except Exception as e:
+            logger.error(f"Error getting processing status and pending exercises: {e}")
+            return {'total': 0, 'processed': 0, 'remaining': 0, 'dead': 0}, []
+
+    @staticmethod
+    def parse_status(total: int, pending: int, claimed: int, dead: int) -> Dict[str, int]:
+        # Claimed exercises are still to be done
+        remaining = pending + claimed
+        PENDING.set(remaining)
+        return {
+            'total': total,
+            'processed': total - remaining - dead,
+            'remaining': remaining,
+            'dead': dead
+        }
+
+    def failure_script_args(self, exercise_ids: Iterable, permanent_ids: Iterable = ()):
+        """Builds the keys/args of RECORD_FAILURES_SCRIPT.
+
+        Permanent failures (e.g. an image URL that is not ours) use up every
+        attempt at once.
+        """
+        max_attempts = max(1, self.config.MAX_ATTEMPTS)
+        args = [max_attempts, self.data_prefix]
+        for exercise_id in exercise_ids:
+            args += [exercise_id, 1]
+        for exercise_id in permanent_ids:
+            args += [exercise_id, max_attempts]
+        return [self.pending_key, self.dead_key, self.claimed_key, self.index_key], args
+
+    def log_dead_letters(self, dead: List[str]) -> List[str]:
+        if dead:
+            logger.warning(
+                f"Moved {len(dead)} exercises to {self.dead_key} after {self.config.MAX_ATTEMPTS} "
+                f"failed attempts: {', '.join(dead[:20])}{' ...' if len(dead) > 20 else ''}"
+            )
+        return dead
+
+    def record_failures(self, exercise_ids: Iterable, permanent_ids: Iterable = ()) -> List[str]:
+        """Counts a failed attempt for the given exercises that are still pending or claimed.
+
+        Claimed ones go back to the pending index. Exercises that reach
+        MAX_ATTEMPTS leave it for exercises:dead instead, so a drain never
+        spins on images that cannot be processed. Returns the ids
+        dead-lettered by this call.
+        """
+        try:
+            keys, args = self.failure_script_args(exercise_ids, permanent_ids)
+            if len(args) == 2:
+                return []
+            return self.log_dead_letters(self._record_failures(keys=keys, args=args))
+        except Exception as e:
+            logger.error(f"Error recording failed exercises: {e}")
             return []
-        
-    def update_exercise_thumbnail(self, exercise_id: str, thumbnail_uri: str) -> bool:
-        """Updates exercise thumbnail in Redis"""
+
+    def requeue_dead_letters(self, exercise_ids: Optional[List[str]] = None) -> int:
+        """Moves dead-lettered exercises (all of them by default) back to pending with fresh attempts"""
         try:
-            # Get current data
-            raw_data = self.redis.get("exercises:all")
-            if not raw_data:
-                logger.error("No exercises found in Redis")
-                return False
+            entries = self.redis.zrange(self.dead_key, 0, -1, withscores=True)
+            if exercise_ids is not None:
+                wanted = {str(exercise_id) for exercise_id in exercise_ids}
+                entries = [(exercise_id, score) for exercise_id, score in entries if exercise_id in wanted]
 
-            exercises = json.loads(raw_data)
-            updated = False
-
-            # Update the specific exercise
-            for exercise in exercises:
-                if exercise['id'] == exercise_id and 'image' in exercise:
-                    exercise['image']['thumbnail'] = thumbnail_uri
-                    updated = True
-                    break
-
-            if updated:
-                # Save back to Redis
-                success = self.redis.set("exercises:all", json.dumps(exercises))
-                if success:
-                    logger.info(f"Successfully updated thumbnail for exercise {exercise_id}")
-                    # Also save individual thumbnail
-                    self.redis.set(f"{self.image_prefix}{exercise_id}", thumbnail_uri)
-                    return True
-                else:
-                    logger.error(f"Failed to save updated exercises to Redis")
-                    return False
+            for start in range(0, len(entries), self.pipeline_chunk):
+                pipe = self.redis.pipeline(transaction=True)
+                for exercise_id, score in entries[start:start + self.pipeline_chunk]:
+                    pipe.hdel(self._data_key(exercise_id), 'attempts')
+                    pipe.zrem(self.dead_key, exercise_id)
+                    pipe.zadd(self.pending_key, {exercise_id: score})
+                pipe.execute()
+
+            logger.info(f"Requeued {len(entries)} dead-lettered exercises")
+            return len(entries)
+
+        except Exception as e:
+            logger.error(f"Error requeueing dead-lettered exercises: {e}")
+            return 0
+
+    @staticmethod
+    def select_pending_jobs(jobs: List[Tuple[str, str]], flat: List) -> List[Tuple[str, str]]:
+        """Keeps the jobs whose [pending score, stored source, ...] reply says they still need work"""
+        return [
+            job for job, pending, source in zip(jobs, flat[::2], flat[1::2])
+            if pending is not None and source in (None, '', job[1])
+        ]
+
+    def filter_pending_jobs(self, jobs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Drops (exercise_id, s3_key) jobs whose work is already done.
+
+        The pair is the job's idempotency key: a job is skipped once its
+        exercise left the pending index or moved to another image, so a
+        redelivered work unit does not render anything twice.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for exercise_id, _ in jobs:
+                pipe.zscore(self.pending_key, exercise_id)
+                pipe.hget(self._data_key(exercise_id), 'source')
+            return self.select_pending_jobs(jobs, pipe.execute())
+        except Exception as e:
+            logger.error(f"Error checking pending jobs, processing all of them: {e}")
+            return jobs
+
+    def prioritize(self, exercise_ids: Iterable) -> int:
+        """Queues exercises for the interactive lane; returns how many were not queued already"""
+        try:
+            now = time.time()
+            return self.redis.zadd(self.priority_key, {str(exercise_id): now for exercise_id in exercise_ids}, nx=True)
+        except Exception as e:
+            logger.error(f"Error prioritizing exercises: {e}")
+            return 0
+
+    def take_priority(self, limit: int) -> Tuple[List[Dict], List[str]]:
+        """Claims up to ``limit`` requested exercises.
+
+        Returns the pending ones, claimed as a drain batch's are, and the
+        ids the index does not know yet, which the caller should look up
+        again after a sync.
+        """
+        try:
+            flat = self._take_priority(keys=[self.priority_key, self.pending_key, self.index_key, self.claimed_key],
+                                       args=[limit, self.data_prefix, self.claim_deadline()])
+            return self.parse_priority_batch(flat)
+        except Exception as e:
+            logger.error(f"Error taking prioritized exercises: {e}")
+            return [], []
+
+    @staticmethod
+    def parse_priority_batch(flat: List[str]) -> Tuple[List[Dict], List[str]]:
+        exercises, unknown = [], []
+        for exercise_id, data in zip(flat[::2], flat[1::2]):
+            if data:
+                exercises.append(RedisService._decode_pending(data))
             else:
-                logger.warning(f"Exercise {exercise_id} not found in Redis")
-                return False
+                unknown.append(exercise_id)
+        return exercises, unknown
+
+    def get_pending_exercises(self, exercise_ids: List[str]) -> List[Dict]:
+        """Returns the given exercises that are still pending"""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for exercise_id in exercise_ids:
+                pipe.zscore(self.pending_key, exercise_id)
+                pipe.hget(self._data_key(exercise_id), 'data')
+            replies = pipe.execute()
+            return [self._decode_pending(data) for score, data in zip(replies[::2], replies[1::2])
+                    if score is not None and data]
+        except Exception as e:
+            logger.error(f"Error getting pending exercises: {e}")
+            return []
+
+    def claim_trigger(self, window: int) -> bool:
+        """True if no process_exercises trigger is outstanding, marking one as sent.
+
+        The next sync clears the marker, so triggers are coalesced only
+        while an earlier one still waits to be picked up; the window expires
+        a marker whose message was lost.
+        """
+        try:
+            return bool(self.redis.set(self.trigger_key, 1, nx=True, ex=max(1, window)))
+        except Exception as e:
+            logger.error(f"Error claiming trigger, sending it anyway: {e}")
+            return True
 
+    def release_trigger(self):
+        try:
+            self.redis.delete(self.trigger_key)
         except Exception as e:
-            logger.error(f"Error updating exercise thumbnail: {e}", exc_info=True)
+            logger.error(f"Error releasing trigger: {e}")
+
+    def start_run(self) -> Dict[str, str]:
+        """Opens the drain checkpoint, or joins the one another drain or an
+        interrupted run left.
+
+        Concurrent drains share the checkpoint; each is registered with it
+        until finish_run, or until it has not checkpointed for
+        CLAIM_LEASE_SECONDS, so the counters cover every batch.
+        """
+        try:
+            now = time.time()
+            self.run_token = uuid.uuid4().hex
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.hsetnx(self.run_key, 'started_at', int(now))
+            pipe.zremrangebyscore(self.run_drains_key, '-inf', now - self.config.CLAIM_LEASE_SECONDS)
+            pipe.zcard(self.run_drains_key)
+            pipe.zadd(self.run_drains_key, {self.run_token: now})
+            pipe.hgetall(self.run_key)
+            created, _, active, _, checkpoint = pipe.execute()
+            if not created:
+                logger.info(
+                    f"{'Joining' if active else 'Resuming'} run started at "
+                    f"{time.ctime(int(checkpoint['started_at']))} ({checkpoint.get('batches', 0)} batches, "
+                    f"{checkpoint.get('succeeded', 0)} succeeded so far)"
+                )
+            return checkpoint
+        except Exception as e:
+            logger.error(f"Error opening run checkpoint: {e}")
+            return {}
+
+    def checkpoint_run(self, succeeded: int, failed: int, dead_lettered: int) -> bool:
+        """Adds one finished batch to the drain checkpoint"""
+        try:
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.hincrby(self.run_key, 'batches', 1)
+            pipe.hincrby(self.run_key, 'succeeded', succeeded)
+            pipe.hincrby(self.run_key, 'failed', failed)
+            pipe.hincrby(self.run_key, 'dead_lettered', dead_lettered)
+            pipe.hset(self.run_key, 'updated_at', int(time.time()))
+            if self.run_token:
+                pipe.zadd(self.run_drains_key, {self.run_token: time.time()})
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Error writing run checkpoint: {e}")
             return False
 
+    def finish_run(self) -> Dict[str, str]:
+        """Leaves the drain checkpoint; the last drain out closes it and returns its totals"""
+        try:
+            flat = self._finish_run(
+                keys=[self.run_key, self.run_drains_key],
+                args=[self.run_token or '', time.time() - self.config.CLAIM_LEASE_SECONDS]
+            )
+            self.run_token = None
+            checkpoint = dict(zip(flat[::2], flat[1::2]))
+            if not checkpoint:
+                logger.debug("Drain finished; the run stays open while other drains are active")
+            else:
+                logger.info(
+                    f"Run complete: {checkpoint.get('batches', 0)} batches, {checkpoint.get('succeeded', 0)} "
+                    f"succeeded, {checkpoint.get('failed', 0)} failed, {checkpoint.get('dead_lettered', 0)} dead-lettered"
+                )
+            return checkpoint
+        except Exception as e:
+            logger.error(f"Error closing run checkpoint: {e}")
+            return {}
+
+    @staticmethod
+    def _digest(value) -> str:
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        return hashlib.sha1(value).hexdigest()
+
+    @staticmethod
+    def _source_key(uri: str) -> str:
+        """The S3 key jobs are built from, stored to detect stale thumbnail writes"""
+        try:
+            return get_s3_key(uri) or ''
+        except Exception:
+            return ''
+
+    def blob_digest(self) -> Optional[str]:
+        """SHA-1 of exercises:all, or None when it does not exist"""
+        try:
+            return self._blob_digest(keys=[self.all_key])
+        except redis.ResponseError:
+            # Servers without redis.sha1hex (e.g. fakeredis): hash it here
+            raw_data = self.binary.get(self.all_key)
+            return self._digest(raw_data) if raw_data else None
+
+    def sync_from_blob(self, force: bool = False) -> int:
+        """Imports new and changed exercises from exercises:all.
+
+        Nothing is read while the blob's digest matches the last completed
+        sync. Otherwise each exercise is diffed against the digest stored on
+        its hash and only new or modified ones are written; one whose image
+        URI changed loses its thumbnail and goes back to pending. Progress is
+        checkpointed per chunk, so an interrupted sync of the same blob
+        resumes where it stopped. Returns the number of new or changed
+        exercises.
+        """
+        try:
+            # This sync covers every trigger sent so far
+            self.redis.delete(self.trigger_key)
+            if not force and self.blob_digest() == self.redis.get(self.digest_key):
+                logger.debug(f"{self.all_key} unchanged since the last sync")
+                return 0
+
+            raw_data = self.binary.get(self.all_key)
+            if not raw_data:
+                return 0
+
+            digest = self._digest(raw_data)
+            exercises = decode_catalog(raw_data)
+            checkpoint = self.redis.hgetall(self.sync_cursor_key)
+            start = int(checkpoint['position']) if checkpoint.get('digest') == digest else 0
+            if start:
+                logger.info(f"Resuming sync of {self.all_key} at {start}/{len(exercises)}")
+
+            counts = {'new': 0, 'changed': 0, 'source_changed': 0}
+            for chunk_start in range(start, len(exercises), self.pipeline_chunk):
+                chunk = exercises[chunk_start:chunk_start + self.pipeline_chunk]
+
+                pipe = self.redis.pipeline(transaction=False)
+                for exercise in chunk:
+                    pipe.hmget(self._data_key(exercise['id']), 'digest', 'uri', 'thumbnail', 'reset')
+                    pipe.zscore(self.dead_key, exercise['id'])
+                stored = pipe.execute()
+
+                pipe = self.redis.pipeline(transaction=False)
+                replaced = []
+                rows = zip(chunk, stored[::2], stored[1::2])
+                for position, (exercise, fields, dead) in enumerate(rows, chunk_start):
+                    change = self._sync_exercise(pipe, exercise, position, *fields, dead=dead is not None,
+                                                 replaced=replaced)
+                    if change:
+                        counts[change] += 1
+                pipe.hset(self.sync_cursor_key, mapping={
+                    'digest': digest, 'position': chunk_start + len(chunk)
+                })
+                pipe.execute()
+                if replaced:
+                    self._replace_thumbnails(
+                        keys=[self.refs_key, self.files_key, self.orphans_key],
+                        args=[self.blob_prefix, *(value or '' for pair in replaced for value in pair)]
+                    )
+
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.set(self.digest_key, digest)
+            pipe.delete(self.sync_cursor_key)
+            pipe.execute()
+
+            changed = sum(counts.values())
+            logger.info(
+                f"Synced {len(exercises)} exercises: {counts['new']} new, {counts['changed']} changed, "
+                f"{counts['source_changed']} with a new image"
+            )
+            return changed
+
+        except Exception as e:
+            logger.error(f"Error syncing exercises from {self.all_key}: {e}", exc_info=True)
+            return 0
+
+    def _sync_exercise(self, pipe, exercise: Dict, position: int, stored_digest: Optional[str],
+                       stored_uri: Optional[str], stored_thumbnail: Optional[str],
+                       reset: Optional[str] = None, dead: bool = False,
+                       replaced: Optional[List[Tuple[Optional[str], Optional[str]]]] = None) -> Optional[str]:
+        """Queues the writes for one blob entry; returns the kind of change, if any.
+
+        ``reset`` marks an exercise whose image changed and has not been
+        rendered since: whatever thumbnail the blob still holds for it shows
+        the old image, so it is never adopted. Every (old, new) thumbnail
+        swap on the hash is appended to ``replaced`` for
+        REPLACE_THUMBNAILS_SCRIPT.
+        """
+        if replaced is None:
+            replaced = []
+        exercise_id = str(exercise['id'])
+        image = dict(exercise.get('image') or {})
+        thumbnail = image.pop('thumbnail', None)
+        uri = image.get('uri') or ''
+        if reset:
+            thumbnail = None
+
+        data = dict(exercise)
+        if exercise.get('image') is not None:
+            data['image'] = image
+        data_json = dumps(data)
+        data_digest = self._digest(data_json)
+
+        pipe.zadd(self.index_key, {exercise_id: position})
+        if data_digest == stored_digest:
+            if thumbnail is not None and thumbnail != stored_thumbnail:
+                # Written into the blob by another producer
+                pipe.hset(self._data_key(exercise_id), 'thumbnail', thumbnail)
+                replaced.append((stored_thumbnail, thumbnail))
+                pipe.zrem(self.pending_key, exercise_id)
+                pipe.zrem(self.dead_key, exercise_id)
+            return None
+
+        key = self._data_key(exercise_id)
+        if stored_uri is None:
+            change = 'new'
+        elif stored_uri != uri:
+            # Any thumbnail, even one still in the blob, shows the old image,
+            # and the new one deserves fresh attempts
+            change = 'source_changed'
+            thumbnail = None
+            dead = False
+            reset = '1'
+            pipe.hdel(key, 'thumbnail', 'attempts')
+        else:
+            change = 'changed'
+            if thumbnail is None:
+                thumbnail = stored_thumbnail
+
+        mapping = {'data': data_json, 'uri': uri, 'digest': data_digest, 'source': self._source_key(uri)}
+        if reset:
+            mapping['reset'] = reset
+        if thumbnail is not None:
+            mapping['thumbnail'] = thumbnail
+        pipe.hset(key, mapping=mapping)
+        if thumbnail != stored_thumbnail:
+            replaced.append((stored_thumbnail, thumbnail))
+
+        if uri and thumbnail is None:
+            if dead:
+                # Still the image that kept failing
+                return change
+            pipe.zadd(self.pending_key, {exercise_id: position})
+        else:
+            pipe.zrem(self.pending_key, exercise_id)
+        pipe.zrem(self.dead_key, exercise_id)
+        return change
+
+    def get_exercise(self, exercise_id: str) -> Optional[Dict]:
+        """Reads a single exercise from its hash"""
+        try:
+            fields = self.redis.hgetall(self._data_key(exercise_id))
+            return self._exercise_from_hash(fields) if fields else None
+        except Exception as e:
+            logger.error(f"Error getting exercise {exercise_id}: {e}")
+            return None
+
+    @staticmethod
+    def _exercise_from_hash(fields: Dict) -> Dict:
+        exercise = loads(fields['data'])
+        if exercise.get('image') is not None:
+            exercise['image']['thumbnail'] = fields.get('thumbnail')
+        return exercise
+
+    def materialize_all_exercises(self, max_retries: int = 5) -> bool:
+        """Rewrites exercises:all from the per-exercise hashes for legacy readers.
+
+        When the blob exists it is merged in place, so exercises added upstream
+        since the last sync are preserved; the write is guarded by WATCH.
+        Every synced exercise gets exactly the thumbnail on its hash, none
+        included, so a thumbnail of a replaced image does not linger in the
+        blob. Entries whose image changed upstream since the sync are left
+        for the next sync.
+        """
+        for _ in range(max_retries):
+            try:
+                with self.binary.pipeline() as pipe:
+                    pipe.watch(self.all_key)
+                    raw_data = pipe.get(self.all_key)
+
+                    if raw_data:
+                        exercises = decode_catalog(raw_data)
+                        stored = self._get_thumbnails([str(e['id']) for e in exercises])
+                        for exercise in exercises:
+                            image = exercise.get('image')
+                            uri, thumbnail = stored.get(str(exercise['id']), (None, None))
+                            if uri is not None and image is not None and (image.get('uri') or '') == uri:
+                                image['thumbnail'] = thumbnail
+                    else:
+                        exercises = self._load_indexed_exercises()
+
+                    payload = encode_catalog(exercises, self.catalog_format)
+                    # Only a blob that was fully synced may be marked as such;
+                    # otherwise upstream edits merged here would be skipped
+                    synced = raw_data is not None and self.redis.get(self.digest_key) == self._digest(raw_data)
+
+                    pipe.multi()
+                    pipe.set(self.all_key, payload)
+                    if synced:
+                        pipe.set(self.digest_key, self._digest(payload))
+                    pipe.execute()
+                    logger.info(f"Materialized {len(exercises)} exercises into {self.all_key}")
+                    return True
+
+            except redis.WatchError:
+                logger.debug(f"{self.all_key} changed during materialize, retrying")
+                continue
+            except Exception as e:
+                logger.error(f"Error materializing {self.all_key}: {e}", exc_info=True)
+                return False
+
+        logger.error(f"Gave up materializing {self.all_key} after {max_retries} attempts")
+        return False
+
+    def _get_thumbnails(self, exercise_ids: List[str]) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """(uri, thumbnail) per hash; the uri is None for exercises that were never synced"""
+        thumbnails = {}
+        for start in range(0, len(exercise_ids), self.pipeline_chunk):
+            chunk = exercise_ids[start:start + self.pipeline_chunk]
+            pipe = self.redis.pipeline(transaction=False)
+            for exercise_id in chunk:
+                pipe.hmget(self._data_key(exercise_id), 'uri', 'thumbnail')
+            thumbnails.update(zip(chunk, pipe.execute()))
+        return thumbnails
+
+    def _load_indexed_exercises(self) -> List[Dict]:
+        exercise_ids = self.redis.zrange(self.index_key, 0, -1)
+        exercises = []
+        for start in range(0, len(exercise_ids), self.pipeline_chunk):
+            pipe = self.redis.pipeline(transaction=False)
+            for exercise_id in exercise_ids[start:start + self.pipeline_chunk]:
+                pipe.hgetall(self._data_key(exercise_id))
+            exercises.extend(self._exercise_from_hash(f) for f in pipe.execute() if f)
+        return exercises
+
     def get_thumbnail(self, exercise_id: str) -> Optional[str]:
         """Obține thumbnail pentru un exercițiu"""
         try:
@@ -118,42 +1083,121 @@ class RedisService:
             logger.error(f"Redis save error: {e}")
             return False
 
-    def update_exercise_thumbnail(self, exercise_id: str, thumbnail_uri: str) -> bool:
-        """Actualizează thumbnail-ul în lista completă de exerciții"""
+    def rendition_key(self, exercise_id: str, name: str) -> str:
+        return f"{self.image_prefix}{exercise_id}:{name}"
+
+    def update_script_args(self, updates: List[Tuple[str, str, Optional[Dict[str, str]], Optional[str]]]):
+        """Builds the keys/args of UPDATE_THUMBNAILS_SCRIPT for a batch"""
+        keys = [self.pending_key, self.dead_key, self.claimed_key, self.refs_key, self.files_key, self.orphans_key]
+        args = [self.config.REDIS_TTL or 0, self.blob_prefix]
+        for exercise_id, thumbnail_uri, renditions, source in updates:
+            renditions = renditions or {}
+            keys += [self._data_key(exercise_id), f"{self.image_prefix}{exercise_id}"]
+            keys += [self.rendition_key(exercise_id, name) for name in renditions]
+            args += [exercise_id, thumbnail_uri, source or '', len(renditions), *renditions.values()]
+        return keys, args
+
+    def log_update_results(self, updates, flags) -> List[bool]:
+        results = []
+        for (exercise_id, _, _, _), flag in zip(updates, flags):
+            if flag == 1:
+                logger.debug("Updated thumbnail for exercise %s", exercise_id)
+            elif flag == -1:
+                logger.warning(f"Image of exercise {exercise_id} changed while processing, leaving it pending")
+            elif flag == -2:
+                logger.warning(f"Stored thumbnail of exercise {exercise_id} was released before the commit, leaving it pending")
+            else:
+                logger.warning(f"Exercise {exercise_id} not found in per-exercise storage")
+            results.append(flag == 1)
+        return results
+
+    @stage_timer('redis_write')
+    def update_exercise_thumbnails(self, updates: List[Tuple[str, str, Optional[Dict[str, str]], Optional[str]]]) -> List[bool]:
+        """Commits (exercise_id, thumbnail, renditions, source_key) results in one atomic round-trip.
+
+        Returns a success flag per update. ``source_key`` is the S3 key the
+        thumbnail was rendered from; an update whose exercise has since moved
+        to another image is dropped. Batches larger than pipeline_chunk are
+        split so a single script call never blocks Redis for long.
+        """
+        results = []
+        for start in range(0, len(updates), self.pipeline_chunk):
+            chunk = updates[start:start + self.pipeline_chunk]
+            try:
+                keys, args = self.update_script_args(chunk)
+                results += self.log_update_results(chunk, self._update_thumbnails(keys=keys, args=args))
+            except Exception as e:
+                logger.error(f"Error updating exercise thumbnails: {e}")
+                results += [False] * len(chunk)
+        return results
+
+    def update_exercise_thumbnail(self, exercise_id: str, thumbnail_uri: str,
+                                  renditions: Optional[Dict[str, str]] = None,
+                                  source: Optional[str] = None) -> bool:
+        """Sets the thumbnail (plus any extra renditions) and clears the pending entry"""
+        return self.update_exercise_thumbnails([(exercise_id, thumbnail_uri, renditions, source)])[0]
+
+    def get_rendition(self, exercise_id: str, name: str) -> Optional[str]:
+        """Returns an extra rendition stored for an exercise"""
         try:
-            # Obține lista completă
-            exercises_data = self.redis.get("exercises:all")
-            if not exercises_data:
-                logger.error("No exercises found in Redis")
-                return False
-                
-            exercises = json.loads(exercises_data)
-            updated = False
-            
-            # Actualizează thumbnail-ul
-            for exercise in exercises:
-                if exercise['id'] == exercise_id:
-                    if 'image' not in exercise:
-                        exercise['image'] = {}
-                    exercise['image']['thumbnail'] = thumbnail_uri
-                    updated = True
-                    break
-                    
-            if updated:
-                # Salvează înapoi în Redis
-                self.redis.set("exercises:all", json.dumps(exercises))
-                # Salvează și în cache-ul individual
-                self.save_thumbnail(exercise_id, thumbnail_uri)
-                logger.info(f"Updated thumbnail for exercise {exercise_id}")
-                return True
-                
-            logger.warning(f"Exercise {exercise_id} not found in list")
+            return self.redis.get(self.rendition_key(exercise_id, name))
+        except Exception as e:
+            logger.error(f"Redis get error: {e}")
+            return None
+
+    @stage_timer('redis_blob_write')
+    def register_thumbnail(self, reference: str, locations: List[str],
+                           blobs: Optional[Dict[str, bytes]] = None) -> bool:
+        """Records the locations a stored thumbnail was written to, so
+        UPDATE_THUMBNAILS_SCRIPT can count references to it and delete them
+        once none is left.
+
+        ``blobs`` are raw thumbnail bytes written in the same script. Until
+        an exercise refers to them they expire after REDIS_TTL.
+        """
+        try:
+            blobs = blobs or {}
+            self._register_thumbnail(
+                keys=[self.refs_key, self.files_key, self.orphans_key, *blobs],
+                args=[self.config.REDIS_TTL or 0, reference, ' '.join(locations), *blobs.values()]
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Redis blob save error: {e}")
             return False
-            
+
+    def thumbnail_alive(self, reference: str) -> bool:
+        """Whether a stored thumbnail can still be committed to an exercise"""
+        try:
+            if not self.redis.hexists(self.refs_key, reference):
+                return False
+            return not reference.startswith(self.blob_prefix) or bool(self.redis.exists(reference))
         except Exception as e:
-            logger.error(f"Error updating exercise thumbnail: {e}")
+            logger.error(f"Error checking thumbnail {reference}: {e}")
             return False
 
+    def take_orphans(self, count: int) -> List[str]:
+        """Pops up to ``count`` released locations whose thumbnail was not
+        stored again since"""
+        try:
+            orphans = [member.split(' ', 1) for member in self.redis.spop(self.orphans_key, count) or []]
+            if not orphans:
+                return []
+            pipe = self.redis.pipeline(transaction=False)
+            for reference, _ in orphans:
+                pipe.hexists(self.refs_key, reference)
+            return [location for (_, location), stored in zip(orphans, pipe.execute()) if not stored]
+        except Exception as e:
+            logger.error(f"Error taking released thumbnails: {e}")
+            return []
+
+    def get_blob(self, key: str) -> Optional[bytes]:
+        try:
+            return self.binary.get(key)
+        except Exception as e:
+            logger.error(f"Redis blob get error: {e}")
+            return None
+
     def get(self, key: str) -> Optional[str]:
         """Metodă generală pentru a obține valori din Redis"""
         try:
@@ -168,4 +1212,4 @@ class RedisService:
             return self.redis.set(key, value, ex=ex)
         except Exception as e:
             logger.error(f"Error setting key {key}: {e}")
-            return False
\ No newline at end of file
+            return False
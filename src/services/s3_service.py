@@ -1,26 +1,204 @@
 import boto3
 import logging
-from typing import Optional
+from botocore.config import Config as BotoConfig
+from contextlib import closing
+from typing import Callable, List, Optional, Tuple, Union
 from src.config import Config
+from src.services.source_cache import CachedSource, SourceCache
+from src.utils.adaptive import is_missing_error, report_if_throttled, report_permanent_failure
+from src.utils.images import (
+    ImageRejected, check_object_size, etag_of, is_partial, object_size, read_capped, read_up_to, sniff_image
+)
+from src.utils.metrics import BYTES, stage_timer
 
 logger = logging.getLogger(__name__)
 
+def client_options(pool_size: int) -> dict:
+    """botocore client settings from Config, shared by the sync and async services"""
+    return dict(
+        max_pool_connections=Config.S3_MAX_POOL_CONNECTIONS or max(10, pool_size),
+        connect_timeout=Config.S3_CONNECT_TIMEOUT,
+        read_timeout=Config.S3_READ_TIMEOUT,
+        retries={'mode': Config.S3_RETRY_MODE, 'total_max_attempts': Config.S3_MAX_ATTEMPTS},
+    )
+
+def downloaded(data: bytes) -> bytes:
+    """Checks a finished download against the size limit and counts it"""
+    check_object_size(len(data))
+    BYTES.labels('in').inc(len(data))
+    return data
+
 class S3Service:
-    def __init__(self):
+    """Wraps one boto3 client shared by every thread of the consumer.
+
+    Clients are thread-safe, sessions are not, so the client is built from
+    a private session up front. The connection pool is sized to the fetch
+    and write threads by default so none of them queue for a socket.
+    """
+
+    def __init__(self, endpoint_url: Optional[str] = None):
         self.config = Config()
-        self.s3_client = boto3.client(
-            's3',
+        pool_size = self.config.PIPELINE_FETCH_WORKERS + self.config.PIPELINE_WRITE_WORKERS
+        session = boto3.session.Session(
             aws_access_key_id=self.config.AWS_ACCESS_KEY_ID,
             aws_secret_access_key=self.config.AWS_SECRET_ACCESS_KEY,
             region_name=self.config.AWS_DEFAULT_REGION
         )
+        self.s3_client = session.client(
+            's3',
+            endpoint_url=endpoint_url or self.config.S3_ENDPOINT_URL,
+            config=BotoConfig(tcp_keepalive=self.config.S3_TCP_KEEPALIVE, **client_options(pool_size))
+        )
+        self.source_cache = SourceCache() if self.config.SOURCE_CACHE_ENABLED else None
+
+    def _get_key(self, image_url: str) -> str:
+        return image_url.split(f'{self.config.AWS_BUCKET_NAME}.s3.amazonaws.com/')[-1]
         
     def get_image(self, image_url: str) -> Optional[bytes]:
+        image_data = self.get_image_with_etag(image_url)[0]
+        return image_data.read() if isinstance(image_data, CachedSource) else image_data
+
+    def get_image_with_etag(self, image_url: str, etag: Optional[str] = None,
+                            skip: Optional[Callable[[str], bool]] = None
+                            ) -> Tuple[Optional[Union[bytes, CachedSource]], Optional[str]]:
+        """Returns an object's body together with its ETag.
+
+        The ETag comes with the ranged sniff GET, so caches are checked
+        without a HEAD: ``skip`` is called with it as soon as it is known,
+        and when it returns True nothing more is downloaded and
+        (None, etag) is returned. A thumbnail cache hit thus costs one small
+        ranged request and a miss no extra one. With the source cache on, a
+        copy on local disk is returned as a CachedSource instead of bytes,
+        with no request at all when ``etag`` already names it. Downloads are
+        written to the cache and returned the same way, falling back to
+        bytes when the write fails. With S3_SNIFF_BYTES off a HEAD stands in
+        for the sniff when a cache needs the ETag.
+        """
         try:
             bucket = self.config.AWS_BUCKET_NAME
-            key = image_url.split(f'{bucket}.s3.amazonaws.com/')[-1]
-            response = self.s3_client.get_object(Bucket=bucket, Key=key)
-            return response['Body'].read()
+            key = self._get_key(image_url)
+            sniffing = self.config.S3_SNIFF_BYTES > 0
+            head, complete = None, False
+            if etag is None:
+                if sniffing:
+                    head, etag, complete = self._sniff(bucket, key)
+                elif skip or (self.source_cache and self.source_cache.contains(bucket, key)):
+                    etag = self.get_etag(image_url)
+            if etag and skip and skip(etag):
+                return None, etag
+            if self.source_cache and (cached := self.source_cache.get(bucket, key, etag)):
+                return cached, etag
+
+            if sniffing and head is None:
+                # The ETag was known up front but is not cached
+                head, etag, complete = self._sniff(bucket, key)
+            if complete:
+                data = head
+            elif head is not None:
+                data = self._download_rest(bucket, key, head, etag)
+            else:
+                data, etag = self._download(bucket, key)
+            if self.source_cache and etag:
+                return self.source_cache.put(bucket, key, etag, data) or data, etag
+            return data, etag
+        except ImageRejected as e:
+            logger.warning(f"Rejected {image_url}: {e}")
+            report_permanent_failure(image_url, str(e))
+            return None, None
         except Exception as e:
+            if is_missing_error(e):
+                report_permanent_failure(image_url, 'not found')
+            else:
+                report_if_throttled(e, 's3')
             logger.error(f"S3 error: {e}")
+            return None, None
+
+    @stage_timer('s3_get')
+    def _sniff(self, bucket: str, key: str) -> Tuple[bytes, Optional[str], bool]:
+        """Ranged read of the first S3_SNIFF_BYTES; returns (head, etag, complete).
+
+        Oversized objects and non-images are rejected before the full
+        download. ``complete`` means the head is the whole object: it fit,
+        or the endpoint ignored Range and answered 200 with all of it, which
+        is then read up to the size cap. Every read has an upper bound.
+        """
+        sniff_bytes = self.config.S3_SNIFF_BYTES
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{sniff_bytes - 1}")
+        etag = etag_of(response)
+        with closing(response['Body']) as body:
+            if not is_partial(response):
+                # Range was ignored: this is the whole object
+                check_object_size(response.get('ContentLength', 0))
+                head = read_up_to(body, sniff_bytes)
+                sniff_image(head)
+                return downloaded(read_capped(body, head)), etag, True
+            head = read_up_to(body, sniff_bytes + 1)
+        size = object_size(response, len(head))
+        check_object_size(size)
+        sniff_image(head)
+        if len(head) >= size:
+            return downloaded(head), etag, True
+        return head, etag, False
+
+    @stage_timer('s3_get')
+    def _download_rest(self, bucket: str, key: str, head: bytes, etag: Optional[str]) -> bytes:
+        """Fetches what follows a sniffed head, pinned to the sniffed version with If-Match"""
+        options = {'IfMatch': f'"{etag}"'} if etag else {}
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(head)}-", **options)
+        with closing(response['Body']) as body:
+            check_object_size(len(head) + response.get('ContentLength', 0))
+            data = read_capped(body, head)
+        return downloaded(data)
+
+    @stage_timer('s3_get')
+    def _download(self, bucket: str, key: str) -> Tuple[bytes, Optional[str]]:
+        """Downloads a whole object and its ETag in one bounded read, for S3_SNIFF_BYTES=0"""
+        response = self.s3_client.get_object(Bucket=bucket, Key=key)
+        with closing(response['Body']) as body:
+            check_object_size(response.get('ContentLength', 0))
+            data = read_capped(body)
+        return downloaded(data), etag_of(response)
+
+    @stage_timer('s3_head')
+    def get_etag(self, image_url: str) -> Optional[str]:
+        """Returns an object's ETag with a HEAD request, without downloading it"""
+        try:
+            bucket = self.config.AWS_BUCKET_NAME
+            response = self.s3_client.head_object(Bucket=bucket, Key=self._get_key(image_url))
+            return response.get('ETag', '').strip('"') or None
+        except Exception as e:
+            report_if_throttled(e, 's3')
+            logger.error(f"S3 head error: {e}")
             return None
+
+    @stage_timer('s3_put')
+    def put_object(self, key: str, data: bytes, content_type: str,
+                   bucket: Optional[str] = None) -> bool:
+        """Uploads raw bytes under a key, by default in the source bucket"""
+        try:
+            self.s3_client.put_object(
+                Bucket=bucket or self.config.AWS_BUCKET_NAME,
+                Key=key,
+                Body=data,
+                ContentType=content_type
+            )
+            return True
+        except Exception as e:
+            report_if_throttled(e, 's3')
+            logger.error(f"S3 upload error: {e}")
+            return False
+
+    def delete_objects(self, keys: List[str], bucket: Optional[str] = None) -> bool:
+        """Deletes up to 1000 keys in one request, by default from the source bucket"""
+        try:
+            response = self.s3_client.delete_objects(
+                Bucket=bucket or self.config.AWS_BUCKET_NAME,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+            for error in response.get('Errors', []):
+                logger.error(f"S3 delete error for {error.get('Key')}: {error.get('Message')}")
+            return not response.get('Errors')
+        except Exception as e:
+            report_if_throttled(e, 's3')
+            logger.error(f"S3 delete error: {e}")
+            return False
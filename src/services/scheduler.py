@@ -0,0 +1,49 @@
+import logging
+from typing import Iterable, Optional
+from src.config import Config
+from src.services.rabbitmq_service import RabbitMQService
+from src.services.redis_service import RedisService
+
+logger = logging.getLogger(__name__)
+
+class ThumbnailScheduler:
+    """Publishes thumbnail work on a bulk and an interactive lane.
+
+    ``trigger_drain`` sends the usual process_exercises trigger to the bulk
+    queue; a burst of them publishes one message until a sync picks it up.
+    ``request_thumbnails`` is for exercises someone is waiting on: the ids
+    go into the exercises:priority set, deduplicated, and a wake-up goes to
+    RABBITMQ_INTERACTIVE_QUEUE. Workers serve that set before every bulk
+    batch or work unit, so a request waits for at most the batch in
+    progress, even in the middle of a full backfill.
+    """
+
+    def __init__(self, rabbitmq_service: Optional[RabbitMQService] = None,
+                 redis_service: Optional[RedisService] = None):
+        self.config = Config()
+        self.rabbitmq_service = rabbitmq_service or RabbitMQService()
+        self.redis_service = redis_service or RedisService()
+
+    def request_thumbnails(self, exercise_ids: Iterable) -> int:
+        """Asks for specific exercises ahead of the backlog; returns how many were not requested already"""
+        exercise_ids = [str(exercise_id) for exercise_id in exercise_ids]
+        added = self.redis_service.prioritize(exercise_ids)
+        if not added:
+            logger.debug(f"Exercises {exercise_ids} are already queued")
+            return 0
+
+        # The ids travel along so the message still works if the set was lost
+        message = {'action': 'process_priority', 'ids': exercise_ids}
+        if not self.rabbitmq_service.publish(self.config.RABBITMQ_INTERACTIVE_QUEUE, message):
+            logger.error(f"Could not publish the request for {exercise_ids}; the next batch still picks it up")
+        return added
+
+    def trigger_drain(self) -> bool:
+        """Publishes process_exercises unless one is still waiting; returns whether it published"""
+        if not self.redis_service.claim_trigger(self.config.TRIGGER_COALESCE_SECONDS):
+            logger.debug("A process_exercises trigger is already waiting, coalescing")
+            return False
+        if self.rabbitmq_service.publish(self.config.RABBITMQ_QUEUE, {'action': 'process_exercises'}):
+            return True
+        self.redis_service.release_trigger()
+        return False
@@ -0,0 +1,198 @@
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+from src.config import Config
+from src.utils.metrics import SOURCE_CACHE_BYTES, SOURCE_CACHE_REQUESTS
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction is then only serialized within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Temp files older than this belong to a writer that died mid-write
+STALE_TEMP_SECONDS = 3600
+
+class SourceEvicted(Exception):
+    """A cached source was evicted between the lookup and the read; fetch it again"""
+
+class CachedSource:
+    """A source image in the disk cache.
+
+    Only the path travels, so handing one to a render process costs a few
+    bytes instead of pickling the whole image. ``open()`` maps the file
+    read-only; Pillow reads it like any file object without a copy of the
+    whole image in the Python heap.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def read(self) -> bytes:
+        with self._open() as f:
+            return f.read()
+
+    @contextmanager
+    def open(self) -> Iterator[mmap.mmap]:
+        with self._open() as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+    def _open(self):
+        # Another consumer's trim may remove the file after get() found it;
+        # once open, it stays readable
+        try:
+            return open(self.path, 'rb')
+        except FileNotFoundError:
+            raise SourceEvicted(f"Cached source {self.path} was evicted before it was read") from None
+
+class SourceCache:
+    """Downloaded source images on local disk, keyed by bucket/key/ETag.
+
+    Every object gets a directory named after its bucket and key holding one
+    file per ETag, so a re-uploaded object replaces its old version instead
+    of sitting next to it. Files are written to a temp file and renamed into
+    place, so readers in other processes see a whole file or none. A hit
+    bumps the file's mtime; once the total size passes SOURCE_CACHE_MAX_BYTES
+    the least recently used files are removed under an flock, so the
+    consumers of a host can share one directory. A file evicted while
+    another process has it mapped stays readable until it is closed; one
+    evicted before it is opened raises SourceEvicted.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.config = Config()
+        self.directory = directory or self.config.SOURCE_CACHE_DIR
+        self.max_bytes = self.config.SOURCE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock_path = os.path.join(self.directory, '.lock')
+        # Bytes on disk at the last scan plus what this process wrote since;
+        # other processes' writes show up at the next scan
+        self._size = None
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def _object_dir(self, bucket: str, key: str) -> str:
+        digest = hashlib.sha1(f"{bucket}/{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    @staticmethod
+    def _file_name(etag: str) -> str:
+        return hashlib.sha1(etag.encode('utf-8')).hexdigest()
+
+    def contains(self, bucket: str, key: str) -> bool:
+        """Whether any version of an object is cached, i.e. worth revalidating"""
+        return os.path.isdir(self._object_dir(bucket, key))
+
+    def get(self, bucket: str, key: str, etag: Optional[str]) -> Optional[CachedSource]:
+        """Returns the cached copy of one version of an object; no ETag counts as a miss"""
+        source = None
+        if etag:
+            path = os.path.join(self._object_dir(bucket, key), self._file_name(etag))
+            try:
+                size = os.stat(path).st_size
+                # Marks it recently used for the eviction scan
+                os.utime(path)
+                source = CachedSource(path, size)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Source cache read error: {e}")
+        SOURCE_CACHE_REQUESTS.labels('hit' if source else 'miss').inc()
+        return source
+
+    def put(self, bucket: str, key: str, etag: str, data: bytes) -> Optional[CachedSource]:
+        """Stores a downloaded object; returns None when it could not be written"""
+        if not data or len(data) > self.max_bytes:
+            return None
+        object_dir = self._object_dir(bucket, key)
+        name = self._file_name(etag)
+        try:
+            os.makedirs(object_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=object_dir, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, os.path.join(object_dir, name))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+            # Older versions of the object are dead weight
+            for other in os.listdir(object_dir):
+                if other != name and not other.startswith('.'):
+                    self._remove(os.path.join(object_dir, other))
+        except OSError as e:
+            logger.error(f"Source cache write error: {e}")
+            return None
+
+        with self._lock:
+            self._written += len(data)
+            if self._size is not None:
+                self._size += len(data)
+            trim = self._size is None or self._size > self.max_bytes or self._written > self.max_bytes // 10
+        if trim:
+            self.trim()
+        return CachedSource(os.path.join(object_dir, name), len(data))
+
+    def trim(self):
+        """Rescans the cache and evicts least recently used files down to 90% of the limit"""
+        with self._lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                files, size = self._scan()
+                if size > self.max_bytes:
+                    target = self.max_bytes * 9 // 10
+                    for _, file_size, path in sorted(files):
+                        if size <= target:
+                            break
+                        if self._remove(path):
+                            size -= file_size
+                self._size, self._written = size, 0
+                SOURCE_CACHE_BYTES.set(size)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _scan(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        files, size = [], 0
+        now = time.time()
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith('.tmp-'):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        self._remove(path)
+                    continue
+                if name.startswith('.'):
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                size += stat.st_size
+        return files, size
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.rmdir(os.path.dirname(path))  # only succeeds once the object's directory is empty
+        except OSError:
+            pass
+        return True
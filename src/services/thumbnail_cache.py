@@ -0,0 +1,80 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+from src.config import Config
+from src.services.redis_service import RedisService
+from src.utils.codec import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Bump when the encoded output changes for the same source and parameters
+THUMBNAIL_VERSION = 2
+
+class ThumbnailCache:
+    """Content-addressed cache of encoded renditions.
+
+    Entries are keyed by the source object's ETag plus the rendition
+    parameters, so a source shared by many exercises (or re-uploaded under
+    another key with identical content) is decoded once. Lookups hit an
+    in-process LRU bounded by total bytes first, then Redis with a TTL.
+    """
+
+    def __init__(self, redis_service: RedisService):
+        self.config = Config()
+        self.redis = redis_service.redis
+        self.key_prefix = "thumbnail:cache:"
+        self.ttl = self.config.THUMBNAIL_CACHE_TTL
+        self.max_bytes = self.config.THUMBNAIL_CACHE_LRU_BYTES
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(etag: str, signature: str, reducing_gap: Optional[float]) -> str:
+        raw = f"{etag}|{signature}|gap={reducing_gap}|v{THUMBNAIL_VERSION}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, str]]:
+        """Returns the cached renditions (name -> data URI) for a fingerprint"""
+        with self._lock:
+            payload = self._entries.get(fingerprint)
+            if payload is not None:
+                self._entries.move_to_end(fingerprint)
+
+        if payload is None:
+            try:
+                payload = self.redis.get(f"{self.key_prefix}{fingerprint}")
+            except Exception as e:
+                logger.error(f"Thumbnail cache read error: {e}")
+                return None
+            if payload is None:
+                return None
+            self._remember(fingerprint, payload)
+
+        return loads(payload)
+
+    def put(self, fingerprint: str, renditions: Dict[str, str]):
+        payload = dumps(renditions)
+        self._remember(fingerprint, payload)
+        try:
+            self.redis.set(f"{self.key_prefix}{fingerprint}", payload, ex=self.ttl or None)
+        except Exception as e:
+            logger.error(f"Thumbnail cache write error: {e}")
+
+    def _remember(self, fingerprint: str, payload: str):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(fingerprint, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[fingerprint] = payload
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
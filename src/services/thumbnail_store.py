@@ -0,0 +1,89 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+from src.config import Config
+from src.services.image_processor import Rendition
+from src.services.redis_service import RedisService
+from src.services.s3_service import S3Service
+
+logger = logging.getLogger(__name__)
+
+class RedisThumbnailStore:
+    """Keeps raw rendition bytes under thumbnail:blob:<owner>:<name>.<ext>.
+
+    The exercise record only holds the key; readers fetch the bytes with
+    ``RedisService.get_blob``. Blobs expire after REDIS_TTL until an
+    exercise commits them, then stay until no exercise refers to them.
+    """
+
+    def __init__(self, redis_service: RedisService):
+        self.redis_service = redis_service
+        self.location = f"redis:{redis_service.blob_prefix}"
+
+    def put(self, owner: str, encoded: List[Tuple[Rendition, bytes]]) -> Optional[Dict[str, str]]:
+        """Writes the renditions, the exercise thumbnail first"""
+        keys = {
+            rendition.name: f"{self.redis_service.blob_prefix}{owner}:{rendition.name}.{rendition.extension}"
+            for rendition, _ in encoded
+        }
+        blobs = {keys[rendition.name]: data for rendition, data in encoded}
+        registered = self.redis_service.register_thumbnail(next(iter(blobs)), list(blobs), blobs)
+        return keys if registered else None
+
+    def alive(self, thumbnail: str) -> bool:
+        """Whether a cached thumbnail key can still be committed"""
+        return self.redis_service.thumbnail_alive(thumbnail)
+
+class S3ThumbnailStore:
+    """Uploads rendition bytes to <prefix><owner>/<name>.<ext> and returns their URLs.
+
+    Objects no exercise refers to any more are queued in Redis and deleted
+    a batch at a time after later uploads.
+    """
+
+    def __init__(self, s3_service: S3Service, redis_service: RedisService):
+        self.config = Config()
+        self.s3_service = s3_service
+        self.redis_service = redis_service
+        self.delete_batch = 100
+        self.bucket = self.config.THUMBNAIL_S3_BUCKET
+        self.prefix = self.config.THUMBNAIL_S3_PREFIX
+        self.url_base = self.config.THUMBNAIL_URL_BASE or f"https://{self.bucket}.s3.amazonaws.com/"
+        if not self.url_base.endswith('/'):
+            self.url_base += '/'
+        self.location = f"s3:{self.bucket}/{self.prefix}"
+
+    def put(self, owner: str, encoded: List[Tuple[Rendition, bytes]]) -> Optional[Dict[str, str]]:
+        urls = {}
+        for rendition, data in encoded:
+            key = f"{self.prefix}{owner}/{rendition.name}.{rendition.extension}"
+            if not self.s3_service.put_object(key, data, rendition.mime_type, bucket=self.bucket):
+                return None
+            urls[rendition.name] = f"{self.url_base}{key}"
+        if not self.redis_service.register_thumbnail(next(iter(urls.values())), list(urls.values())):
+            return None
+        self.delete_released()
+        return urls
+
+    def alive(self, thumbnail: str) -> bool:
+        """Whether a cached thumbnail URL can still be committed"""
+        return self.redis_service.thumbnail_alive(thumbnail)
+
+    def delete_released(self):
+        """Deletes objects of thumbnails whose last reference was replaced"""
+        keys = [
+            url[len(self.url_base):]
+            for url in self.redis_service.take_orphans(self.delete_batch) if url.startswith(self.url_base)
+        ]
+        if keys and self.s3_service.delete_objects(keys, bucket=self.bucket):
+            logger.debug("Deleted %d released thumbnail objects", len(keys))
+
+def create_thumbnail_store(mode: str, redis_service: RedisService,
+                           s3_service: Optional[S3Service] = None):
+    """Builds the store for THUMBNAIL_STORAGE; None means inline data URIs"""
+    if mode == 'inline':
+        return None
+    if mode == 'redis':
+        return RedisThumbnailStore(redis_service)
+    if mode == 's3':
+        return S3ThumbnailStore(s3_service or S3Service(), redis_service)
+    raise ValueError(f"Unsupported thumbnail storage: {mode}")
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import signal
+import time
+from src.config import Config
+from src.utils.logger import setup_logger
+
+
+class WorkerStats:
+    """Success/failure counters a worker shares with the supervisor"""
+
+    def __init__(self, ctx):
+        self.succeeded = ctx.Value('Q', 0)
+        self.failed = ctx.Value('Q', 0)
+
+    def record(self, succeeded: int, failed: int):
+        with self.succeeded.get_lock():
+            self.succeeded.value += succeeded
+        with self.failed.get_lock():
+            self.failed.value += failed
+
+    def snapshot(self):
+        return self.succeeded.value, self.failed.value
+
+
+def run_worker(index: int, stats: WorkerStats, work_mode: str):
+    """Entry point of a supervised consumer process"""
+    # Ctrl-C reaches the whole process group; let the supervisor decide
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Config.WORK_MODE = work_mode
+
+    # N workers each with a cpu_count-sized pool would oversubscribe the host
+    if 'PIPELINE_PROCESS_WORKERS' not in os.environ:
+        Config.PIPELINE_PROCESS_WORKERS = 1
+    # Each worker serves its own /metrics on consecutive ports
+    if Config.METRICS_PORT:
+        Config.METRICS_PORT += index
+
+    from src.consumer import ImageConsumer
+    consumer = ImageConsumer(stats=stats)
+    signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop())
+    consumer.run()
+
+
+class WorkerSlot:
+    def __init__(self, index: int, stats: WorkerStats):
+        self.index = index
+        self.stats = stats
+        self.process = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = None
+        self.last_snapshot = (0, 0)
+
+
+class WorkerSupervisor:
+    """Runs N ImageConsumer processes, restarting crashed ones with backoff.
+
+    Each worker opens its own RabbitMQ, Redis and S3 connections. On SIGTERM
+    or SIGINT the supervisor forwards SIGTERM so workers finish their
+    in-flight message before exiting. With more than one worker they run in
+    fanout mode: a drain is carried out by whichever worker receives the
+    trigger, leaving the others idle.
+    """
+
+    # A worker that stays up this long is considered healthy again
+    STABLE_AFTER = 60
+
+    def __init__(self, worker_count: int = None):
+        self.logger = setup_logger('WorkerSupervisor')
+        self.config = Config()
+        self.worker_count = max(1, worker_count or self.config.WORKER_COUNT)
+        self.ctx = multiprocessing.get_context('spawn')
+        self.slots = [WorkerSlot(i, WorkerStats(self.ctx)) for i in range(self.worker_count)]
+        self.work_mode = self.config.WORK_MODE
+        if self.worker_count > 1 and self.work_mode != 'fanout':
+            self.logger.warning(
+                f"WORK_MODE={self.work_mode} keeps all but one of {self.worker_count} workers idle, "
+                f"running them in fanout mode"
+            )
+            self.work_mode = 'fanout'
+        self.stopping = False
+        self.last_report = time.monotonic()
+
+    def _handle_signal(self, signum, frame):
+        self.logger.info(f"Received signal {signum}, draining workers...")
+        self.stopping = True
+
+    def _start_worker(self, slot: WorkerSlot):
+        slot.process = self.ctx.Process(
+            target=run_worker,
+            args=(slot.index, slot.stats, self.work_mode),
+            name=f"consumer-{slot.index}"
+        )
+        slot.process.start()
+        slot.started_at = time.monotonic()
+        slot.restart_at = None
+        self.logger.info(f"Started worker {slot.index} (pid {slot.process.pid})")
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for slot in self.slots:
+            if slot.process.is_alive():
+                if slot.failures and now - slot.started_at > self.STABLE_AFTER:
+                    slot.failures = 0
+                continue
+
+            if slot.restart_at is None:
+                slot.failures += 1
+                delay = min(
+                    self.config.WORKER_RESTART_BACKOFF * 2 ** (slot.failures - 1),
+                    self.config.WORKER_RESTART_MAX_BACKOFF
+                )
+                slot.restart_at = now + delay
+                self.logger.warning(
+                    f"Worker {slot.index} exited with code {slot.process.exitcode}, "
+                    f"restarting in {delay:.1f}s"
+                )
+            elif now >= slot.restart_at:
+                self._start_worker(slot)
+
+    def _report_stats(self, final: bool = False):
+        now = time.monotonic()
+        elapsed = max(now - self.last_report, 1e-6)
+        total_rate = 0.0
+        total_succeeded = total_failed = 0
+
+        for slot in self.slots:
+            succeeded, failed = slot.stats.snapshot()
+            rate = (succeeded - slot.last_snapshot[0]) / elapsed
+            slot.last_snapshot = (succeeded, failed)
+            total_rate += rate
+            total_succeeded += succeeded
+            total_failed += failed
+            self.logger.debug(f"Worker {slot.index}: {succeeded} ok, {failed} failed, {rate:.2f} img/s")
+
+        label = "Final stats" if final else "Throughput"
+        self.logger.info(
+            f"{label} - {total_succeeded} processed, {total_failed} failed, "
+            f"{total_rate:.2f} img/s across {self.worker_count} workers"
+        )
+        self.last_report = now
+
+    def _shutdown(self):
+        for slot in self.slots:
+            if slot.process and slot.process.is_alive():
+                slot.process.terminate()
+
+        deadline = time.monotonic() + self.config.WORKER_SHUTDOWN_TIMEOUT
+        for slot in self.slots:
+            if slot.process is None:
+                continue
+            slot.process.join(max(0.0, deadline - time.monotonic()))
+            if slot.process.is_alive():
+                self.logger.warning(f"Worker {slot.index} did not drain in time, killing it")
+                slot.process.kill()
+                slot.process.join()
+
+        self._report_stats(final=True)
+        self.logger.info("All workers stopped")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+        self.logger.info(f"Starting {self.worker_count} consumer workers...")
+        for slot in self.slots:
+            self._start_worker(slot)
+
+        while not self.stopping:
+            self._check_workers()
+            if time.monotonic() - self.last_report >= self.config.SUPERVISOR_STATS_INTERVAL:
+                self._report_stats()
+            time.sleep(1)
+
+        self._shutdown()
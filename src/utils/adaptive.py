@@ -0,0 +1,153 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+from src.config import Config
+from src.utils.metrics import BACKOFF_SECONDS, BATCH_LIMIT, CONCURRENCY_LIMIT, THROTTLES
+
+logger = logging.getLogger(__name__)
+
+# Error codes S3 (and S3-compatible stores) answer with when asked to slow down
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests'}
+# ... and when the object is not there at all
+MISSING_CODES = {'NoSuchKey', 'NoSuchBucket', 'NotFound', '404'}
+# Unclaimed permanent failures kept at most (e.g. from callers that never ask)
+MAX_PERMANENT_FAILURES = 10000
+
+_throttles = 0
+_throttles_lock = threading.Lock()
+# S3 key -> reason, for sources that can never be rendered
+_permanent = OrderedDict()
+_permanent_lock = threading.Lock()
+
+def is_throttle_error(error: Exception) -> bool:
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLE_CODES or status in (429, 503)
+
+def report_if_throttled(error: Exception, source: str) -> bool:
+    """Counts a throttling response; controllers back off on the next update"""
+    global _throttles
+    if not is_throttle_error(error):
+        return False
+    THROTTLES.labels(source).inc()
+    with _throttles_lock:
+        _throttles += 1
+    return True
+
+def throttle_count() -> int:
+    return _throttles
+
+def is_missing_error(error: Exception) -> bool:
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in MISSING_CODES or status == 404
+
+def report_permanent_failure(key: str, reason: str):
+    """Records a source that fails the same way on every attempt: missing, rejected or undecodable.
+
+    Such failures say nothing about load, so controllers leave them out,
+    and the batch that ran the job dead-letters it straight away.
+    """
+    with _permanent_lock:
+        _permanent[key] = reason
+        _permanent.move_to_end(key)
+        while len(_permanent) > MAX_PERMANENT_FAILURES:
+            _permanent.popitem(last=False)
+
+def take_permanent_failures(jobs: Iterable[Tuple[str, str]]) -> List[str]:
+    """Ids of the (exercise_id, s3_key) jobs whose source was reported as permanently broken"""
+    jobs = list(jobs)
+    with _permanent_lock:
+        failed = [exercise_id for exercise_id, key in jobs if key in _permanent]
+        for _, key in jobs:
+            _permanent.pop(key, None)
+    return failed
+
+class AdaptiveController:
+    """AIMD limits for the drain batch size, jobs in flight and the pause between batches.
+
+    After every batch the limits grow by a quarter (concurrency by one) and
+    the pause halves, as long as nothing signals overload: S3 throttling, a
+    Redis read slower than REDIS_LATENCY_LIMIT, a failure rate above
+    ADAPTIVE_MAX_ERROR_RATE, or per-job latency beyond
+    ADAPTIVE_LATENCY_TOLERANCE times its healthy average. Any of those
+    halves the limits and doubles the pause. Permanent failures (see
+    report_permanent_failure) count towards none of them. With
+    ADAPTIVE_ENABLED off the limits stay fixed and the pause is the old
+    0.1 s (1 s after a batch where everything failed).
+    """
+
+    def __init__(self, batch_size: int, concurrency: int):
+        self.config = Config()
+        self.enabled = self.config.ADAPTIVE_ENABLED
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.max_batch_size = max(self.batch_size, self.config.ADAPTIVE_MAX_BATCH_SIZE)
+        self.max_concurrency = max(self.concurrency, self.config.ADAPTIVE_MAX_IN_FLIGHT or 4 * self.concurrency)
+        self.delay = 0.0
+        # Running average of per-job latency over healthy batches
+        self.baseline = None
+        self._throttles = throttle_count()
+        self._redis_latency = 0.0
+        self._publish()
+
+    def observe_redis(self, seconds: float):
+        """Records a Redis round-trip timed by the caller; the slowest one per batch counts"""
+        self._redis_latency = max(self._redis_latency, seconds)
+
+    def update(self, jobs: int, failed: int, elapsed: float, permanent: int = 0) -> str:
+        """Feeds back one finished batch; returns why it backed off, or '' if it did not.
+
+        ``permanent`` of the ``failed`` jobs failed because of their source
+        image, not the load.
+        """
+        throttles = throttle_count()
+        throttled, self._throttles = throttles - self._throttles, throttles
+        redis_latency, self._redis_latency = self._redis_latency, 0.0
+        jobs, failed = jobs - permanent, failed - permanent
+
+        if not self.enabled:
+            self.delay = 1.0 if jobs and failed == jobs else 0.1
+            self._publish()
+            return ''
+
+        # Each job shared the batch's wall time with up to `concurrency` others
+        latency = elapsed * min(self.concurrency, max(1, jobs)) / max(1, jobs)
+        reason = ''
+        if throttled:
+            reason = f"{throttled} S3 throttling responses"
+        elif redis_latency > self.config.REDIS_LATENCY_LIMIT:
+            reason = f"Redis latency {redis_latency * 1000:.0f} ms"
+        elif jobs and failed / jobs > self.config.ADAPTIVE_MAX_ERROR_RATE:
+            reason = f"{failed}/{jobs} jobs failed"
+        elif jobs and self.baseline and latency > self.baseline * self.config.ADAPTIVE_LATENCY_TOLERANCE:
+            reason = f"job latency {latency * 1000:.0f} ms over the {self.baseline * 1000:.0f} ms average"
+
+        if reason:
+            self.batch_size = max(1, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+            self.delay = min(self.config.ADAPTIVE_MAX_BACKOFF, max(0.5, self.delay * 2))
+            logger.warning(f"Backing off ({reason}): {self.describe()}")
+        elif jobs:
+            self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+            self.batch_size = min(self.max_batch_size, math.ceil(self.batch_size * 1.25))
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.delay = self.delay / 2 if self.delay > 0.05 else 0.0
+
+        self._publish()
+        return reason
+
+    def snapshot(self) -> Dict[str, float]:
+        return {'batch_size': self.batch_size, 'concurrency': self.concurrency, 'delay': round(self.delay, 3)}
+
+    def describe(self) -> str:
+        return f"batch size {self.batch_size}, concurrency {self.concurrency}, pause {self.delay:.2f}s"
+
+    def _publish(self):
+        BATCH_LIMIT.set(self.batch_size)
+        CONCURRENCY_LIMIT.set(self.concurrency)
+        BACKOFF_SECONDS.set(self.delay)
@@ -0,0 +1,68 @@
+import json
+from typing import Any, Dict, List, Optional, Union
+from src.config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Formats exercises:all can be written in; reads detect the format, so
+# producers and readers can switch one at a time
+CATALOG_FORMATS = ('json', 'msgpack', 'msgpack+zstd')
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def dumps(value: Any) -> str:
+    """Compact JSON text; the stdlib fallback matches orjson's output byte for byte"""
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+def loads(data: Union[str, bytes]) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def check_format(fmt: str):
+    """Raises ValueError when a catalog format is unknown or its library is missing"""
+    if fmt not in CATALOG_FORMATS:
+        raise ValueError(f"Unsupported catalog format: {fmt}")
+    if fmt.startswith('msgpack') and msgpack is None:
+        raise ValueError(f"Catalog format {fmt} needs the msgpack package")
+    if fmt.endswith('+zstd') and zstandard is None:
+        raise ValueError(f"Catalog format {fmt} needs the zstandard package")
+
+def detect_format(raw: bytes) -> str:
+    if raw.startswith(ZSTD_MAGIC):
+        return 'msgpack+zstd'
+    if raw.lstrip()[:1] in (b'[', b'{'):
+        return 'json'
+    return 'msgpack'
+
+def encode_catalog(exercises: List[Dict], fmt: str = 'json') -> bytes:
+    if fmt == 'json':
+        return dumps(exercises).encode('utf-8')
+    packed = msgpack.packb(exercises, use_bin_type=True)
+    if fmt == 'msgpack+zstd':
+        return zstandard.ZstdCompressor(level=Config.CATALOG_ZSTD_LEVEL).compress(packed)
+    return packed
+
+def decode_catalog(raw: Optional[bytes]) -> Optional[List[Dict]]:
+    """Decodes exercises:all in whichever format it was written"""
+    if not raw:
+        return None
+    fmt = detect_format(raw)
+    check_format(fmt)
+    if fmt == 'json':
+        return loads(raw)
+    if fmt == 'msgpack+zstd':
+        raw = zstandard.ZstdDecompressor().decompress(raw)
+    return msgpack.unpackb(raw, raw=False)
@@ -0,0 +1,122 @@
+import io
+from typing import Optional, Tuple
+from PIL import Image
+from src.config import Config
+
+# Leading bytes of the formats we decode, for prefixes too short for Pillow
+# to parse the whole header (e.g. a JPEG with a large EXIF block)
+IMAGE_SIGNATURES = (
+    b'\xff\xd8\xff',        # JPEG
+    b'\x89PNG\r\n\x1a\n',   # PNG
+    b'GIF87a', b'GIF89a',
+    b'BM',
+    b'II*\x00', b'MM\x00*',  # TIFF
+)
+
+class ImageRejected(ValueError):
+    """A source refused before it is downloaded in full or decoded"""
+
+def check_object_size(size: int):
+    max_bytes = Config.S3_MAX_OBJECT_BYTES
+    if max_bytes and size > max_bytes:
+        raise ImageRejected(f"object is {size} bytes, over S3_MAX_OBJECT_BYTES ({max_bytes})")
+
+def check_pixels(size: Tuple[int, int]):
+    max_pixels = Config.IMAGE_MAX_PIXELS
+    if max_pixels and size[0] * size[1] > max_pixels:
+        raise ImageRejected(
+            f"{size[0]}x{size[1]} is over IMAGE_MAX_PIXELS ({max_pixels}), possible decompression bomb"
+        )
+
+def has_image_signature(head: bytes) -> bool:
+    return (head.startswith(IMAGE_SIGNATURES)
+            or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+            or head[4:8] == b'ftyp')  # AVIF / HEIF
+
+def sniff_image(head: bytes) -> Optional[str]:
+    """Checks the first bytes of a source before committing to a full download.
+
+    Returns the format when Pillow can read the header (its dimensions are
+    checked too), None when the header is cut off but the signature is
+    known. Raises ImageRejected for anything else.
+    """
+    try:
+        with Image.open(io.BytesIO(head)) as img:
+            check_pixels(img.size)
+            return img.format
+    except ImageRejected:
+        raise
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(str(e))
+    except Exception:
+        if has_image_signature(head):
+            return None
+        raise ImageRejected("not a recognised image format")
+
+def etag_of(response: dict) -> Optional[str]:
+    return response.get('ETag', '').strip('"') or None
+
+def is_partial(response: dict) -> bool:
+    """Whether a ranged GET was answered with the range (206) rather than the whole object"""
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status == 206 if status else 'ContentRange' in response
+
+# Size of each read of a response body; reads may return less (aiohttp
+# hands back only what is buffered), so bodies are read in a loop
+READ_CHUNK_BYTES = 1 << 20
+
+def _read_limit(already: int) -> Optional[int]:
+    """Bytes still worth reading: one past what S3_MAX_OBJECT_BYTES allows"""
+    max_bytes = Config.S3_MAX_OBJECT_BYTES
+    return max(0, max_bytes - already) + 1 if max_bytes else None
+
+def _next_read(limit: Optional[int]) -> int:
+    return READ_CHUNK_BYTES if limit is None else min(READ_CHUNK_BYTES, limit)
+
+def read_up_to(body, size: int) -> bytes:
+    """Reads ``size`` bytes, or fewer when the body ends first"""
+    chunks, remaining = [], size
+    while remaining > 0 and (chunk := body.read(remaining)):
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+async def read_up_to_async(body, size: int) -> bytes:
+    """read_up_to for aiobotocore streams"""
+    chunks, remaining = [], size
+    while remaining > 0 and (chunk := await body.read(remaining)):
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def read_capped(body, head: bytes = b'') -> bytes:
+    """Reads the rest of a body after ``head``, at most one byte past what
+    S3_MAX_OBJECT_BYTES still allows, and returns it joined to ``head``"""
+    chunks, limit = [head], _read_limit(len(head))
+    while limit is None or limit > 0:
+        chunk = body.read(_next_read(limit))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if limit is not None:
+            limit -= len(chunk)
+    return b''.join(chunks)
+
+async def read_capped_async(body, head: bytes = b'') -> bytes:
+    """read_capped for aiobotocore streams"""
+    chunks, limit = [head], _read_limit(len(head))
+    while limit is None or limit > 0:
+        chunk = await body.read(_next_read(limit))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if limit is not None:
+            limit -= len(chunk)
+    return b''.join(chunks)
+
+def object_size(response: dict, received: int) -> int:
+    """Full object size from a ranged GET's Content-Range header"""
+    content_range = response.get('ContentRange')
+    if content_range and '/' in content_range:
+        return int(content_range.rsplit('/', 1)[1])
+    return received
@@ -0,0 +1,93 @@
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+S3_HOST_MARKER = 'proveit-exercises-directories.s3'
+S3_URL_PREFIX = 'proveit-exercises-directories.s3.amazonaws.com/'
+
+def get_s3_key(image_url: str) -> Optional[str]:
+    """Extracts the object key from an exercise image URL, or None if it is not ours"""
+    if S3_HOST_MARKER not in image_url:
+        return None
+    return image_url.split('?')[0].split(S3_URL_PREFIX)[1]
+
+def build_jobs(exercises: List[Dict], logger: logging.Logger) -> List[Tuple[str, str]]:
+    """Turns exercises into (exercise_id, s3_key) pairs, skipping unusable ones"""
+    jobs = []
+    for exercise in exercises:
+        try:
+            exercise_id = exercise['id']
+            image_url = exercise.get('image', {}).get('uri')
+
+            if not image_url:
+                logger.warning(f"No image URL for exercise {exercise_id}")
+                continue
+
+            path_parts = get_s3_key(image_url)
+            if path_parts is None:
+                logger.warning(f"Skipping {exercise_id} - Invalid S3 URL")
+                continue
+
+            jobs.append((exercise_id, path_parts))
+
+        except Exception as e:
+            logger.error(f"Error processing exercise {exercise.get('id', 'unknown')}: {str(e)}", exc_info=True)
+            continue
+
+    logger.debug("Built %d jobs from %d exercises", len(jobs), len(exercises))
+    return jobs
+
+def skipped_ids(exercises: List[Dict], jobs: List[Tuple[str, str]]) -> List[str]:
+    """Ids of exercises build_jobs could not turn into a job"""
+    queued = {str(exercise_id) for exercise_id, _ in jobs}
+    return [str(exercise['id']) for exercise in exercises
+            if 'id' in exercise and str(exercise['id']) not in queued]
+
+def retry_headers(headers: Optional[Dict], error: Exception, max_attempts: int) -> Tuple[Dict, bool]:
+    """Headers for redelivering a failed message, and whether it is out of attempts.
+
+    A body that is not valid JSON can never succeed, so it uses up every
+    attempt at once.
+    """
+    headers = dict(headers or {})
+    attempts = int(headers.get('x-attempts', 0)) + 1
+    if isinstance(error, json.JSONDecodeError):
+        attempts = max(attempts, max_attempts)
+    headers['x-attempts'] = attempts
+    headers['x-last-error'] = f"{type(error).__name__}: {error}"[:500]
+    return headers, attempts >= max_attempts
+
+def build_work_units(jobs: List[Tuple[str, str]], unit_size: int) -> List[Dict]:
+    """Groups jobs into process_thumbnails messages of at most unit_size jobs"""
+    unit_size = max(1, unit_size)
+    return [
+        {'action': 'process_thumbnails', 'jobs': [list(job) for job in jobs[i:i + unit_size]]}
+        for i in range(0, len(jobs), unit_size)
+    ]
+
+class MaterializeSchedule:
+    """Spaces out rewrites of exercises:all during a long run.
+
+    ``due()`` is called once per batch or work unit and returns True every
+    ``batches`` calls or ``seconds`` seconds, whichever comes first, so
+    readers of the blob see progress before the run ends; 0 turns a limit
+    off.
+    """
+
+    def __init__(self, batches: int, seconds: float):
+        self.batches = max(0, batches)
+        self.seconds = max(0.0, seconds)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.since = time.monotonic()
+
+    def due(self) -> bool:
+        self.count += 1
+        if ((self.batches and self.count >= self.batches)
+                or (self.seconds and time.monotonic() - self.since >= self.seconds)):
+            self.reset()
+            return True
+        return False
@@ -1,49 +1,102 @@
+import atexit
+import itertools
+import json
 import logging
+import queue
 import sys
 import os
-from logging.handlers import RotatingFileHandler
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from src.config import Config
 
-def setup_logger(name='ImageConsumer'):
+_handlers = None
+_queue_handler = None
+_listener = None
+_lock = threading.Lock()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'file': f"{record.filename}:{record.lineno}",
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LazyQueueHandler(QueueHandler):
+    """Enqueues records untouched so %-formatting happens on the listener thread.
+
+    The stock QueueHandler formats in the caller to make records picklable;
+    the queue here never leaves the process, so that work can be deferred.
+    Arguments must therefore not be mutated after the log call.
     """
-    Configurează un logger cu output în consolă și fișier,
-    cu rotație automată și niveluri diferite pentru consolă și fișier
+
+    def prepare(self, record):
+        return record
+
+class SampledLogger:
+    """Passes one in every ``every`` info/debug calls through to a logger.
+
+    For per-image lines on hot paths; warnings and errors are never sampled.
     """
+
+    def __init__(self, logger: logging.Logger, every: int = None):
+        self.logger = logger
+        self.every = max(1, every if every is not None else Config.LOG_SAMPLE_RATE)
+        self._calls = itertools.count()
+
+    def _sampled(self, level: int) -> bool:
+        return next(self._calls) % self.every == 0 and self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args):
+        if self._sampled(logging.DEBUG):
+            self.logger.debug(msg, *args)
+
+    def info(self, msg, *args):
+        if self._sampled(logging.INFO):
+            self.logger.info(msg, *args)
+
+    def warning(self, msg, *args, **kwargs):
+        self.logger.warning(msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.logger.error(msg, *args, **kwargs)
+
+def _build_handlers():
     # Crează directorul pentru loguri dacă nu există
     log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs')
     os.makedirs(log_dir, exist_ok=True)
-    
+
     # Calea completă către fișierul de log
     log_file = os.path.join(log_dir, 'consumer.log')
 
-    # Crează logger-ul
-    logger = logging.getLogger(name)
-    
-    # Verifică dacă logger-ul are deja handlere pentru a evita duplicarea
-    if logger.handlers:
-        return logger
-        
-    logger.setLevel(logging.DEBUG)  # Set la DEBUG pentru a permite toate nivelurile
-
-    # Oprește propagarea pentru a evita duplicarea
-    logger.propagate = False
-
-    # Format detaliat pentru loguri
-    detailed_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    if Config.LOG_FORMAT == 'json':
+        detailed_formatter = console_formatter = JsonFormatter()
+    else:
+        # Format detaliat pentru loguri
+        detailed_formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
 
-    # Format simplu pentru consolă
-    console_formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%H:%M:%S'
-    )
+        # Format simplu pentru consolă
+        console_formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s',
+            datefmt='%H:%M:%S'
+        )
 
     # Handler pentru consolă (doar INFO și erori)
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(console_formatter)
-    logger.addHandler(console_handler)
 
     # Handler pentru fișier (toate mesajele, inclusiv DEBUG)
     file_handler = RotatingFileHandler(
@@ -54,7 +107,6 @@ def setup_logger(name='ImageConsumer'):
     )
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(detailed_formatter)
-    logger.addHandler(file_handler)
 
     # Adaugă și un handler special pentru erori
     error_file = os.path.join(log_dir, 'error.log')
@@ -66,7 +118,47 @@ def setup_logger(name='ImageConsumer'):
     )
     error_handler.setLevel(logging.ERROR)
     error_handler.setFormatter(detailed_formatter)
-    logger.addHandler(error_handler)
+
+    return [console_handler, file_handler, error_handler]
+
+def _logger_handlers():
+    """Handlers shared by every logger of the process.
+
+    One set per process, so loggers no longer rotate the same file from
+    separate handlers. With LOG_ASYNC they sit behind a single queue drained
+    by a QueueListener thread and callers only pay for an enqueue.
+    """
+    global _handlers, _queue_handler, _listener
+    with _lock:
+        if _handlers is None:
+            _handlers = _build_handlers()
+            if Config.LOG_ASYNC:
+                log_queue = queue.SimpleQueue()
+                _queue_handler = LazyQueueHandler(log_queue)
+                _listener = QueueListener(log_queue, *_handlers, respect_handler_level=True)
+                _listener.start()
+                atexit.register(_listener.stop)
+        return [_queue_handler] if _queue_handler else _handlers
+
+def setup_logger(name='ImageConsumer'):
+    """
+    Configurează un logger cu output în consolă și fișier,
+    cu rotație automată și niveluri diferite pentru consolă și fișier
+    """
+    # Crează logger-ul
+    logger = logging.getLogger(name)
+
+    # Verifică dacă logger-ul are deja handlere pentru a evita duplicarea
+    if logger.handlers:
+        return logger
+
+    logger.setLevel(logging.DEBUG)  # Set la DEBUG pentru a permite toate nivelurile
+
+    # Oprește propagarea pentru a evita duplicarea
+    logger.propagate = False
+
+    for handler in _logger_handlers():
+        logger.addHandler(handler)
 
     logger.debug("Logger initialized with console and file handlers")
-    return logger
\ No newline at end of file
+    return logger
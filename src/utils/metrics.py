@@ -0,0 +1,63 @@
+import logging
+import time
+from typing import Dict, Optional
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from src.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Stages: s3_get, s3_head, s3_put, decode_resize, encode, render, publish,
+# redis_read, redis_write, redis_blob_write, job (end to end)
+STAGE_SECONDS = Histogram(
+    'thumbnail_stage_seconds', 'Time spent in each processing stage', ['stage'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+IMAGES = Counter('thumbnail_images_total', 'Exercises handled, by outcome', ['outcome'])
+BYTES = Counter('thumbnail_bytes_total', 'Image bytes downloaded (in) and encoded (out)', ['direction'])
+CACHE_REQUESTS = Counter('thumbnail_cache_requests_total', 'Thumbnail cache lookups', ['result'])
+SOURCE_CACHE_REQUESTS = Counter('thumbnail_source_cache_requests_total', 'Local source image cache lookups', ['result'])
+SOURCE_CACHE_BYTES = Gauge('thumbnail_source_cache_bytes', 'Size of the local source image cache at its last scan')
+QUEUE_LAG = Histogram(
+    'thumbnail_queue_lag_seconds', 'Time between publishing a message and consuming it',
+    buckets=(0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+)
+IN_FLIGHT = Gauge('thumbnail_jobs_in_flight', 'Exercises between fetch and the Redis commit')
+PENDING = Gauge('thumbnail_pending_exercises', 'Exercises still waiting for a thumbnail')
+THROTTLES = Counter('thumbnail_throttles_total', 'Throttling responses from upstream services', ['source'])
+# Current limits of the adaptive controller
+BATCH_LIMIT = Gauge('thumbnail_batch_size_limit', 'Exercises fetched per drain batch')
+CONCURRENCY_LIMIT = Gauge('thumbnail_concurrency_limit', 'Jobs allowed in flight')
+BACKOFF_SECONDS = Gauge('thumbnail_backoff_seconds', 'Pause between drain batches')
+
+def stage_timer(stage: str):
+    """Context manager / decorator observing the wrapped block into STAGE_SECONDS"""
+    return STAGE_SECONDS.labels(stage).time()
+
+def observe_timings(timings: Optional[Dict[str, float]]):
+    """Records per-stage durations measured elsewhere, e.g. in a worker process"""
+    for stage, seconds in (timings or {}).items():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+def record_outcomes(succeeded: int, failed: int, skipped: int = 0):
+    IMAGES.labels('succeeded').inc(succeeded)
+    IMAGES.labels('failed').inc(failed)
+    if skipped:
+        IMAGES.labels('skipped').inc(skipped)
+
+def observe_queue_lag(published_at: Optional[float]):
+    """Records how long a message waited in the queue, from its publish timestamp"""
+    if published_at:
+        QUEUE_LAG.observe(max(0.0, time.time() - published_at))
+
+def start_metrics_server(port: Optional[int] = None) -> bool:
+    """Serves /metrics on METRICS_ADDR:port; a port of 0 leaves it off"""
+    port = Config.METRICS_PORT if port is None else port
+    if not port:
+        return False
+    try:
+        start_http_server(port, addr=Config.METRICS_ADDR)
+        logger.info(f"Serving metrics on http://{Config.METRICS_ADDR}:{port}/metrics")
+        return True
+    except Exception as e:
+        logger.error(f"Could not start metrics server on port {port}: {e}")
+        return False
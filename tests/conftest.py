@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+
+# Config reads these at import; the services below never connect to them
+for name, value in {
+    'RABBITMQ_HOST': 'localhost', 'RABBITMQ_PORT': '5672', 'RABBITMQ_QUEUE': 'exercises',
+    'REDIS_HOST': 'localhost', 'REDIS_PORT': '6379', 'REDIS_DB': '0', 'REDIS_TTL': '3600',
+    'AWS_BUCKET_NAME': 'proveit-exercises-directories', 'AWS_DEFAULT_REGION': 'us-east-1',
+    'METRICS_PORT': '0',
+}.items():
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from src.services.redis_service import RedisService
+from src.utils.adaptive import report_permanent_failure
+from src.utils.jobs import S3_URL_PREFIX
+
+def image_uri(key: str) -> str:
+    return f"https://{S3_URL_PREFIX}{key}"
+
+def exercise(exercise_id, key=None, thumbnail=None, **fields):
+    return dict(fields, id=exercise_id, image={'uri': image_uri(key or f"img/{exercise_id}.png"), 'thumbnail': thumbnail})
+
+def publish_catalog(redis_service: RedisService, exercises):
+    """Writes exercises:all the way the producer does"""
+    redis_service.redis.set(redis_service.all_key, json.dumps(exercises))
+
+class MemoryS3:
+    """Stand-in for S3Service uploads and AsyncS3Service downloads over a dict of objects.
+
+    Keys in ``flaky`` time out on every download.
+    """
+
+    def __init__(self, objects=None, flaky=()):
+        self.objects = {} if objects is None else objects
+        self.flaky = set(flaky)
+        self.downloads = 0
+
+    def put_object(self, key, data, content_type, bucket=None):
+        self.objects[key] = data
+        return True
+
+    def delete_objects(self, keys, bucket=None):
+        for key in keys:
+            self.objects.pop(key, None)
+        return True
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_image_with_etag(self, image_url, etag=None, skip=None):
+        key = image_url.split(S3_URL_PREFIX)[-1]
+        if key in self.flaky:
+            return None, None
+        if key not in self.objects:
+            # As AsyncS3Service does for NoSuchKey
+            report_permanent_failure(image_url, 'not found')
+            return None, None
+        etag = f"etag-{key}"
+        if skip and await skip(etag):
+            return None, etag
+        self.downloads += 1
+        return self.objects[key], etag
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def redis_service(server):
+    return RedisService(
+        client=fakeredis.FakeRedis(server=server, decode_responses=True),
+        binary_client=fakeredis.FakeRedis(server=server)
+    )
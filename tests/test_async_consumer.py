@@ -0,0 +1,160 @@
+import asyncio
+import io
+import json
+import pytest
+from PIL import Image
+from src.config import Config
+from src.async_consumer import AsyncImageConsumer
+from src.services.async_redis_service import AsyncRedisService
+from conftest import MemoryS3, exercise, fakeredis, publish_catalog
+
+def png(shade: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (500, 400), (shade, 40, 80)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+class Message:
+    def __init__(self, body: dict, headers=None):
+        self.body = json.dumps(body).encode('utf-8')
+        self.headers = headers or {}
+        self.routing_key = None
+        self.timestamp = None
+        self.processed = False
+        self.settled = None
+
+    async def ack(self):
+        self.processed, self.settled = True, 'ack'
+
+    async def nack(self, requeue=True):
+        self.processed, self.settled = True, 'nack'
+
+class MemoryBroker:
+    """Stand-in for AsyncRabbitMQService delivering a fixed list of messages"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.published = []
+        self.republished = []
+
+    async def start_consuming(self, callback):
+        for message in self.messages:
+            await callback(message)
+
+    async def publish_many(self, queue_name, messages, persistent=True):
+        self.published += messages
+        return len(messages)
+
+    async def republish(self, queue_name, body, headers):
+        self.republished.append((json.loads(body), headers))
+        return True
+
+    async def close(self):
+        pass
+
+@pytest.fixture(autouse=True)
+def small_config(monkeypatch):
+    monkeypatch.setattr(Config, 'PIPELINE_PROCESS_WORKERS', 1)
+    monkeypatch.setattr(Config, 'THUMBNAIL_CACHE_ENABLED', False)
+    monkeypatch.setattr(Config, 'THUMBNAIL_STORAGE', 'inline')
+    monkeypatch.setattr(Config, 'WORK_MODE', 'drain')
+
+def run_consumer(server, redis_service, s3, messages):
+    async def main():
+        async_redis = AsyncRedisService(
+            client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True), sync_service=redis_service
+        )
+        consumer = AsyncImageConsumer(redis_service=async_redis, s3_service=s3,
+                                      rabbitmq_service=MemoryBroker(messages))
+        await consumer.run()
+        return consumer
+    return asyncio.run(main())
+
+def test_drain_renders_every_pending_exercise(server, redis_service):
+    publish_catalog(redis_service, [exercise(i) for i in range(25)])
+    s3 = MemoryS3({f"img/{i}.png": png(i) for i in range(25)})
+    trigger = Message({'action': 'process_exercises'})
+
+    run_consumer(server, redis_service, s3, [trigger])
+
+    assert trigger.settled == 'ack'
+    assert redis_service.get_processing_status() == {'total': 25, 'processed': 25, 'remaining': 0, 'dead': 0}
+    catalog = redis_service.get_all_exercises()
+    assert len(catalog) == 25
+    assert all(item['image']['thumbnail'].startswith('data:image/jpeg;base64,') for item in catalog)
+    assert s3.downloads == 25
+
+def test_drain_dead_letters_images_that_cannot_be_rendered(server, redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'MAX_ATTEMPTS', 5)
+    publish_catalog(redis_service, [exercise(i) for i in range(6)] + [exercise('gone')])
+    objects = {f"img/{i}.png": png(i) for i in range(6)}
+    objects['img/3.png'] = b'\x89PNG\r\n\x1a\nnot really'
+    trigger = Message({'action': 'process_exercises'})
+
+    run_consumer(server, redis_service, MemoryS3(objects), [trigger])
+
+    assert trigger.settled == 'ack'
+    # Undecodable and missing images use up every attempt at once
+    assert redis_service.redis.zrange(redis_service.dead_key, 0, -1) == ['3', 'gone']
+    status = redis_service.get_processing_status()
+    assert status['processed'] == 5
+    assert redis_service.get_thumbnail('3') is None
+
+def test_work_unit_skips_exercises_already_committed(server, redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'WORK_MODE', 'fanout')
+    publish_catalog(redis_service, [exercise(i) for i in range(4)])
+    s3 = MemoryS3({f"img/{i}.png": png(i) for i in range(4)})
+    consumer = run_consumer(server, redis_service, s3, [Message({'action': 'process_exercises'})])
+    units = consumer.rabbitmq_service.published
+    assert sum(len(unit['jobs']) for unit in units) == 4
+
+    # Every unit delivered twice, as after a lost ack
+    redelivered = [Message(unit) for unit in units + units]
+    run_consumer(server, redis_service, s3, redelivered)
+
+    assert all(message.settled == 'ack' for message in redelivered)
+    assert s3.downloads == 4
+    assert redis_service.get_processing_status()['remaining'] == 0
+    assert all(item['image']['thumbnail'] for item in redis_service.get_all_exercises())
+
+def test_drain_materializes_catalog_on_schedule(server, redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'ADAPTIVE_ENABLED', False)
+    monkeypatch.setattr(Config, 'BATCH_SIZE', 4)
+    monkeypatch.setattr(Config, 'ASYNC_MAX_IN_FLIGHT', 4)
+    monkeypatch.setattr(Config, 'MATERIALIZE_INTERVAL_BATCHES', 1)
+    publish_catalog(redis_service, [exercise(i) for i in range(12)])
+    seen = []
+    materialize = redis_service.materialize_all_exercises
+
+    def spy(*args, **kwargs):
+        result = materialize(*args, **kwargs)
+        seen.append(sum(1 for item in redis_service.get_all_exercises() if item['image']['thumbnail']))
+        return result
+    monkeypatch.setattr(redis_service, 'materialize_all_exercises', spy)
+
+    run_consumer(server, redis_service, MemoryS3({f"img/{i}.png": png(i) for i in range(12)}),
+                 [Message({'action': 'process_exercises'})])
+
+    # Once per batch while draining, then once at the end
+    assert seen == [4, 8, 12, 12]
+
+def test_work_unit_requeues_failed_jobs_until_dead_lettered(server, redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'WORK_MODE', 'fanout')
+    monkeypatch.setattr(Config, 'MAX_ATTEMPTS', 3)
+    publish_catalog(redis_service, [exercise(i) for i in range(4)])
+    s3 = MemoryS3({f"img/{i}.png": png(i) for i in range(4)}, flaky={'img/2.png'})
+    consumer = run_consumer(server, redis_service, s3, [Message({'action': 'process_exercises'})])
+
+    deliveries = []
+    units = [Message(unit) for unit in consumer.rabbitmq_service.published]
+    while units:
+        deliveries.append(units)
+        broker = run_consumer(server, redis_service, s3, units).rabbitmq_service
+        units = [Message(unit, headers) for unit, headers in broker.republished]
+
+    retries = [message for messages in deliveries[1:] for message in messages]
+    assert [json.loads(message.body)['jobs'] for message in retries] == [[[2, 'img/2.png']]] * 2
+    assert [message.headers['x-attempts'] for message in retries] == [1, 2]
+    assert redis_service.redis.zrange(redis_service.dead_key, 0, -1) == ['2']
+    # Materialized once the last retry drained the backlog
+    catalog = {item['id']: item['image']['thumbnail'] for item in redis_service.get_all_exercises()}
+    assert [exercise_id for exercise_id, thumbnail in catalog.items() if thumbnail] == [0, 1, 3]
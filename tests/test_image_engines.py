@@ -0,0 +1,28 @@
+import pytest
+from src.benchmark import PARITY_PSNR_DB, bench_engines, build_corpus
+from src.services import image_engines
+from src.services.image_processor import create_renditions, data_uri, parse_renditions, thumbnail_psnr
+
+RENDITIONS = 'thumb:128x128:jpeg,card:480x270:webp'
+
+@pytest.fixture(scope='module')
+def corpus():
+    return build_corpus(8, seed=1234)
+
+def test_vips_matches_pillow(corpus):
+    if not image_engines.VipsEngine.available():
+        pytest.skip("pyvips is not installed")
+    renditions = parse_renditions(RENDITIONS, 'vips')
+    for key, data in corpus.items():
+        reference = create_renditions(data, renditions, 2.0, engine='pillow')
+        encoded = create_renditions(data, renditions, 2.0, engine='vips')
+        assert encoded is not None, key
+        for r in renditions:
+            psnr = thumbnail_psnr(data_uri(r.mime_type, reference[r.name]), data_uri(r.mime_type, encoded[r.name]))
+            assert psnr >= PARITY_PSNR_DB, f"{key} {r.name}: {psnr:.1f} dB"
+
+def test_benchmark_skips_parity_of_missing_engine(corpus, monkeypatch):
+    monkeypatch.setattr(image_engines.VipsEngine, 'available', staticmethod(lambda: False))
+    results = bench_engines(dict(list(corpus.items())[:2]), rounds=1)
+    assert results['vips'] == {'parity': 'skipped', 'reason': 'not installed'}
+    assert results['pillow']['parity'] == 'reference'
@@ -0,0 +1,192 @@
+import pytest
+from src.config import Config
+from src.services.redis_service import RedisService
+from conftest import exercise, fakeredis, publish_catalog
+
+def pending(redis_service):
+    return redis_service.redis.zrange(redis_service.pending_key, 0, -1)
+
+def dead(redis_service):
+    return redis_service.redis.zrange(redis_service.dead_key, 0, -1)
+
+def thumbnail(redis_service, exercise_id):
+    return redis_service.redis.hget(redis_service._data_key(exercise_id), 'thumbnail')
+
+def test_update_thumbnails_applies_and_clears_pending(redis_service):
+    publish_catalog(redis_service, [exercise(1), exercise(2)])
+    redis_service.sync_from_blob()
+
+    assert redis_service.update_exercise_thumbnail('1', 'data:thumb', {'large': 'data:large'}, 'img/1.png')
+    assert thumbnail(redis_service, '1') == 'data:thumb'
+    assert redis_service.get_thumbnail('1') == 'data:thumb'
+    assert redis_service.get_rendition('1', 'large') == 'data:large'
+    assert pending(redis_service) == ['2']
+
+def test_update_thumbnails_refuses_stale_source(redis_service):
+    publish_catalog(redis_service, [exercise(1, 'img/old.png')])
+    redis_service.sync_from_blob()
+    # The image changes while the old one is being rendered
+    publish_catalog(redis_service, [exercise(1, 'img/new.png')])
+    redis_service.sync_from_blob()
+
+    keys, args = redis_service.update_script_args([('1', 'data:old', None, 'img/old.png')])
+    assert redis_service._update_thumbnails(keys=keys, args=args) == [-1]
+    assert not redis_service.update_exercise_thumbnail('1', 'data:old', source='img/old.png')
+    assert thumbnail(redis_service, '1') is None
+    assert pending(redis_service) == ['1']
+
+    assert redis_service.update_exercise_thumbnail('1', 'data:new', source='img/new.png')
+    assert thumbnail(redis_service, '1') == 'data:new'
+
+def test_update_thumbnails_skips_unknown_exercise(redis_service):
+    keys, args = redis_service.update_script_args([('404', 'data:thumb', None, 'img/404.png')])
+    assert redis_service._update_thumbnails(keys=keys, args=args) == [0]
+    assert not redis_service.redis.exists(redis_service._data_key('404'))
+
+def test_record_failures_dead_letters_after_max_attempts(redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'MAX_ATTEMPTS', 3)
+    publish_catalog(redis_service, [exercise(1), exercise(2), exercise(3)])
+    redis_service.sync_from_blob()
+
+    assert redis_service.record_failures(['1', '2']) == []
+    assert redis_service.record_failures(['1']) == []
+    assert redis_service.record_failures(['1']) == ['1']
+    assert pending(redis_service) == ['2', '3']
+    assert dead(redis_service) == ['1']
+    # Kept at its catalog position for requeue_dead_letters
+    assert redis_service.redis.zscore(redis_service.dead_key, '1') == 0
+
+def test_record_failures_dead_letters_permanent_failures_at_once(redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'MAX_ATTEMPTS', 3)
+    publish_catalog(redis_service, [exercise(1), exercise(2)])
+    redis_service.sync_from_blob()
+
+    assert redis_service.record_failures(['2'], permanent_ids=['1']) == ['1']
+    assert dead(redis_service) == ['1']
+    assert pending(redis_service) == ['2']
+
+def test_record_failures_ignores_exercises_no_longer_pending(redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'MAX_ATTEMPTS', 1)
+    publish_catalog(redis_service, [exercise(1)])
+    redis_service.sync_from_blob()
+    redis_service.update_exercise_thumbnail('1', 'data:thumb', source='img/1.png')
+
+    assert redis_service.record_failures(['1', '404']) == []
+    assert dead(redis_service) == []
+    assert redis_service.redis.hget(redis_service._data_key('1'), 'attempts') is None
+
+def test_sync_skips_unchanged_catalog(redis_service):
+    publish_catalog(redis_service, [exercise(1), exercise(2, thumbnail='data:done')])
+    assert redis_service.sync_from_blob() == 2
+    assert pending(redis_service) == ['1']
+    assert redis_service.sync_from_blob() == 0
+
+def test_sync_writes_only_new_and_changed_exercises(redis_service):
+    publish_catalog(redis_service, [exercise(1, title='a'), exercise(2), exercise(3)])
+    redis_service.sync_from_blob()
+    redis_service.update_exercise_thumbnail('1', 'data:one', source='img/1.png')
+    redis_service.update_exercise_thumbnail('2', 'data:two', source='img/2.png')
+    untouched = redis_service.redis.hgetall(redis_service._data_key('3'))
+
+    publish_catalog(redis_service, [
+        exercise(1, title='b'),           # changed text, same image
+        exercise(2, 'img/2-v2.png'),      # new image
+        exercise(3),
+        exercise(4),                      # new
+    ])
+    assert redis_service.sync_from_blob() == 3
+
+    assert thumbnail(redis_service, '1') == 'data:one'
+    assert redis_service.get_exercise('1')['title'] == 'b'
+    assert thumbnail(redis_service, '2') is None
+    assert redis_service.redis.hget(redis_service._data_key('2'), 'source') == 'img/2-v2.png'
+    assert redis_service.redis.hgetall(redis_service._data_key('3')) == untouched
+    assert pending(redis_service) == ['2', '3', '4']
+    assert redis_service.redis.zrange(redis_service.index_key, 0, -1) == ['1', '2', '3', '4']
+
+def test_sync_does_not_adopt_thumbnail_of_replaced_image(redis_service):
+    publish_catalog(redis_service, [exercise(1, 'img/old.png')])
+    redis_service.sync_from_blob()
+    redis_service.update_exercise_thumbnail('1', 'data:old', source='img/old.png')
+    redis_service.materialize_all_exercises()
+
+    # The producer swaps the image but the blob still carries the old thumbnail
+    publish_catalog(redis_service, [exercise(1, 'img/new.png', thumbnail='data:old')])
+    redis_service.sync_from_blob()
+    assert thumbnail(redis_service, '1') is None
+    redis_service.sync_from_blob(force=True)
+    assert thumbnail(redis_service, '1') is None
+    assert pending(redis_service) == ['1']
+
+@pytest.mark.parametrize('dead_first', [False, True])
+def test_sync_gives_new_image_fresh_attempts(redis_service, monkeypatch, dead_first):
+    monkeypatch.setattr(Config, 'MAX_ATTEMPTS', 1)
+    publish_catalog(redis_service, [exercise(1, 'img/broken.png')])
+    redis_service.sync_from_blob()
+    if dead_first:
+        redis_service.record_failures(['1'])
+        assert dead(redis_service) == ['1']
+
+    publish_catalog(redis_service, [exercise(1, 'img/fixed.png')])
+    redis_service.sync_from_blob()
+    assert pending(redis_service) == ['1']
+    assert dead(redis_service) == []
+
+def claimed(redis_service):
+    return redis_service.redis.zrange(redis_service.claimed_key, 0, -1)
+
+def test_pending_batches_are_claimed_once(redis_service):
+    publish_catalog(redis_service, [exercise(i) for i in range(5)])
+    redis_service.sync_from_blob()
+
+    first = [item['id'] for item in redis_service.get_exercises_without_thumbnails(2)]
+    status, second = redis_service.get_status_and_pending(2)
+    assert first == [0, 1]
+    assert [item['id'] for item in second] == [2, 3]
+    assert pending(redis_service) == ['4']
+    # Claimed exercises are still to be done
+    assert status['remaining'] == 5
+
+    assert redis_service.update_exercise_thumbnail('0', 'data:thumb', source='img/0.png')
+    assert redis_service.record_failures(['1']) == []
+    assert claimed(redis_service) == ['2', '3']
+    assert pending(redis_service) == ['1', '4']
+    assert redis_service.redis.hget(redis_service._data_key('1'), 'attempts') == '1'
+
+    assert redis_service.release_claims(['2', '3', '0']) == 2
+    assert pending(redis_service) == ['1', '2', '3', '4']
+    assert claimed(redis_service) == []
+
+def test_expired_claims_return_to_pending(redis_service, monkeypatch):
+    publish_catalog(redis_service, [exercise(1), exercise(2)])
+    redis_service.sync_from_blob()
+    monkeypatch.setattr(Config, 'CLAIM_LEASE_SECONDS', -1)
+    # Claimed by a worker that died
+    assert len(redis_service.get_exercises_without_thumbnails(2)) == 2
+
+    monkeypatch.setattr(Config, 'CLAIM_LEASE_SECONDS', 600)
+    assert [item['id'] for item in redis_service.get_exercises_without_thumbnails(1)] == [1]
+    assert pending(redis_service) == ['2']
+
+def test_priority_requests_claim_their_exercises(redis_service):
+    publish_catalog(redis_service, [exercise(1), exercise(2)])
+    redis_service.sync_from_blob()
+    redis_service.prioritize(['2'])
+
+    exercises, unknown = redis_service.take_priority(10)
+    assert [item['id'] for item in exercises] == [2] and unknown == []
+    assert [item['id'] for item in redis_service.get_exercises_without_thumbnails(10)] == [1]
+
+def test_concurrent_drains_share_the_run_checkpoint(server, redis_service):
+    other = RedisService(client=fakeredis.FakeRedis(server=server, decode_responses=True),
+                         binary_client=fakeredis.FakeRedis(server=server))
+    redis_service.start_run()
+    other.start_run()
+    redis_service.checkpoint_run(3, 1, 0)
+    other.checkpoint_run(2, 0, 1)
+
+    assert redis_service.finish_run() == {}
+    assert redis_service.redis.exists(redis_service.run_key)
+    checkpoint = other.finish_run()
+    assert (checkpoint['batches'], checkpoint['succeeded'], checkpoint['dead_lettered']) == ('2', '5', '1')
+    assert not redis_service.redis.exists(redis_service.run_key, redis_service.run_drains_key)
@@ -0,0 +1,145 @@
+import asyncio
+import io
+import random
+import pytest
+from aiobotocore.response import StreamingBody
+from aiohttp import StreamReader
+from aiohttp.base_protocol import BaseProtocol
+from PIL import Image
+from src.config import Config
+from src.services.async_s3_service import AsyncS3Service
+from src.services.s3_service import S3Service
+from conftest import image_uri
+
+SHORT_READ = 1000
+
+def large_png() -> bytes:
+    """A noisy PNG of about 2 MB, far more than one read returns"""
+    noise = random.Random(7).randbytes(1000 * 700 * 3)
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (1000, 700), noise).save(buffer, 'PNG', compress_level=0)
+    return buffer.getvalue()
+
+class ShortReads:
+    """Body whose reads return at most SHORT_READ bytes, as network streams may"""
+
+    def __init__(self, data: bytes):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self.stream.read(min(amt, SHORT_READ) if amt is not None and amt >= 0 else SHORT_READ)
+
+    def close(self):
+        pass
+
+class AsyncShortReads(ShortReads):
+    async def read(self, amt=None):
+        return super().read(amt)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+class AiohttpResponse:
+    """The part of aiohttp.ClientResponse that aiobotocore's StreamingBody reads.
+
+    A task feeds ``content`` SHORT_READ bytes at a time, the way a socket
+    delivers a large object.
+    """
+    opened = []
+
+    def __init__(self, data: bytes):
+        loop = asyncio.get_running_loop()
+        protocol = BaseProtocol(loop)
+        protocol.connection_made(asyncio.Transport())
+        self.content = StreamReader(protocol, 2 ** 16, loop=loop)
+        self.url = 'https://bucket.s3.amazonaws.com/big.png'
+        self.closed = False
+        self.feeder = loop.create_task(self.feed(data))
+        self.opened.append(self)
+
+    async def feed(self, data: bytes):
+        for start in range(0, len(data), SHORT_READ):
+            self.content.feed_data(data[start:start + SHORT_READ])
+            await asyncio.sleep(0)
+        self.content.feed_eof()
+
+    def close(self):
+        self.closed = True
+        self.feeder.cancel()
+
+def aiohttp_body(data: bytes):
+    return StreamingBody(AiohttpResponse(data), len(data))
+
+class ObjectClient:
+    """Answers get_object for one object, honouring Range like S3"""
+
+    def __init__(self, data: bytes, body=ShortReads):
+        self.data = data
+        self.body = body
+
+    def response(self, Range=None):
+        start, end = 0, len(self.data) - 1
+        if Range:
+            first, _, last = Range[len('bytes='):].partition('-')
+            start, end = int(first), min(int(last), end) if last else end
+        part = self.data[start:end + 1]
+        response = {
+            'Body': self.body(part), 'ContentLength': len(part), 'ETag': '"etag"',
+            'ResponseMetadata': {'HTTPStatusCode': 206 if Range else 200},
+        }
+        if Range:
+            response['ContentRange'] = f"bytes {start}-{end}/{len(self.data)}"
+        return response
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        return self.response(Range)
+
+class AsyncObjectClient(ObjectClient):
+    async def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        return self.response(Range)
+
+@pytest.fixture(autouse=True)
+def no_source_cache(monkeypatch):
+    monkeypatch.setattr(Config, 'SOURCE_CACHE_ENABLED', False)
+
+@pytest.mark.parametrize('sniff_bytes', [0, 64 * 1024, 4 * 1024 * 1024])
+def test_sync_download_survives_short_reads(monkeypatch, sniff_bytes):
+    monkeypatch.setattr(Config, 'S3_SNIFF_BYTES', sniff_bytes)
+    data = large_png()
+    s3 = S3Service()
+    s3.s3_client = ObjectClient(data)
+
+    assert s3.get_image_with_etag(image_uri('big.png')) == (data, 'etag')
+
+@pytest.mark.parametrize('sniff_bytes', [0, 64 * 1024, 4 * 1024 * 1024])
+def test_async_download_survives_short_reads(monkeypatch, sniff_bytes):
+    monkeypatch.setattr(Config, 'S3_SNIFF_BYTES', sniff_bytes)
+    data = large_png()
+    s3 = AsyncS3Service()
+    s3.s3_client = AsyncObjectClient(data, AsyncShortReads)
+
+    assert asyncio.run(s3.get_image_with_etag(image_uri('big.png'))) == (data, 'etag')
+
+@pytest.mark.parametrize('sniff_bytes', [0, 64 * 1024, 4 * 1024 * 1024])
+def test_async_download_reads_aiohttp_stream_to_the_end(monkeypatch, sniff_bytes):
+    monkeypatch.setattr(Config, 'S3_SNIFF_BYTES', sniff_bytes)
+    monkeypatch.setattr(AiohttpResponse, 'opened', [])
+    data = large_png()
+    s3 = AsyncS3Service()
+    s3.s3_client = AsyncObjectClient(data, aiohttp_body)
+
+    assert asyncio.run(s3.get_image_with_etag(image_uri('big.png'))) == (data, 'etag')
+    assert AiohttpResponse.opened and all(response.closed for response in AiohttpResponse.opened)
+
+def test_download_stops_past_size_limit(monkeypatch):
+    monkeypatch.setattr(Config, 'S3_SNIFF_BYTES', 0)
+    monkeypatch.setattr(Config, 'S3_MAX_OBJECT_BYTES', 100 * 1024)
+    s3 = S3Service()
+    client = s3.s3_client = ObjectClient(large_png())
+    # A wrong Content-Length must not let the body through either
+    client.response = lambda Range=None: dict(ObjectClient.response(client, Range), ContentLength=0)
+
+    assert s3.get_image_with_etag(image_uri('big.png')) == (None, None)
@@ -0,0 +1,60 @@
+import io
+import os
+import pytest
+from PIL import Image
+from src.config import Config
+from src.services.image_pipeline import ImagePipeline
+from src.services.image_processor import ImageProcessor
+from src.services.source_cache import SourceCache, SourceEvicted
+from conftest import exercise, publish_catalog
+
+def jpeg() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), (200, 120, 40)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+class EvictingS3:
+    """Serves objects through a SourceCache and evicts the first copy before it is rendered"""
+
+    def __init__(self, cache: SourceCache):
+        self.cache = cache
+        self.fetches = 0
+
+    def get_image_with_etag(self, image_url, etag=None, skip=None):
+        self.fetches += 1
+        source = self.cache.put(Config.AWS_BUCKET_NAME, image_url, 'etag', jpeg())
+        if self.fetches == 1:
+            os.unlink(source.path)
+        return source, 'etag'
+
+@pytest.fixture
+def cache(tmp_path):
+    return SourceCache(str(tmp_path))
+
+def test_evicted_source_raises_source_evicted(cache):
+    source = cache.put('bucket', 'key', 'etag', b'data')
+    os.unlink(source.path)
+    with pytest.raises(SourceEvicted):
+        with source.open():
+            pass
+
+def test_serial_render_fetches_evicted_source_again(cache):
+    s3 = EvictingS3(cache)
+    processor = ImageProcessor(s3)
+
+    assert processor.process_image('1', 'img/1.jpg').startswith('data:image/jpeg;base64,')
+    assert s3.fetches == 2
+
+def test_pipeline_fetches_evicted_source_again(cache, redis_service, monkeypatch):
+    monkeypatch.setattr(Config, 'PIPELINE_PROCESS_WORKERS', 1)
+    publish_catalog(redis_service, [exercise(1, 'img/1.jpg')])
+    redis_service.sync_from_blob()
+    s3 = EvictingS3(cache)
+    pipeline = ImagePipeline(ImageProcessor(s3), redis_service)
+    try:
+        assert pipeline.run([('1', 'img/1.jpg')]) == 1
+    finally:
+        pipeline.close()
+
+    assert s3.fetches == 2
+    assert redis_service.get_thumbnail('1').startswith('data:image/jpeg;base64,')
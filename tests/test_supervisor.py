@@ -0,0 +1,7 @@
+from src.config import Config
+from src.supervisor import WorkerSupervisor
+
+def test_several_workers_run_in_fanout_mode(monkeypatch):
+    monkeypatch.setattr(Config, 'WORK_MODE', 'drain')
+    assert WorkerSupervisor(worker_count=3).work_mode == 'fanout'
+    assert WorkerSupervisor(worker_count=1).work_mode == 'drain'
@@ -0,0 +1,83 @@
+import pytest
+from src.config import Config
+from src.services.image_processor import parse_renditions
+from src.services.thumbnail_store import RedisThumbnailStore, S3ThumbnailStore
+from conftest import MemoryS3, exercise, publish_catalog
+
+RENDITIONS = parse_renditions('thumb:128x128:jpeg,card:480x270:webp')
+
+def encoded(tag: bytes):
+    return [(rendition, tag + rendition.name.encode()) for rendition in RENDITIONS]
+
+def commit(redis_service, exercise_id, renditions) -> bool:
+    thumbnail = renditions['thumb']
+    return redis_service.update_exercise_thumbnail(exercise_id, thumbnail, {'card': renditions['card']},
+                                                   f"img/{exercise_id}.png")
+
+@pytest.fixture
+def catalog(redis_service):
+    publish_catalog(redis_service, [exercise(1), exercise(2)])
+    redis_service.sync_from_blob()
+    return redis_service
+
+def test_rendition_keys_expire_but_committed_blobs_do_not(catalog, monkeypatch):
+    monkeypatch.setattr(Config, 'REDIS_TTL', 3600)
+    store = RedisThumbnailStore(catalog)
+    keys = store.put('fp', encoded(b'a'))
+    # Nothing refers to them yet
+    assert all(0 < catalog.redis.ttl(key) <= 3600 for key in keys.values())
+    assert commit(catalog, '1', keys)
+
+    for key in [catalog.rendition_key('1', 'card'), f"{catalog.image_prefix}1"]:
+        assert 0 < catalog.redis.ttl(key) <= 3600, key
+    assert all(catalog.redis.ttl(key) == -1 for key in keys.values())
+
+    # Written again for another exercise, which then fails to commit them
+    assert store.put('fp', encoded(b'a')) == keys
+    assert all(catalog.redis.ttl(key) == -1 for key in keys.values())
+
+def test_replaced_blobs_are_deleted_with_their_last_reference(catalog):
+    store = RedisThumbnailStore(catalog)
+    shared = store.put('fp', encoded(b'a'))
+    assert commit(catalog, '1', shared) and commit(catalog, '2', shared)
+
+    assert commit(catalog, '1', store.put('fp-1', encoded(b'b')))
+    # Exercise 2 still shows them
+    assert all(catalog.get_blob(key) for key in shared.values())
+    assert store.alive(shared['thumb'])
+
+    assert commit(catalog, '2', store.put('fp-2', encoded(b'c')))
+    assert not any(catalog.redis.exists(key) for key in shared.values())
+    assert not store.alive(shared['thumb'])
+
+def test_released_thumbnail_is_not_committed(catalog):
+    store = RedisThumbnailStore(catalog)
+    old = store.put('fp', encoded(b'a'))
+    assert commit(catalog, '1', old)
+    assert commit(catalog, '1', store.put('fp-1', encoded(b'b')))
+
+    keys, args = catalog.update_script_args([('2', old['thumb'], None, 'img/2.png')])
+    assert catalog._update_thumbnails(keys=keys, args=args) == [-2]
+    assert catalog.redis.hget(catalog._data_key('2'), 'thumbnail') is None
+
+def test_replaced_s3_objects_are_deleted_after_next_upload(catalog):
+    s3 = MemoryS3()
+    store = S3ThumbnailStore(s3, catalog)
+    assert commit(catalog, '1', store.put('fp', encoded(b'a')))
+    assert set(s3.objects) == {'thumbnails/fp/thumb.jpg', 'thumbnails/fp/card.webp'}
+
+    assert commit(catalog, '1', store.put('fp-1', encoded(b'b')))
+    store.put('fp-2', encoded(b'c'))
+
+    assert set(s3.objects) == {f"thumbnails/{owner}/{name}" for owner in ('fp-1', 'fp-2')
+                               for name in ('thumb.jpg', 'card.webp')}
+
+def test_sync_releases_thumbnail_of_replaced_image(catalog):
+    store = RedisThumbnailStore(catalog)
+    keys = store.put('fp', encoded(b'a'))
+    assert commit(catalog, '1', keys)
+
+    publish_catalog(catalog, [exercise(1, 'img/1-v2.png'), exercise(2)])
+    catalog.sync_from_blob()
+
+    assert not any(catalog.redis.exists(key) for key in keys.values())